@@ -0,0 +1,211 @@
+# ----------------------------------------------------------------------------------------
+# ColumnarStore.py
+# Version: ArcPro / Python 3+
+# Creation Date: 2026-10-16
+# Last Edit: 2026-10-16
+
+# Summary:
+# Optional columnar (GeoParquet-style) copies of the traced network outputs (lines, catchments, sub-catchments), for
+# downstream metric and prioritization steps which only need some columns, or the features in an area.
+# Geometry is stored as WKB, with a bounding box column (struct of xmin, ymin, xmax, ymax) for each feature. Rows are
+# written in row groups as they come in, so outputs are never held in memory as a whole, and parquet keeps column
+# statistics for each row group, so reads filtered by attributes or bounding box skip whole row groups.
+# The file metadata has a `geo` key, as in GeoParquet (encoding, geometry types, bbox, covering, CRS).
+
+# Usage Tips:
+# Requires pyarrow (conda install pyarrow). It is only imported when this module is used, so the rest of the
+# workflow does not depend on it.
+# The CRS is stored as PROJJSON, made with pyproj from the EPSG code of the spatial reference (or its WKT, if it has
+# no code). As GeoParquet reads a missing CRS as OGC:CRS84, it is left out only for geographic WGS84, and is null
+# (unknown) when there is no spatial reference. pyproj is needed for any other CRS.
+# The HealthyWaters functions (WriteColumnar_hw) export finished output feature classes to columnar copies after each
+# stage (FeaturesToColumnar); OpenColumnar/WriteRows can also be used to write rows as they are made.
+
+# Syntax:
+# FeaturesToColumnar('hw_Flowline_5km_catchArea', 'E:/hw_parquet/hw_Flowline_5km_catchArea.parquet')
+# OR streaming rows as they are made
+# store = OpenColumnar(out_File, [['OBJECTID_in_Points', 'LONG']], 'MultiPolygon', sr)
+# WriteRows(store, [[geom, 1], [geom2, 2]])
+# CloseColumnar(store)
+# table = ReadColumnar(out_File, ['OBJECTID_in_Points'], bbox=[xmin, ymin, xmax, ymax])
+# ----------------------------------------------------------------------------------------
+
+# Import modules
+import os
+import json
+
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+   import pyarrow.dataset as ds
+except ImportError:
+   pa = None
+
+try:
+   import pyproj
+except ImportError:
+   pyproj = None
+
+try:
+   import arcpy
+except ImportError:
+   arcpy = None
+
+# arcpy field types: arrow types
+arrowTypes = {'SHORT': 'int32', 'SmallInteger': 'int32', 'LONG': 'int64', 'Integer': 'int64', 'OID': 'int64',
+              'FLOAT': 'float32', 'Single': 'float32', 'DOUBLE': 'float64', 'Double': 'float64',
+              'TEXT': 'string', 'String': 'string', 'DATE': 'timestamp', 'Date': 'timestamp'}
+
+# arcpy shape types: GeoParquet geometry types
+geomTypes = {'Polygon': 'MultiPolygon', 'Polyline': 'MultiLineString', 'Point': 'Point', 'Multipoint': 'MultiPoint'}
+
+
+def RequireArrow():
+   """Raises an ImportError if pyarrow is not installed."""
+   if pa is None:
+      raise ImportError('pyarrow is required for columnar outputs (conda install pyarrow).')
+
+
+def ArrowType(ftype):
+   """Arrow data type for an arcpy field type (see arrowTypes)."""
+   t = arrowTypes.get(ftype, 'string')
+   if t == 'timestamp':
+      return pa.timestamp('ms')
+   return pa.type_for_alias(t)
+
+
+def CrsJson(sr):
+   """PROJJSON CRS for the `geo` metadata, from an arcpy SpatialReference. Returns None if sr is None (unknown CRS).
+   Raises an ImportError if pyproj is not installed."""
+   if sr is None:
+      return None
+   if pyproj is None:
+      raise ImportError('pyproj is required to write the CRS of columnar outputs (conda install pyproj).')
+   if sr.factoryCode:
+      crs = pyproj.CRS.from_epsg(int(sr.factoryCode))
+   else:
+      # exportToString appends the coordinate domains and tolerances after the WKT, separated by ';'
+      crs = pyproj.CRS.from_wkt(sr.exportToString().split(';')[0])
+   return crs.to_json_dict()
+
+
+def GeoColumn(geomType, sr=None):
+   """Geometry column metadata for the `geo` key. The CRS is left out for geographic WGS84 (EPSG 4326), which is
+   what GeoParquet assumes when it is missing (OGC:CRS84, lon/lat), and is null for an unknown CRS."""
+   col = {'encoding': 'WKB', 'geometry_types': [geomType],
+          'covering': {'bbox': {'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'],
+                                'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}}}
+   if sr is None or sr.factoryCode != 4326:
+      col['crs'] = CrsJson(sr)
+   return col
+
+
+def OpenColumnar(out_File, fields, geomType, sr=None, rowGroup=10000):
+   """Opens a columnar store for writing, returning a store dictionary used by WriteRows and CloseColumnar.
+   Parameters:
+   - out_File = Output parquet file
+   - fields = List of [name, arcpy field type] for the attribute columns
+   - geomType = GeoParquet geometry type (e.g. 'MultiPolygon'; see geomTypes)
+   - sr = arcpy SpatialReference of the geometries
+   - rowGroup = Number of rows per row group. Rows are buffered until a row group is full.
+   """
+   RequireArrow()
+   bbox = pa.struct([('xmin', pa.float64()), ('ymin', pa.float64()), ('xmax', pa.float64()), ('ymax', pa.float64())])
+   schema = pa.schema([('geometry', pa.binary()), ('bbox', bbox)] + [(f[0], ArrowType(f[1])) for f in fields])
+   if os.path.dirname(out_File) and not os.path.exists(os.path.dirname(out_File)):
+      os.makedirs(os.path.dirname(out_File))
+   geo = {'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': GeoColumn(geomType, sr)}}
+   writer = pq.ParquetWriter(out_File, schema, write_statistics=True)
+   return {'file': out_File, 'schema': schema, 'writer': writer, 'fields': [f[0] for f in fields], 'rows': [],
+           'rowGroup': rowGroup, 'geo': geo, 'bbox': [float('inf'), float('inf'), -float('inf'), -float('inf')],
+           'count': 0}
+
+
+def WriteRows(store, rows):
+   """Adds rows to a columnar store (OpenColumnar). Rows are [geometry] + attribute values, in the order of the store
+   fields, where geometry is an arcpy geometry, or [wkb, [xmin, ymin, xmax, ymax]]. Full row groups are written out
+   as they fill."""
+   for row in rows:
+      g = row[0]
+      if isinstance(g, (list, tuple)):
+         wkb, box = bytes(g[0]), list(g[1])
+      else:
+         e = g.extent
+         wkb, box = bytes(g.WKB), [e.XMin, e.YMin, e.XMax, e.YMax]
+      store['rows'].append([wkb, box] + list(row[1:]))
+      if len(store['rows']) >= store['rowGroup']:
+         FlushColumnar(store)
+
+
+def FlushColumnar(store):
+   """Writes buffered rows of a columnar store as a row group."""
+   rows = store['rows']
+   if len(rows) == 0:
+      return
+   cols = {'geometry': [r[0] for r in rows],
+           'bbox': [dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], r[1])) for r in rows]}
+   for i, f in enumerate(store['fields']):
+      cols[f] = [r[i + 2] for r in rows]
+   store['writer'].write_table(pa.Table.from_pydict(cols, schema=store['schema']))
+   b = store['bbox']
+   store['bbox'] = [min(b[0], min([r[1][0] for r in rows])), min(b[1], min([r[1][1] for r in rows])),
+                    max(b[2], max([r[1][2] for r in rows])), max(b[3], max([r[1][3] for r in rows]))]
+   store['count'] += len(rows)
+   store['rows'] = []
+
+
+def CloseColumnar(store):
+   """Writes remaining rows and the `geo` metadata, and closes a columnar store. Returns the file path."""
+   FlushColumnar(store)
+   if store['count'] > 0:
+      store['geo']['columns']['geometry']['bbox'] = store['bbox']
+   store['writer'].add_key_value_metadata({'geo': json.dumps(store['geo'])})
+   store['writer'].close()
+   return store['file']
+
+
+def FeaturesToColumnar(in_Features, out_File, fields=None, rowGroup=10000):
+   """Copies a feature class to a columnar store, streaming rows from a cursor one row group at a time.
+   Parameters:
+   - in_Features = Input feature class
+   - out_File = Output parquet file
+   - fields = Fields to copy (default all, except the ObjectID, geometry and geometry length/area fields)
+   - rowGroup = Number of rows per row group
+   """
+   desc = arcpy.Describe(in_Features)
+   skip = [getattr(desc, 'lengthFieldName', ''), getattr(desc, 'areaFieldName', '')]
+   flds = [f for f in arcpy.ListFields(in_Features) if f.type not in ['OID', 'Geometry'] and f.name not in skip]
+   if fields:
+      flds = [f for f in flds if f.name in fields]
+   store = OpenColumnar(out_File, [[f.name, f.type] for f in flds], geomTypes.get(desc.shapeType, desc.shapeType),
+                        desc.spatialReference, rowGroup)
+   print('Writing `' + in_Features + '` to columnar store `' + out_File + '`...')
+   with arcpy.da.SearchCursor(in_Features, ['SHAPE@'] + [f.name for f in flds]) as cursor:
+      batch = []
+      for row in cursor:
+         if row[0] is None:
+            continue
+         batch.append(row)
+         if len(batch) >= rowGroup:
+            WriteRows(store, batch)
+            batch = []
+      WriteRows(store, batch)
+   return CloseColumnar(store)
+
+
+def ReadColumnar(in_File, columns=None, bbox=None, where=None):
+   """Reads a columnar store to an arrow Table, reading only the requested columns. Row groups whose statistics do not
+   match the bounding box (or where expression) are skipped.
+   Parameters:
+   - in_File = Parquet file from OpenColumnar or FeaturesToColumnar
+   - columns = Columns to read (default all). Include 'geometry' for the WKB geometries.
+   - bbox = Optional [xmin, ymin, xmax, ymax]; only features whose bounding box intersects it are returned
+   - where = Optional pyarrow.dataset expression, e.g. ds.field('OBJECTID_in_Points') == 5
+   """
+   RequireArrow()
+   expr = where
+   if bbox is not None:
+      e = ((ds.field('bbox', 'xmax') >= bbox[0]) & (ds.field('bbox', 'xmin') <= bbox[2]) &
+           (ds.field('bbox', 'ymax') >= bbox[1]) & (ds.field('bbox', 'ymin') <= bbox[3]))
+      expr = e if expr is None else expr & e
+   return ds.dataset(in_File, format='parquet').to_table(columns=columns, filter=expr)
@@ -2,7 +2,7 @@
 # HealthyWaters.py
 # Version:  ArcGIS 10.3.1 / Python 2.7.8 OR ArcPro / Python 3.x
 # Creation Date: 2020-01-06
-# Last Edit: 2020-06-02
+# Last Edit: 2026-10-16
 # Creator(s):  Kirsten R. Hazler/David Bucklin
 
 # Summary:
@@ -34,20 +34,47 @@
 #
 # Create feature classes for upstream flowline network and catchments
 # GetCatchArea_hw(in_Points, in_lyrUpTrace, in_Catchment, out_Lines, out_CatchArea)
+#
+# OR, with Network Analyst, in batches of points (by HU4) solved in parallel worker processes
+# GetNetworksBatched_hw(in_Points, in_hydroNet, out_Lines, up_Dist = 1000, in_Catchment, workers = 4)
+#
+# OR, without Network Analyst, trace upstream networks in-process (see HydroGraph.py)
+# TraceNetworks_hw(in_Points, in_hydroNet, out_Lines, up_Dist = 1000, in_Catchment)
+# OR for multiple distances from one trace
+# TraceNetworkBands_hw(in_Points, in_hydroNet, [[2000, 'hw_Flowline_2km'], [5000, 'hw_Flowline_5km']], in_Catchment)
+# OR to only re-trace new or moved points, updating outputs from a previous run in the same geodatabase
+# UpdateNetworkBands_hw(in_Points, in_hydroNet, [[2000, 'hw_Flowline_2km'], [5000, 'hw_Flowline_5km']], in_Catchment)
+#
+# Whole-watershed totals of catchment attributes for each point, from an upstream accumulation (no trace/dissolve)
+# WatershedTotals_hw(in_Points, in_hydroNet, in_Catchment, ['areaSqKm'], 'hw_fullWs_totals')
+#
+# Write times, feature counts and memory use for each stage of the functions above to a JSON report
+# WriteRunReport('hw_runReport.json')
 # ----------------------------------------------------------------------------------------
 
 # Import modules
 from HelperPro import *
+import concurrent.futures
+import hashlib
+import json
+import HydroGraph
+import WatershedRaster
+import ColumnarStore
+from HydroGraph import *
 
 
-def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
+def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True, lyrName="naUpTrace", out_Dir=None):
    """Creates a service layer needed to grab stream segments a specified distance upstream of network points.
    This function only needs to be run once for each distance specified. After that, the output layers can be reused
    repeatedly.
    Parameters:
    - in_hydroNet = Input hydrological network dataset (e.g., VA_HydroNet.gdb\HydroNet\HydroNet_ND)
    - up_Dist = The distance (in map units) to traverse upstream from a point along the network
-   - dams = Whether dams should be included as barriers in the network analysis layer
+   - dams = Whether dams should be included as barriers in the network analysis layer (as line barriers; see
+      TraceNetworks_hw for how these differ from dams in the in-process tracer)
+   - lyrName = Name of the network analysis layer. Layers made at the same time (e.g. one per batch in
+      GetNetworksBatched_hw) need different names.
+   - out_Dir = Folder for the output layer file. Default is the folder containing the HydroNet geodatabase.
    """
    arcpy.CheckOutExtension("Network")
 
@@ -56,9 +83,11 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
    nwDataset = descHydro.catalogPath
    catPath = os.path.dirname(nwDataset)  # This is where hydro layers will be found
    hydroDir = os.path.dirname(os.path.dirname(catPath))  # This is where output layer files will be saved
+   if out_Dir:
+      hydroDir = out_Dir
 
    # Output layer name to reflect the specified upstream distance
-   lyrUpTrace = hydroDir + os.sep + "naUpTrace_%s.lyr" % str(int(round(up_Dist)))
+   lyrUpTrace = hydroDir + os.sep + lyrName + "_%s.lyr" % str(int(round(up_Dist)))
 
    # Upstream trace with break at specified distance
    restrictions = ["NoPipelines", "NoUndergroundConduits", "NoEphemeral", "NoCoastline"]
@@ -68,7 +97,7 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
    if pyvers < 3:
       # create service area line layer for ArcMap
       serviceLayer = arcpy.MakeServiceAreaLayer_na(in_network_dataset=nwDataset,
-                                                   out_network_analysis_layer="naUpTrace",
+                                                   out_network_analysis_layer=lyrName,
                                                    impedance_attribute="Length",
                                                    travel_from_to="TRAVEL_FROM",
                                                    default_break_values=up_Dist,
@@ -94,7 +123,7 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
       tm.name = "setRestrict"
       # Note: This removes all travel restrictions along network
       tm.restrictions = restrictions
-      serviceLayer = arcpy.na.MakeServiceAreaAnalysisLayer(nwDataset, "naUpTrace", tm, "FROM_FACILITIES",
+      serviceLayer = arcpy.na.MakeServiceAreaAnalysisLayer(nwDataset, lyrName, tm, "FROM_FACILITIES",
                                                            up_Dist, output_type="LINES",
                                                            geometry_at_overlaps="OVERLAP")
    if dams:
@@ -105,7 +134,7 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
 
       # Add dam barriers to service layer
       printMsg('Adding dam barriers to service layer...')
-      barriers = arcpy.AddLocations_na(in_network_analysis_layer="naUpTrace",
+      barriers = arcpy.AddLocations_na(in_network_analysis_layer=lyrName,
                                        sub_layer="Line Barriers",
                                        in_table=in_Lines,
                                        field_mappings="Name Permanent_Identifier #",
@@ -121,7 +150,7 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
 
    # save
    printMsg('Saving service layer to %s...' % lyrUpTrace)
-   arcpy.SaveToLayerFile_management("naUpTrace", lyrUpTrace)
+   arcpy.SaveToLayerFile_management(lyrName, lyrUpTrace)
 
    if dams:
       del barriers
@@ -133,7 +162,7 @@ def MakeServiceLayer_hw(in_hydroNet, up_Dist, dams=True):
 
 
 def GetCatchments_hw(in_Lines, in_Catchment, out_CatchArea, in_Points,
-                     ptid_join="OBJECTID_in_Points", catID="NHDPlusID", get_SubCat=True):
+                     ptid_join="OBJECTID_in_Points", catID="NHDPlusID", get_SubCat=True, workers=1, native=False):
    """Internal function to select catchments associated with an upstream network.
 
    in_Lines = Line networks, output from a network analyst service area analysis
@@ -143,76 +172,80 @@ def GetCatchments_hw(in_Lines, in_Catchment, out_CatchArea, in_Points,
    ptid_join = Unique integer ID for each network, inherited from original points (in_Points)
    catID = Unique integer ID for each catchment
    get_SubCat = Boolean; calculate and replace initial catchment with precise subcatchment?
+   workers = Number of worker processes for sub-catchments (see GetSubCatchments_hw)
+   native = Use the windowed D8 watershed labeller for sub-catchments (see GetSubCatchments_hw)
    """
-   out_scratch = arcpy.env.scratchGDB + os.sep
-   # Use NHDPlusID to build a query. NHDPlusID is necessary for this.
-   oids = set([str(int(a[0])) for a in arcpy.da.SearchCursor(in_Lines, catID)])
-   oids = list(oids)
-   query = catID + " IN (" + ','.join(oids) + ")"
-   cat_lyr = arcpy.MakeFeatureLayer_management(in_Catchment, where_clause=query)
+   # Unique network/catchment pairs from the lines. NHDPlusID is necessary for this.
+   pairs = set([(int(a[0]), int(a[1])) for a in arcpy.da.SearchCursor(in_Lines, [ptid_join, catID])
+                if a[1] is not None])
 
-   # OLD method. Not necessary anymore
+   # OLD methods. Not necessary anymore
    # cat_lyr = arcpy.MakeFeatureLayer_management(in_Catchment, where_clause="SourceFC <> 'NHDPlusSink'")
    # arcpy.SelectLayerByLocation_management(cat_lyr, "INTERSECT", in_Lines)
+   # (catchments were also selected with a `catID IN (...)` query, spatially joined to lines, and dissolved)
 
-   # get/dissolve catchments associated with lines
+   # get catchments associated with lines, fetched by catID using the catchment ID index (no SQL IN query)
    print('Getting associated catchments...')
    # ISSUE: Some flowlines do not have associated catchments (e.g canals). This will miss those catchments.
-   arcpy.SpatialJoin_analysis(cat_lyr, in_Lines, out_feature_class=out_scratch + 'cat_sj',
-                                          join_operation="JOIN_ONE_TO_MANY",
-                                          join_type="KEEP_COMMON",
-                                          match_option="INTERSECT")
-   # Only want catchments matching corresponding flowlines; also dissolve to reduce fields.
-   # query = catID + ' IS NOT NULL AND ' + catID + '_1 IS NOT NULL AND (' + catID + ' = ' + catID + '_1'
-   query = catID + ' = ' + catID + '_1'
-   catch_full = arcpy.MakeFeatureLayer_management(out_scratch + 'cat_sj', where_clause=query)
-   arcpy.Dissolve_management(catch_full, out_CatchArea + '_full', dissolve_field=[ptid_join, catID])
-   del catch_full
+   with RunStage('GetCatchments', pairs) as stage:
+      catIndex = MakeIdIndex(in_Catchment, catID)
+      cat_oids, missing = LookupIds(catIndex, [p[1] for p in pairs])
+      if len(missing) > 0:
+         print(str(len(missing)) + ' `' + catID + '` values in lines do not have a catchment.')
+      shp = dict([[int(a[1]), a[2]] for a in FetchRows(in_Catchment, cat_oids, [catID, "SHAPE@"])])
+      ws, nm = SplitPath(out_CatchArea + '_full')
+      sr = arcpy.Describe(in_Catchment).spatialReference
+      arcpy.CreateFeatureclass_management(ws, nm, "POLYGON", spatial_reference=sr)
+      arcpy.AddField_management(out_CatchArea + '_full', ptid_join, "LONG")
+      arcpy.AddField_management(out_CatchArea + '_full', catID, "DOUBLE")
+      with arcpy.da.InsertCursor(out_CatchArea + '_full', ["SHAPE@", ptid_join, catID]) as cursor:
+         for p in sorted(pairs):
+            if p[1] in shp:
+               cursor.insertRow([shp[p[1]], p[0], p[1]])
+      stage['out'] = out_CatchArea + '_full'
 
    # Sub-catchment routine
    if get_SubCat:
       out_subCat = os.path.basename(in_Points) + '_subCatchArea'
-      if not arcpy.Exists(out_subCat):
-         # Only needs to run once. Uses a fixed name so it can be reused for other catchments generated in the gdb.
-         GetSubCatchments_hw(in_Lines, out_CatchArea + '_full', out_subCat, ptid_join)
+      with RunStage('SubCatchments', in_Lines) as stage:
+         if not arcpy.Exists(out_subCat):
+            # Only needs to run once. Uses a fixed name so it can be reused for other catchments generated in the gdb.
+            GetSubCatchments_hw(in_Lines, out_CatchArea + '_full', out_subCat, ptid_join, catID, workers=workers,
+                                native=native)
+         stage['out'] = out_subCat
       print("Replacing initial catchment with sub-catchment...")
-      catch_full = arcpy.MakeFeatureLayer_management(out_CatchArea + '_full')
-      nid_oid = [[ptid_join + " = " + str(a[0]), catID + " = " + str(int(a[1]))] for a in
-                 arcpy.da.SearchCursor(out_subCat, [ptid_join, catID])]
-      # make query for pairwise selection of catchments
-      query = '(' + ') OR ('.join([' AND '.join(b) for b in nid_oid]) + ')'
-      arcpy.SelectLayerByAttribute_management(catch_full, "NEW_SELECTION", query)
-      arcpy.DeleteRows_management(catch_full)
-      arcpy.Append_management(out_subCat, out_CatchArea + '_full', "NO_TEST")
-      del catch_full
+      # pairwise (network, catchment) replacement of catchments
+      with RunStage('ReplaceSubCatchments', out_subCat):
+         ReplacePairs(out_CatchArea + '_full', [ptid_join, catID], out_subCat)
    # end Sub-catchment routine
-   del cat_lyr
 
    print('Dissolving catchments...')
-   arcpy.Dissolve_management(out_CatchArea + '_full', out_CatchArea, dissolve_field=ptid_join)
-
-   # get unaasociated catchments (using lines instead of catchments...)
-   assoc = list(set([str(f[0]) for f in arcpy.da.SearchCursor(in_Lines, ptid_join)]))
-   query = ptid_join + " NOT IN (" + ','.join(assoc) + ")"
-   pt_lyr = arcpy.MakeFeatureLayer_management(in_Points, where_clause=query)
-
-   if int(arcpy.GetCount_management(pt_lyr)[0]) > 0:
-      printMsg('Adding catchments for points without networks...')
-      cat_lyr = arcpy.MakeFeatureLayer_management(in_Catchment)
-      arcpy.SelectLayerByLocation_management(cat_lyr, "INTERSECT", pt_lyr)
-      arcpy.SpatialJoin_analysis(cat_lyr, pt_lyr, out_scratch + 'catUnassoc',
-                                 join_operation="JOIN_ONE_TO_MANY", join_type="KEEP_COMMON", match_option="INTERSECT")
-      arcpy.Dissolve_management(out_scratch + 'catUnassoc',
-                                out_scratch + 'catUnassoc1', dissolve_field=[ptid_join, catID])
-      arcpy.Append_management(out_scratch + 'catUnassoc1', out_CatchArea, "NO_TEST")
-      arcpy.Append_management(out_scratch + 'catUnassoc1', out_CatchArea + '_full', "NO_TEST")
-      del pt_lyr, cat_lyr
+   with RunStage('DissolveCatchments', out_CatchArea + '_full') as stage:
+      arcpy.Dissolve_management(out_CatchArea + '_full', out_CatchArea, dissolve_field=ptid_join)
+      stage['out'] = out_CatchArea
+
+   # get catchments for points without networks, from the catchment bounding box index (no selections or joins)
+   assoc = set([int(f[0]) for f in arcpy.da.SearchCursor(in_Lines, ptid_join)])
+   pts = [a for a in arcpy.da.SearchCursor(in_Points, [ptid_join, 'SHAPE@XY'], spatial_reference=sr)
+          if a[0] is not None and int(a[0]) not in assoc]
+
+   if len(pts) > 0:
+      printMsg('Adding catchments for ' + str(len(pts)) + ' points without networks...')
+      with RunStage('PointCatchments', pts) as stage:
+         hits = PointsInPolygons(in_Catchment, [a[1] for a in pts], [catID])
+         with arcpy.da.InsertCursor(out_CatchArea, ['SHAPE@', ptid_join]) as cur1:
+            with arcpy.da.InsertCursor(out_CatchArea + '_full', ['SHAPE@', ptid_join, catID]) as cur2:
+               for h in hits:
+                  cur1.insertRow([h[2], int(pts[h[0]][0])])
+                  cur2.insertRow([h[2], int(pts[h[0]][0]), h[3]])
+         stage['out'] = hits
 
    return out_CatchArea
 
 
 def GetSubCatchments_hw(in_Lines, in_CatchArea, out_subCatch,
-                        ptid_join="OBJECTID_in_Points", catID="NHDPlusID", fdr_src='L:/David/GIS_data/NHDPlus_HR'):
+                        ptid_join="OBJECTID_in_Points", catID="NHDPlusID", fdr_src='L:/David/GIS_data/NHDPlus_HR',
+                        workers=1, native=False):
    """Internal function to generate the initial sub-catchment for each upstream network. Uses Watershed within the
    initial catchment, and then converts to polygon.
 
@@ -221,6 +254,11 @@ def GetSubCatchments_hw(in_Lines, in_CatchArea, out_subCatch,
    out_subCatch = Output sub-catchments
    ptid_join = Unique integer ID for each network, inherited from original points (in_Points)
    fdr_src = Source directory for NHDPlusHR rasters (fdr rasters used to calculate Watersheds).
+   workers = Number of worker processes. If more than 1, HU4s (VPUs) are processed in parallel, each worker using its
+      own scratch geodatabase. Run from a standalone python (not the ArcGIS Pro python window) to use this.
+   native = Use the windowed D8 watershed labeller (WatershedRaster.WatershedsD8) instead of arcpy.sa.Watershed. It
+      reads the flow direction raster one catchment at a time, instead of the full HU4, and delineates nested
+      watersheds for all points in a catchment in one pass per HU4, instead of one pass per seqID.
 
    Dependencies:
    - Catchment layer with unique IDs, matching unique ID in flowlines (e.g. NHDPlusID)
@@ -235,88 +273,63 @@ def GetSubCatchments_hw(in_Lines, in_CatchArea, out_subCatch,
    arcpy.env.extent = in_CatchArea
 
    # select the 'starting' flowline for each network, make a temporary FC
-   arcpy.Select_analysis(in_Lines, out_scratch + 'flow', "FromCumul_Length = 0")
-   flow = out_scratch + 'flow'
-   # full catchments layer
-   cat = arcpy.MakeFeatureLayer_management(in_CatchArea)
-   # unique ID
-   uid = ptid_join
-
-   # Find cases of multiple points per catchment
-   arcpy.Statistics_analysis(flow, out_scratch + 'flowdup', [[catID, 'Count']], catID)
-   nids = [a for a in arcpy.da.SearchCursor(out_scratch + 'flowdup', [catID, 'COUNT_' + catID])]
-   dupnid = [int(a[0]) for a in nids if a[1] > 1]
-   seqs = list(range(1, max([a[1] for a in nids])+1))
-   # add attribute seqID. Corresponds to sequence in a unique catchment.
-   arcpy.AddField_management(flow, "seqID", "LONG")
-   seqd = {}
-   for d in dupnid:
-      seqd[d] = 0
-   with arcpy.da.UpdateCursor(flow, [catID, "seqID"]) as cursor:
-      for row in cursor:
-         c = int(row[0])
-         if c in dupnid:
-            seqd[c] = seqd[c] + 1
-            row[1] = seqd[c]
-         else:
-            row[1] = 1
-         cursor.updateRow(row)
-   # make query for pairwise selection of catchments
-   nid_oid = [[uid + " = " + str(a[0]), catID + " = " + str(int(a[1]))] for a in arcpy.da.SearchCursor(flow, [uid, catID])]
-   # NOTE: some OIDs do not get a reach, generally since they are at the 'bottom' (pour point) of the catchment already
-   query = '(' + ') OR ('.join([' AND '.join(b) for b in nid_oid]) + ')'
-   arcpy.SelectLayerByAttribute_management(cat, "NEW_SELECTION", query)
-   arcpy.Dissolve_management(cat, out_scratch + "subWatershed_mask", "VPUID")
-   sub = out_scratch + "subWatershed_mask"
-   vpu = [a[0] for a in arcpy.da.SearchCursor(sub, 'VPUID')]
-   catvpu = arcpy.MakeFeatureLayer_management(sub)
-
-   # Loop over VPUIDs/duplicate catchment runs
-   flow_lyr = arcpy.MakeFeatureLayer_management(flow)
-   ls_sub = []
-   for vpuid in vpu:
-      arcpy.env.extent = in_CatchArea
-      arcpy.SelectLayerByAttribute_management(catvpu, "NEW_SELECTION", "VPUID = '" + str(vpuid) + "'")
-      arcpy.CopyFeatures_management(catvpu, out_scratch + 'msk')
-
-      if vpuid.startswith('02'):
-         fdr = fdr_src + os.sep + "HRNHDPlusRasters" + vpuid + os.sep + 'hydrofix.gdb/fdr_sinkfix'
+   with RunStage('SubCatchmentSetup', in_Lines) as stage:
+      arcpy.Select_analysis(in_Lines, out_scratch + 'flow', "FromCumul_Length = 0")
+      flow = out_scratch + 'flow'
+      # unique ID
+      uid = ptid_join
+
+      # Find cases of multiple points per catchment
+      arcpy.Statistics_analysis(flow, out_scratch + 'flowdup', [[catID, 'Count']], catID)
+      nids = [a for a in arcpy.da.SearchCursor(out_scratch + 'flowdup', [catID, 'COUNT_' + catID])]
+      dupnid = [int(a[0]) for a in nids if a[1] > 1]
+      seqs = list(range(1, max([a[1] for a in nids])+1))
+      # add attribute seqID. Corresponds to sequence in a unique catchment.
+      arcpy.AddField_management(flow, "seqID", "LONG")
+      seqd = {}
+      for d in dupnid:
+         seqd[d] = 0
+      with arcpy.da.UpdateCursor(flow, [catID, "seqID"]) as cursor:
+         for row in cursor:
+            c = int(row[0])
+            if c in dupnid:
+               seqd[c] = seqd[c] + 1
+               row[1] = seqd[c]
+            else:
+               row[1] = 1
+            cursor.updateRow(row)
+      # pairwise selection of catchments
+      nid_oid = [a for a in arcpy.da.SearchCursor(flow, [uid, catID])]
+      # NOTE: some OIDs do not get a reach, generally since they are at the 'bottom' (pour point) of the catchment
+      # already
+      cat = CopyPairs(in_CatchArea, [uid, catID], nid_oid, out_scratch + "subWatershed_cat")
+      arcpy.Dissolve_management(cat, out_scratch + "subWatershed_mask", "VPUID")
+      sub = out_scratch + "subWatershed_mask"
+      vpu = [a[0] for a in arcpy.da.SearchCursor(sub, 'VPUID')]
+      stage['out'] = flow
+
+   # Loop over VPUIDs. Each VPU is independent, so these can run in a process pool. Worker processes do not inherit
+   # arcpy.env.workspace, so datasets are passed as full catalog paths, and each VPU writes to its own geodatabase.
+   with RunStage('Watersheds', flow) as stage:
+      ls_sub = []
+      args = [CatalogPath(a) for a in [flow, sub, cat, in_CatchArea]] + [uid, seqs, fdr_src]
+      if workers > 1 and len(vpu) > 1:
+         print('Getting subcatchments for ' + str(len(vpu)) + ' HU4s using ' + str(min(workers, len(vpu))) +
+               ' worker processes...')
+         with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(vpu))) as pool:
+            jobs = [pool.submit(SubCatchmentsVPU_hw, vpuid, *args, catID=catID, native=native) for vpuid in vpu]
+            for j in jobs:
+               ls_sub += j.result()
       else:
-         fdr = fdr_src + os.sep + "HRNHDPlusRasters" + vpuid + os.sep + 'fdr.tif'
-
-      # Loop over unique seqID. Flowlines in flow_lyr are selected by intersecting VPU, and then seqID
-      for s in seqs:
-         # set envs for each run
-         arcpy.env.snapRaster = fdr
-         arcpy.env.cellSize = fdr
-         arcpy.env.outputCoordinateSystem = fdr
-         arcpy.env.extent = out_scratch + 'msk'
-         arcpy.env.mask = out_scratch + 'msk'
-
-         # flowlines not necessary to select, since mask will filter them
-         arcpy.SelectLayerByLocation_management(flow_lyr, "INTERSECT", catvpu, selection_type="NEW_SELECTION")
-         arcpy.SelectLayerByAttribute_management(flow_lyr, "SUBSET_SELECTION", "seqID = " + str(s))
-         if str(arcpy.GetCount_management(flow_lyr)) == '0':
-            continue
-         print('Getting subcatchments for HU4 ' + vpuid + ', group ' + str(s) + '...')
-
-         # Watershed, convert to polygon. All are written to the out_scratch GDB
-         catsub = out_scratch + 'catSub_' + str(vpuid) + '_' + str(s)
-         arcpy.PolylineToRaster_conversion(flow_lyr, uid, out_scratch + 'pp_rast')
-         arcpy.sa.Watershed(fdr, out_scratch + 'pp_rast', "Value").save(out_scratch + 'wsrast')
-         arcpy.env.outputCoordinateSystem = in_CatchArea
-         if pyvers < 3:
-            arcpy.RasterToPolygon_conversion(out_scratch + 'wsrast', out_scratch + 'poly0', "NO_SIMPLIFY", "Value")
-            arcpy.Dissolve_management(out_scratch + 'poly0', out_scratch + 'poly0d', 'gridcode')  # Not Necessary in Pro.
-         else:
-            arcpy.RasterToPolygon_conversion(out_scratch + 'wsrast', out_scratch + 'poly0d', "NO_SIMPLIFY", "Value", "MULTIPLE_OUTER_PART")
-         arcpy.Identity_analysis(out_scratch + 'poly0d', cat, out_scratch + 'poly1')
-         arcpy.Select_analysis(out_scratch + 'poly1', catsub, 'gridcode = ' + uid)
-         ls_sub.append(catsub)
+         for vpuid in vpu:
+            ls_sub += SubCatchmentsVPU_hw(vpuid, *args, catID=catID, native=native)
+      stage['out'] = sum([CountRows(f) for f in ls_sub])
 
    # merge VPUID datasets
    arcpy.env.extent = None
-   arcpy.Merge_management(ls_sub, out_subCatch)
+   with RunStage('MergeSubCatchments', ls_sub) as stage:
+      arcpy.Merge_management(ls_sub, out_subCatch)
+      stage['out'] = out_subCatch
    # Reset env variables used in fn
    arcpy.env.outputCoordinateSystem = None
    arcpy.env.snapRaster = None
@@ -324,25 +337,91 @@ def GetSubCatchments_hw(in_Lines, in_CatchArea, out_subCatch,
    arcpy.env.mask = None
 
 
-def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
-                   in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None, snap_dist="50 Meters"):
-   """Loads point(s), solves the upstream service layer to get lines, grabs catchments intersecting lines.
-    Outputs are two feature classes (dissolved lines and catchments, one feature per input point).
-   Parameters:
-   - in_Points = Input feature class representing sample point(s) along network
-   - in_lyrUpTrace = Network Analyst service layer set up to run upstream
-   - in_hydroNet = Hydrological network used to build service layer. Must Contain NHDFlowline feature class
-   - out_Lines = Output lines representing upstream flow to a specified distance from point
-   - in_Catchment = Input catchment polygons layer, matching flowlines from in_hydroNet. Optional: if given, the
-      catchments for the network will be output, using the naming scheme `[out_Lines]_catchArea`.
+def SubCatchmentsVPU_hw(vpuid, flow, in_Mask, in_Cat, in_CatchArea, uid, seqs,
+                        fdr_src='L:/David/GIS_data/NHDPlus_HR', out_ws=None, catID="NHDPlusID", native=False):
+   """Internal function to generate sub-catchments for the pour points within one HU4 (VPU), used by
+   GetSubCatchments_hw. It can run in a worker process: if out_ws is not given, all outputs are written to a new
+   geodatabase for the VPU in the scratch folder, so that workers do not share a workspace. Datasets must be given as
+   full paths, since a worker process does not have the workspace of the parent process.
+
+   vpuid = VPUID (HU4) to process
+   flow = Starting flowlines for each network, with the seqID field
+   in_Mask = Selected catchments dissolved by VPUID
+   in_Cat = Selected catchments
+   in_CatchArea = Catchments associated with the networks (used for the output coordinate system)
+   uid = Unique integer ID for each network
+   seqs = List of seqID values
+   fdr_src = Source directory for NHDPlusHR rasters
+   out_ws = Workspace for outputs
+   catID = Catchment ID field
+   native = Use WatershedRaster.WatershedsD8 instead of arcpy.sa.Watershed
+
+   Returns a list of sub-catchment feature classes.
    """
-   out_scratch = arcpy.env.scratchGDB + os.sep
-   arcpy.CheckOutExtension("Network")
-   nhdFlow = os.path.dirname(in_hydroNet) + os.sep + 'NHDFlowline'
-   if not arcpy.Exists(nhdFlow):
-      return 'NHDFlowine file does not exist in network dataset `' + in_hydroNet + '`.'
+   arcpy.CheckOutExtension("Spatial")
+   if out_ws is None:
+      gdbName = 'subCat_' + str(vpuid) + '.gdb'
+      out_ws = arcpy.env.scratchFolder + os.sep + gdbName
+      if arcpy.Exists(out_ws):
+         arcpy.Delete_management(out_ws)
+      arcpy.CreateFileGDB_management(arcpy.env.scratchFolder, gdbName)
+   out_scratch = out_ws + os.sep
 
-   # get point field info
+   arcpy.env.extent = in_CatchArea
+   arcpy.Select_analysis(in_Mask, out_scratch + 'msk', "VPUID = '" + str(vpuid) + "'")
+   flow_lyr = arcpy.MakeFeatureLayer_management(flow)
+
+   if vpuid.startswith('02'):
+      fdr = fdr_src + os.sep + "HRNHDPlusRasters" + vpuid + os.sep + 'hydrofix.gdb/fdr_sinkfix'
+   else:
+      fdr = fdr_src + os.sep + "HRNHDPlusRasters" + vpuid + os.sep + 'fdr.tif'
+
+   if native:
+      # One pass for all pour lines in the VPU: pour lines sharing a catchment get nested watersheds, so the seqID
+      # runs are not needed.
+      arcpy.SelectLayerByLocation_management(flow_lyr, "INTERSECT", out_scratch + 'msk', selection_type="NEW_SELECTION")
+      print('Getting subcatchments for HU4 ' + vpuid + '...')
+      catsub = out_scratch + 'catSub_' + str(vpuid)
+      WatershedRaster.WatershedsD8(fdr, flow_lyr, in_Cat, catsub, uid, catID, nested=True)
+      return [catsub]
+
+   # Loop over unique seqID. Flowlines in flow_lyr are selected by intersecting VPU, and then seqID
+   ls_sub = []
+   for s in seqs:
+      # set envs for each run
+      arcpy.env.snapRaster = fdr
+      arcpy.env.cellSize = fdr
+      arcpy.env.outputCoordinateSystem = fdr
+      arcpy.env.extent = out_scratch + 'msk'
+      arcpy.env.mask = out_scratch + 'msk'
+
+      # flowlines not necessary to select, since mask will filter them
+      arcpy.SelectLayerByLocation_management(flow_lyr, "INTERSECT", out_scratch + 'msk', selection_type="NEW_SELECTION")
+      arcpy.SelectLayerByAttribute_management(flow_lyr, "SUBSET_SELECTION", "seqID = " + str(s))
+      if str(arcpy.GetCount_management(flow_lyr)) == '0':
+         continue
+      print('Getting subcatchments for HU4 ' + vpuid + ', group ' + str(s) + '...')
+
+      # Watershed, convert to polygon. All are written to the out_scratch GDB
+      catsub = out_scratch + 'catSub_' + str(vpuid) + '_' + str(s)
+      arcpy.PolylineToRaster_conversion(flow_lyr, uid, out_scratch + 'pp_rast')
+      arcpy.sa.Watershed(fdr, out_scratch + 'pp_rast', "Value").save(out_scratch + 'wsrast')
+      arcpy.env.outputCoordinateSystem = in_CatchArea
+      # one multipart polygon per gridcode, read from the watershed raster in row blocks (no dissolve needed)
+      WatershedRaster.VectorizeRaster(out_scratch + 'wsrast', out_scratch + 'poly0d', 'gridcode')
+      arcpy.Identity_analysis(out_scratch + 'poly0d', in_Cat, out_scratch + 'poly1')
+      arcpy.Select_analysis(out_scratch + 'poly1', catsub, 'gridcode = ' + uid)
+      ls_sub.append(catsub)
+
+   return ls_sub
+
+
+def GetPointID_hw(in_Points, in_Points_id=None):
+   """Internal function to get (or add) the unique integer ID field for points, used to join outputs back to points.
+   in_Points = Input points
+   in_Points_id = Unique integer ID field in in_Points. If not given, a field `[OID]_in_Points` is used (or added),
+      holding the points' ObjectIDs.
+   """
    if not in_Points_id:
       ptid = str([f.name for f in arcpy.Describe(in_Points).Fields if f.type == 'OID'][0])
       ptid_join = ptid + '_in_Points'
@@ -357,12 +436,62 @@ def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
       ptid_type = [a.type for a in arcpy.ListFields(in_Points) if a.name == ptid][0]
       if ptid_type not in ['OID', 'Integer', 'Double']:
          raise ValueError('`' + ptid + '` is not a numeric field type, choose another field or leave empty.')
-         return
       ptidu = [int(a[0]) for a in arcpy.da.SearchCursor(in_Points, ptid)]
       if not len(set(ptidu)) == len(ptidu):
          raise ValueError('`' + ptid + '` contains non-unique integers, choose another field or leave empty.')
-         return
       ptid_join = ptid
+   return ptid_join
+
+
+def CopyPoints_hw(in_Points, out_Points, where_clause=None):
+   """Internal function to copy points (or a subset of them) with their ObjectIDs in a field `[OID]_in_Points` of the
+   copy, so that point IDs stay the same between runs without adding a field to the source points. Returns the ID
+   field name, which is used by GetPointID_hw for the copy.
+   in_Points = Source points
+   out_Points = Output points
+   where_clause = Query for the points to copy (optional)
+   """
+   desc = arcpy.Describe(in_Points)
+   ptid_join = desc.OIDFieldName + '_in_Points'
+   if arcpy.Exists(out_Points):
+      arcpy.Delete_management(out_Points)
+   ws, nm = SplitPath(out_Points)
+   arcpy.CreateFeatureclass_management(ws, nm, desc.shapeType.upper(), in_Points, "SAME_AS_TEMPLATE",
+                                       "SAME_AS_TEMPLATE", desc.spatialReference)
+   if ptid_join not in [f.name for f in arcpy.ListFields(out_Points)]:
+      arcpy.AddField_management(out_Points, ptid_join, "LONG")
+   flds = [f.name for f in arcpy.ListFields(in_Points) if f.editable and f.name != ptid_join and
+           f.type not in ['OID', 'Geometry', 'GlobalID']]
+   with arcpy.da.SearchCursor(in_Points, ['OID@', 'SHAPE@'] + flds, where_clause) as sc:
+      with arcpy.da.InsertCursor(out_Points, [ptid_join, 'SHAPE@'] + flds) as ic:
+         for row in sc:
+            ic.insertRow(row)
+   return ptid_join
+
+
+def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
+                   in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None, snap_dist="50 Meters",
+                   out_ws=None):
+   """Loads point(s), solves the upstream service layer to get lines, grabs catchments intersecting lines.
+    Outputs are two feature classes (dissolved lines and catchments, one feature per input point).
+   Parameters:
+   - in_Points = Input feature class representing sample point(s) along network
+   - in_lyrUpTrace = Network Analyst service layer set up to run upstream
+   - in_hydroNet = Hydrological network used to build service layer. Must Contain NHDFlowline feature class
+   - out_Lines = Output lines representing upstream flow to a specified distance from point
+   - in_Catchment = Input catchment polygons layer, matching flowlines from in_hydroNet. Optional: if given, the
+      catchments for the network will be output, using the naming scheme `[out_Lines]_catchArea`.
+   - out_ws = Workspace for intermediate outputs. Default is the scratch geodatabase. Runs in separate processes
+      (see GetNetworksBatched_hw) each need their own.
+   """
+   out_scratch = (out_ws or arcpy.env.scratchGDB) + os.sep
+   arcpy.CheckOutExtension("Network")
+   nhdFlow = os.path.dirname(in_hydroNet) + os.sep + 'NHDFlowline'
+   if not arcpy.Exists(nhdFlow):
+      return 'NHDFlowine file does not exist in network dataset `' + in_hydroNet + '`.'
+
+   # get point field info
+   ptid_join = GetPointID_hw(in_Points, in_Points_id)
    # timestamp
    t0 = time.time()
 
@@ -378,29 +507,31 @@ def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
 
    # Load point(s) as facilities into service layer
    printMsg('Loading points into service layer...')
-   naPoints = arcpy.AddLocations_na(in_network_analysis_layer=in_upTrace,
-                                    sub_layer="Facilities",
-                                    in_table=in_Points,
-                                    field_mappings="Name " + ptid_join + " #",
-                                    search_tolerance=snap_dist,
-                                    sort_field=ptid_join,
-                                    search_criteria="NHDFlowline SHAPE;HydroNet_ND_Junctions NONE",
-                                    match_type="MATCH_TO_CLOSEST",
-                                    append="CLEAR",
-                                    snap_to_position_along_network="SNAP",
-                                    snap_offset="0 Meters",
-                                    exclude_restricted_elements="EXCLUDE",
-                                    search_query="NHDFlowline #;HydroNet_ND_Junctions #")
+   with RunStage('AddLocations', in_Points):
+      naPoints = arcpy.AddLocations_na(in_network_analysis_layer=in_upTrace,
+                                       sub_layer="Facilities",
+                                       in_table=in_Points,
+                                       field_mappings="Name " + ptid_join + " #",
+                                       search_tolerance=snap_dist,
+                                       sort_field=ptid_join,
+                                       search_criteria="NHDFlowline SHAPE;HydroNet_ND_Junctions NONE",
+                                       match_type="MATCH_TO_CLOSEST",
+                                       append="CLEAR",
+                                       snap_to_position_along_network="SNAP",
+                                       snap_offset="0 Meters",
+                                       exclude_restricted_elements="EXCLUDE",
+                                       search_query="NHDFlowline #;HydroNet_ND_Junctions #")
    printMsg('Completed point loading.')
 
    del naPoints
 
    # Solve upstream service layer; save out lines and updated layer
    printMsg('Solving service layer...')
-   arcpy.Solve_na(in_network_analysis_layer=in_upTrace,
-                  ignore_invalids="SKIP",
-                  terminate_on_solve_error="TERMINATE",
-                  simplification_tolerance="")
+   with RunStage('Solve', in_Points):
+      arcpy.Solve_na(in_network_analysis_layer=in_upTrace,
+                     ignore_invalids="SKIP",
+                     terminate_on_solve_error="TERMINATE",
+                     simplification_tolerance="")
    if pyvers < 3:
       in_Lines = arcpy.mapping.ListLayers(in_upTrace, "Lines")[0]
       printMsg('Saving updated %s service layer to %s...' % (in_upTrace, in_lyrUpTrace))
@@ -410,8 +541,10 @@ def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
       in_Lines = in_upTrace.listLayers("Lines")[0]
       in_upTrace.save()
    printMsg('Saving out lines...')
-   arcpy.CopyFeatures_management(in_Lines, upLines)
-   arcpy.RepairGeometry_management(upLines, "DELETE_NULL")
+   with RunStage('CopyLines') as stage:
+      arcpy.CopyFeatures_management(in_Lines, upLines)
+      arcpy.RepairGeometry_management(upLines, "DELETE_NULL")
+      stage['out'] = upLines
 
    # Add ID field from original points to facilities
    if pyvers < 3:
@@ -425,19 +558,28 @@ def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
    # output lines datasets, with original points ID attached
    # Note: Facility ID in Lines == ObjectID in Facilities. The join adds the unique point ID field to Lines.
    printMsg('Dissolving line networks...')
-   arcpy.JoinField_management(upLines, "FacilityID", joinPt, "ObjectID", ptid_join)
-
-   # first select lines from NHDFlowline to join. This makes the join faster.
-   oids = [str(int(a[0])) for a in arcpy.da.SearchCursor(upLines, "SourceOID")]
-   query = 'OBJECTID IN (' + ','.join(oids) + ')'
-   nhdFlow_lyr = arcpy.MakeFeatureLayer_management(nhdFlow, where_clause=query)
-   if in_Catchment:
-      # get catID, which will be used to join to catchments
-      arcpy.JoinField_management(upLines, "SourceOID", nhdFlow_lyr, "OBJECTID", catID)
+   with RunStage('JoinField', upLines):
+      arcpy.JoinField_management(upLines, "FacilityID", joinPt, "ObjectID", ptid_join)
+
+   # get catID, which will be used to join to catchments. Looked up from the flowline ID index (by SourceOID).
+   # This is added whether or not in_Catchment is given, so that batches can be merged and get catchments together
+   # (see GetNetworksBatched_hw), and the lines match those from TraceNetworks_hw.
+   with RunStage('LookupCatID', upLines):
+      flowIndex = MakeIdIndex(nhdFlow, catID)
+      arcpy.AddField_management(upLines, catID, "DOUBLE")
+      src = [a[0] for a in arcpy.da.SearchCursor(upLines, "SourceOID")]
+      keys = dict(zip(src, LookupKeys(flowIndex, src).tolist()))
+      with arcpy.da.UpdateCursor(upLines, ["SourceOID", catID]) as cursor:
+         for row in cursor:
+            row[1] = NullNaN(keys[row[0]])
+            cursor.updateRow(row)
 
    # output both un-dissolved and dissolved networks
-   arcpy.CopyFeatures_management(upLines, out_Lines + '_full')
-   arcpy.Dissolve_management(upLines, out_Lines, dissolve_field=ptid_join)
+   with RunStage('DissolveLines', upLines) as stage:
+      arcpy.CopyFeatures_management(upLines, out_Lines + '_full')
+      # segments share end points, so these are concatenated instead of a geometric Dissolve
+      DissolveLines(upLines, out_Lines, ptid_join)
+      stage['out'] = out_Lines
 
    # Get catchments, if in_Catchment is given
    if in_Catchment:
@@ -462,36 +604,495 @@ def GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines,
    return out_Lines
 
 
+def PartitionPoints_hw(in_Points, ptid_join, partition="HU4", in_Catchment=None, batchSize=None):
+   """Internal function to split points into batches for GetNetworksBatched_hw. Returns a list of [label, ptids].
+   in_Points = Input points
+   ptid_join = Unique integer ID field for points
+   partition = "HU4" to group points by the VPUID of the catchment they fall in (requires in_Catchment), or a tile
+      size in map units of in_Points, to group points by square tiles
+   in_Catchment = Catchments with a VPUID field
+   batchSize = Maximum number of points in a batch. Larger groups are split.
+   """
+   groups = {}
+   if partition == "HU4":
+      sr = arcpy.Describe(in_Catchment).spatialReference
+      pts = arcpy.da.FeatureClassToNumPyArray(in_Points, [ptid_join, 'SHAPE@X', 'SHAPE@Y'], spatial_reference=sr)
+      hu4 = {}
+      for h in PointsInPolygons(in_Catchment, np.column_stack([pts['SHAPE@X'], pts['SHAPE@Y']]), ['VPUID']):
+         hu4.setdefault(h[0], h[3])
+      for i, p in enumerate(pts[ptid_join].tolist()):
+         groups.setdefault(str(hu4.get(i, 'none')), []).append(int(p))
+   else:
+      size = float(partition)
+      pts = arcpy.da.FeatureClassToNumPyArray(in_Points, [ptid_join, 'SHAPE@X', 'SHAPE@Y'])
+      tx = np.floor(pts['SHAPE@X'] / size).astype(np.int64).tolist()
+      ty = np.floor(pts['SHAPE@Y'] / size).astype(np.int64).tolist()
+      for p, x, y in zip(pts[ptid_join].tolist(), tx, ty):
+         groups.setdefault(str(x) + '_' + str(y), []).append(int(p))
+   batches = []
+   for label in sorted(groups.keys()):
+      ids = groups[label]
+      n = batchSize or len(ids)
+      for i in range(0, len(ids), n):
+         batches.append([label, ids[i:i + n]])
+   return batches
+
+
+def NetworksBatch_hw(batch, in_Points, ptid_join, ptids, in_hydroNet, up_Dist, dams=False, snap_dist="50 Meters",
+                     catID="NHDPlusID"):
+   """Internal function to get networks for one batch of points, used by GetNetworksBatched_hw. It can run in a
+   worker process: the batch's points, service layer and outputs all go in a new geodatabase for the batch in the
+   scratch folder, so that batches do not share a workspace or network analysis layer. Errors are caught, so that
+   a failed solve only affects its own batch.
+
+   batch = Batch number
+   in_Points = Input points (full path: a worker process does not have the workspace of the parent process)
+   ptid_join = Unique integer ID field for points
+   ptids = Point IDs in the batch
+   in_hydroNet = Hydrological network (full path)
+   other parameters as in GetNetworksBatched_hw
+
+   Returns [batch, output lines, error message], where output lines is None if the batch failed.
+   """
+   try:
+      gdbName = 'netBatch_' + str(batch) + '.gdb'
+      out_ws = arcpy.env.scratchFolder + os.sep + gdbName
+      if arcpy.Exists(out_ws):
+         arcpy.Delete_management(out_ws)
+      arcpy.CreateFileGDB_management(arcpy.env.scratchFolder, gdbName)
+      arcpy.env.workspace = out_ws
+      out_scratch = out_ws + os.sep
+      pts = CopyPairs(in_Points, [ptid_join], [[p] for p in ptids], out_scratch + 'batchPoints')
+      lyr = MakeServiceLayer_hw(in_hydroNet, up_Dist, dams, 'naUpTrace_b' + str(batch), arcpy.env.scratchFolder)
+      GetNetworks_hw(pts, lyr, in_hydroNet, out_scratch + 'batchLines', None, catID, in_Points_id=ptid_join,
+                     snap_dist=snap_dist, out_ws=out_ws)
+      return [batch, out_scratch + 'batchLines', None]
+   except Exception as e:
+      return [batch, None, str(e)]
+
+
+def GetNetworksBatched_hw(in_Points, in_hydroNet, out_Lines, up_Dist,
+                          in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None,
+                          snap_dist="50 Meters", dams=False, partition="HU4", batchSize=None, workers=4):
+   """Batched version of GetNetworks_hw. Points are split into batches by HU4 or by tile, and each batch is solved
+   with its own service layer, in parallel worker processes. This keeps each solve (and its memory use) small, and a
+   solve error only loses the points in that batch: these are saved to `[in_Points]_failedBatches`, and the other
+   batches are merged into the outputs. Catchments are found once, for the merged lines. Outputs are the same as
+   GetNetworks_hw.
+   Parameters:
+   - in_Points = Input feature class representing sample point(s) along network
+   - in_hydroNet = Hydrological network. Must Contain NHDFlowline feature class
+   - out_Lines = Output lines representing upstream flow to a specified distance from point
+   - up_Dist = The distance (in map units) to traverse upstream from a point along the network
+   - in_Catchment = Input catchment polygons layer, matching flowlines from in_hydroNet (optional)
+   - dams = Whether dams should be barriers (see MakeServiceLayer_hw)
+   - partition = "HU4" to batch points by the HU4 (VPUID) of the catchment they fall in, or a tile size (in map units
+      of in_Points). HU4 requires in_Catchment.
+   - batchSize = Maximum number of points in a batch (default no limit)
+   - workers = Number of worker processes. Run from a standalone python (not the ArcGIS Pro python window) to use
+      more than 1.
+   - other parameters as in GetNetworks_hw
+   """
+   nhdFlow = os.path.dirname(CatalogPath(in_hydroNet)) + os.sep + 'NHDFlowline'
+   if not arcpy.Exists(nhdFlow):
+      return 'NHDFlowine file does not exist in network dataset `' + in_hydroNet + '`.'
+   if partition == "HU4" and not in_Catchment:
+      return 'Partitioning by HU4 requires in_Catchment.'
+   ptid_join = GetPointID_hw(in_Points, in_Points_id)
+   # timestamp
+   t0 = time.time()
+
+   with RunStage('PartitionPoints', in_Points) as stage:
+      batches = PartitionPoints_hw(in_Points, ptid_join, partition, in_Catchment, batchSize)
+      # build the flowline ID index here, so workers only load it
+      MakeIdIndex(nhdFlow, catID)
+      stage['out'] = len(batches)
+   printMsg('Getting networks for ' + str(len(batches)) + ' batches of points...')
+
+   with RunStage('Batches', in_Points) as stage:
+      res = []
+      # worker processes do not inherit arcpy.env.workspace, so inputs are passed as full catalog paths
+      pts_path, net_path = CatalogPath(in_Points), CatalogPath(in_hydroNet)
+      if workers > 1 and len(batches) > 1:
+         with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+            jobs = [pool.submit(NetworksBatch_hw, i, pts_path, ptid_join, b[1], net_path, up_Dist, dams,
+                                snap_dist, catID) for i, b in enumerate(batches)]
+            for j in jobs:
+               try:
+                  res.append(j.result())
+               except Exception as e:
+                  # the worker process itself failed
+                  res.append([jobs.index(j), None, str(e)])
+      else:
+         for i, b in enumerate(batches):
+            res.append(NetworksBatch_hw(i, pts_path, ptid_join, b[1], net_path, up_Dist, dams, snap_dist, catID))
+      stage['out'] = len([r for r in res if r[1]])
+
+   failed = [r for r in res if r[1] is None]
+   for r in failed:
+      printMsg('Batch ' + str(r[0]) + ' (' + batches[r[0]][0] + ', ' + str(len(batches[r[0]][1])) +
+               ' points) failed: ' + r[2])
+   if failed:
+      out_Failed = CatalogPath(os.path.basename(in_Points) + '_failedBatches')
+      CopyPairs(in_Points, [ptid_join], [[p] for r in failed for p in batches[r[0]][1]], out_Failed)
+      printMsg(str(len(failed)) + ' batches failed. Their points are saved to `' + out_Failed + '`.')
+   done = [r[1] for r in res if r[1]]
+   if len(done) == 0:
+      return 'All batches failed.'
+
+   # merge batches
+   printMsg('Merging ' + str(len(done)) + ' batches...')
+   with RunStage('MergeBatches', done) as stage:
+      arcpy.Merge_management(done, out_Lines)
+      arcpy.Merge_management([d + '_full' for d in done], out_Lines + '_full')
+      stage['out'] = out_Lines
+
+   # Get catchments, if in_Catchment is given
+   if in_Catchment:
+      GetCatchments_hw(out_Lines + '_full', in_Catchment, out_Lines + '_catchArea', in_Points, ptid_join, catID,
+                       get_SubCat=get_SubCat, workers=workers)
+
+   # timestamp
+   t1 = time.time()
+   ds = GetElapsedHours(t0, t1)
+   printMsg('Completed function. Time elapsed: %s' % ds)
+
+   return out_Lines
+
+
+def TraceNetworks_hw(in_Points, in_hydroNet, out_Lines, up_Dist,
+                     in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None, snap_dist=50,
+                     restrictions=None, dams=False, workers=1):
+   """Alternative to GetNetworks_hw which does not use Network Analyst. Points are snapped to NHDFlowline and traced
+   upstream in-process (see HydroGraph.py), for all points at once. Outputs are the same as GetNetworks_hw.
+   Parameters:
+   - in_Points = Input feature class representing sample point(s) along network
+   - in_hydroNet = Hydrological network. Must Contain NHDFlowline feature class
+   - out_Lines = Output lines representing upstream flow to a specified distance from point
+   - up_Dist = The distance (in meters) to traverse upstream from a point along the network
+   - in_Catchment = Input catchment polygons layer, matching flowlines from in_hydroNet. Optional: if given, the
+      catchments for the network will be output, using the naming scheme `[out_Lines]_catchArea`.
+   - snap_dist = Search distance (in meters) for snapping points to flowlines
+   - restrictions = Flowline restrictions (see HydroGraph.restrictDefs). Default is all restrictions, matching
+      MakeServiceLayer_hw.
+   - dams = Whether dams should be barriers. Unlike MakeServiceLayer_hw, this does not require a separate network
+      layer; dams are a bit in the flowline graph's barrier bitmask, switched on or off for each trace. Note that
+      dams are not handled exactly as the Network Analyst line barriers: the flowline is cut where the DamWeir line
+      intersects it (the most downstream crossing, see HydroGraph.SetDams), while Network Analyst locates the line
+      barriers on the network with its own search tolerance. Dams which touch but do not cross a flowline, or cross
+      it at a junction, can block in one and not the other, so networks near dams can differ between the two.
+   - workers = Number of worker processes for the upstream trace (see HydroGraph.TraceParallel) and sub-catchments
+      (see GetSubCatchments_hw)
+   """
+   TraceNetworkBands_hw(in_Points, in_hydroNet, [[up_Dist, out_Lines]], in_Catchment, catID, get_SubCat,
+                        in_Points_id, snap_dist, restrictions, dams, workers)
+   return out_Lines
+
+
+def TraceNetworkBands_hw(in_Points, in_hydroNet, bands,
+                         in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None, snap_dist=50,
+                         restrictions=None, dams=False, workers=1, out_Columnar=None):
+   """Traces upstream networks for multiple distances in a single pass. Each point's network is traversed once, to
+   the largest distance, and the lines for each distance band are cut from that traversal using the cumulative
+   distance along the network. Outputs for each band are the same as TraceNetworks_hw.
+   Parameters:
+   - in_Points = Input feature class representing sample point(s) along network
+   - in_hydroNet = Hydrological network. Must Contain NHDFlowline feature class
+   - bands = List of [up_Dist, out_Lines], giving the distance (in meters) and output lines for each band. Use an
+      up_Dist of None for the full upstream watershed, which is taken from the upstream index saved next to the
+      HydroNet geodatabase (see HydroGraph.MakeUpstreamIndex) instead of a trace.
+   - out_Columnar = Optional folder for columnar (parquet) copies of the outputs (see WriteColumnar_hw)
+   - other parameters as in TraceNetworks_hw
+   """
+   nhdFlow = os.path.dirname(in_hydroNet) + os.sep + 'NHDFlowline'
+   if not arcpy.Exists(nhdFlow):
+      return 'NHDFlowine file does not exist in network dataset `' + in_hydroNet + '`.'
+   ptid_join = GetPointID_hw(in_Points, in_Points_id)
+   # timestamp
+   t0 = time.time()
+
+   with RunStage('FlowGraph') as stage:
+      graph = MakeFlowGraph(nhdFlow, catID)
+      stage['out'] = len(graph['oid'])
+   barriers = BarrierMask(restrictions, dams)
+
+   # Snap points to flowlines
+   printMsg('Snapping points to flowlines...')
+   with RunStage('SnapPoints', in_Points) as stage:
+      pts = arcpy.da.FeatureClassToNumPyArray(in_Points, [ptid_join, 'SHAPE@X', 'SHAPE@Y'],
+                                              spatial_reference=graph['sr'])
+      edge, meas, dist = SnapPoints(graph, np.column_stack([pts['SHAPE@X'], pts['SHAPE@Y']]), snap_dist, barriers)
+      starts = [[int(p), e, m] for p, e, m in zip(pts[ptid_join], edge.tolist(), meas.tolist()) if e >= 0]
+      stage['out'] = starts
+   printMsg(str(len(starts)) + ' of ' + str(len(pts)) + ' points snapped to flowlines.')
+   if len(starts) < len(pts):
+      # report points beyond the snap distance, instead of silently leaving them without a network
+      out_noSnap = CatalogPath(os.path.basename(in_Points) + '_notSnapped')
+      CopyPairs(in_Points, [ptid_join], [[int(p)] for p in pts[ptid_join][edge < 0]], out_noSnap)
+      printMsg(str(len(pts) - len(starts)) + ' points are not within ' + str(snap_dist) +
+               ' meters of a flowline. These are saved to `' + out_noSnap + '`.')
+
+   # Trace once, to the largest distance
+   dists = [b[0] for b in bands if b[0] is not None]
+   if len(dists) > 0:
+      maxDist = max(dists)
+      printMsg('Tracing upstream networks to ' + str(maxDist) + ' meters...')
+      with RunStage('Trace', starts) as stage:
+         if workers > 1 and len(starts) > workers:
+            # workers attach to one memory-mapped copy of the graph, instead of each building their own
+            folder = PublishGraph(graph, arcpy.env.scratchFolder + os.sep + 'flowGraph')
+            pieces = TraceParallel(folder, starts, maxDist, barriers, workers)
+         else:
+            pieces = TraceUpstream(graph, starts, maxDist, barriers)
+         stage['out'] = len(pieces['pt'])
+
+   for up_Dist, out_Lines in bands:
+      # Output both un-dissolved and dissolved networks
+      with RunStage('WriteLines') as stage:
+         if up_Dist is None:
+            printMsg('Working on full watershed networks (`' + out_Lines + '`)...')
+            index = MakeUpstreamIndex(in_hydroNet, graph, barriers)
+            WriteTraceLines(graph, IndexTrace(index, graph, starts), out_Lines, ptid_join, catID)
+         else:
+            printMsg('Working on ' + str(up_Dist) + ' meter networks (`' + out_Lines + '`)...')
+            WriteTraceLines(graph, ClipTrace(pieces, up_Dist), out_Lines, ptid_join, catID)
+         stage['out'] = out_Lines
+
+      # Get catchments, if in_Catchment is given
+      if in_Catchment:
+         out_CatchArea = out_Lines + '_catchArea'
+         GetCatchments_hw(out_Lines + '_full', in_Catchment, out_CatchArea, in_Points, ptid_join, catID,
+                          get_SubCat=get_SubCat, workers=workers)
+
+      if out_Columnar:
+         WriteColumnar_hw([out_Lines, out_Lines + '_full', out_Lines + '_catchArea', out_Lines + '_catchArea_full'],
+                          out_Columnar)
+
+   if out_Columnar and in_Catchment and get_SubCat:
+      WriteColumnar_hw([os.path.basename(in_Points) + '_subCatchArea'], out_Columnar)
+
+   # timestamp
+   t1 = time.time()
+   ds = GetElapsedHours(t0, t1)
+   printMsg('Completed function. Time elapsed: %s' % ds)
+
+   return [b[1] for b in bands]
+
+
+def WatershedTotals_hw(in_Points, in_hydroNet, in_Catchment, fields, out_Table,
+                       catID="NHDPlusID", in_Points_id=None, snap_dist=50, restrictions=None, dams=False):
+   """Whole-watershed totals of catchment attributes for each point, without tracing, dissolving or zonal statistics.
+   Catchment attributes are accumulated upstream once for the whole network (see HydroGraph.MakeAccumulation; saved
+   next to the catchments and reused), so each point's totals are a lookup on the flowline it snaps to. These match
+   the sums over the `fullWs` catchments from TraceNetworkBands_hw, before sub-catchments (the catchment of the
+   point's flowline is counted in full).
+   Parameters:
+   - in_Points = Input feature class representing sample point(s) along network
+   - in_hydroNet = Hydrological network. Must Contain NHDFlowline feature class
+   - in_Catchment = Catchments, with the attributes to accumulate (e.g. from Helper_CatchmentMetrics.cat_join)
+   - fields = Numeric catchment fields to total (areas, lengths, counts, loads). For averages, total an area-weighted
+      field and divide by the total area.
+   - out_Table = Output table, with one row per snapped point: ptid_join, catID of the point's flowline, and a
+      `ws_[field]` field for each field
+   - other parameters as in TraceNetworks_hw
+   """
+   nhdFlow = os.path.dirname(in_hydroNet) + os.sep + 'NHDFlowline'
+   if not arcpy.Exists(nhdFlow):
+      return 'NHDFlowine file does not exist in network dataset `' + in_hydroNet + '`.'
+   ptid_join = GetPointID_hw(in_Points, in_Points_id)
+   t0 = time.time()
+
+   with RunStage('FlowGraph') as stage:
+      graph = MakeFlowGraph(nhdFlow, catID)
+      barriers = BarrierMask(restrictions, dams)
+      index = MakeUpstreamIndex(in_hydroNet, graph, barriers)
+      stage['out'] = len(graph['oid'])
+   with RunStage('Accumulate', in_Catchment):
+      acc = MakeAccumulation(in_Catchment, index, fields, catID)
+
+   printMsg('Snapping points to flowlines...')
+   with RunStage('SnapPoints', in_Points) as stage:
+      pts = arcpy.da.FeatureClassToNumPyArray(in_Points, [ptid_join, 'SHAPE@X', 'SHAPE@Y'],
+                                              spatial_reference=graph['sr'])
+      edge, meas, dist = SnapPoints(graph, np.column_stack([pts['SHAPE@X'], pts['SHAPE@Y']]), snap_dist, barriers)
+      starts = [[int(p), e, m] for p, e, m in zip(pts[ptid_join], edge.tolist(), meas.tolist()) if e >= 0]
+      stage['out'] = starts
+   printMsg(str(len(starts)) + ' of ' + str(len(pts)) + ' points snapped to flowlines.')
+
+   printMsg('Writing watershed totals to `' + out_Table + '`...')
+   with RunStage('WatershedTotals', starts) as stage:
+      totals = WatershedTotals(acc, graph, starts)
+      if arcpy.Exists(out_Table):
+         arcpy.Delete_management(out_Table)
+      arcpy.CreateTable_management(os.path.dirname(out_Table) or arcpy.env.workspace, os.path.basename(out_Table))
+      arcpy.AddField_management(out_Table, ptid_join, "LONG")
+      arcpy.AddField_management(out_Table, catID, "DOUBLE")
+      flds = ['ws_' + f for f in fields]
+      for f in flds:
+         arcpy.AddField_management(out_Table, f, "DOUBLE")
+      with arcpy.da.InsertCursor(out_Table, [ptid_join, catID] + flds) as cursor:
+         for s, tot in zip(starts, totals.tolist()):
+            cursor.insertRow([s[0], float(graph['nid'][s[1]])] + tot)
+      stage['out'] = out_Table
+
+   t1 = time.time()
+   ds = GetElapsedHours(t0, t1)
+   printMsg('Completed function. Time elapsed: %s' % ds)
+   return out_Table
+
+
+def WriteColumnar_hw(ls_fc, out_Columnar, rowGroup=10000):
+   """Writes columnar (GeoParquet-style) copies of output feature classes, one `[fc].parquet` file each, to a folder
+   (see ColumnarStore.py; requires pyarrow, and pyproj for the CRS). This is an export of the finished feature
+   classes, streamed from a cursor one row group at a time; the outputs are still made in the geodatabase first.
+   Feature classes which do not exist are skipped.
+   ls_fc = List of feature classes
+   out_Columnar = Output folder
+   rowGroup = Number of rows per row group
+   """
+   for fc in ls_fc:
+      if arcpy.Exists(fc):
+         ColumnarStore.FeaturesToColumnar(fc, out_Columnar + os.sep + os.path.basename(fc) + '.parquet',
+                                          rowGroup=rowGroup)
+   return out_Columnar
+
+
+def GetPointHashes_hw(in_Points, ptid_join, settings):
+   """Internal function to hash each point's geometry together with the trace settings, used to find new or moved
+   points in UpdateNetworkBands_hw. Returns a dictionary of ptid: hash (as strings).
+   in_Points = Input points
+   ptid_join = Unique integer ID field for points
+   settings = Dictionary of settings which affect the outputs (e.g. snap distance, barriers, network version)
+   """
+   key = json.dumps(settings, sort_keys=True)
+   hashes = {}
+   with arcpy.da.SearchCursor(in_Points, [ptid_join, "SHAPE@WKB"]) as cursor:
+      for row in cursor:
+         h = hashlib.sha1(key.encode('utf-8'))
+         h.update(bytes(row[1]))
+         hashes[str(int(row[0]))] = h.hexdigest()
+   return hashes
+
+
+def UpdateNetworkBands_hw(in_Points, in_hydroNet, bands,
+                          in_Catchment=None, catID="NHDPlusID", get_SubCat=True, in_Points_id=None, snap_dist=50,
+                          restrictions=None, dams=False, workers=1, manifest=None, out_Columnar=None):
+   """Incremental version of TraceNetworkBands_hw. A manifest saved with the outputs records a hash of each point's
+   geometry, the snap settings, barriers and network version. On later runs, only new or moved points are traced
+   (and get catchments), and their rows replace those in the existing outputs; rows for points which were removed
+   are deleted. If the manifest or any output does not exist, all points are processed.
+   Parameters:
+   - manifest = Manifest (JSON) file. Default is `[gdb]_manifest.json`, next to the workspace geodatabase.
+   - out_Columnar = Optional folder for columnar (parquet) copies of the updated outputs (see WriteColumnar_hw)
+   - other parameters as in TraceNetworkBands_hw. Use a point ID (in_Points_id) which is stable between runs.
+   """
+   nhdFlow = os.path.dirname(in_hydroNet) + os.sep + 'NHDFlowline'
+   ptid_join = GetPointID_hw(in_Points, in_Points_id)
+   if manifest is None:
+      manifest = os.path.splitext(GdbPath(in_Points))[0] + '_manifest.json'
+
+   settings = {'snap_dist': snap_dist, 'barriers': BarrierMask(restrictions, dams), 'catID': catID,
+               'get_SubCat': get_SubCat, 'network': NetworkVersion(nhdFlow),
+               'bands': [[b[0], b[1]] for b in bands], 'catchment': in_Catchment}
+   hashes = GetPointHashes_hw(in_Points, ptid_join, settings)
+
+   # Outputs which are updated, with the outputs of the run for changed points
+   outs = []
+   for up_Dist, out_Lines in bands:
+      sufs = ['', '_full']
+      if in_Catchment:
+         sufs += ['_catchArea', '_catchArea_full']
+      outs += [[out_Lines + f, out_Lines + '_delta' + f] for f in sufs]
+   if in_Catchment and get_SubCat:
+      outs.append([os.path.basename(in_Points) + '_subCatchArea', os.path.basename(in_Points) + '_delta_subCatchArea'])
+
+   old = {}
+   if os.path.exists(manifest) and all([arcpy.Exists(o[0]) for o in outs]):
+      with open(manifest) as f:
+         old = json.load(f)['points']
+   changed = [p for p in hashes.keys() if old.get(p) != hashes[p]]
+   removed = [p for p in old.keys() if p not in hashes]
+   printMsg(str(len(changed)) + ' new or moved points, ' + str(len(removed)) + ' removed points, ' +
+            str(len(hashes) - len(changed)) + ' points unchanged.')
+   if len(changed) + len(removed) == 0:
+      return [b[1] for b in bands]
+
+   # Trace changed points, to `_delta` outputs
+   if len(changed) > 0:
+      delta = os.path.basename(in_Points) + '_delta'
+      CopyPairs(in_Points, [ptid_join], [[int(p)] for p in changed], delta)
+      for o in outs:
+         if arcpy.Exists(o[1]):
+            arcpy.Delete_management(o[1])
+      TraceNetworkBands_hw(delta, in_hydroNet, [[b[0], b[1] + '_delta'] for b in bands], in_Catchment, catID,
+                           get_SubCat, ptid_join, snap_dist, restrictions, dams, workers)
+
+   # Replace rows of changed/removed points in outputs
+   printMsg('Updating outputs...')
+   drop = [[int(p)] for p in changed + removed]
+   for out, out_delta in outs:
+      if not arcpy.Exists(out):
+         arcpy.CopyFeatures_management(out_delta, out)
+      else:
+         DeletePairs(out, [ptid_join], drop)
+         if arcpy.Exists(out_delta):
+            arcpy.Append_management(out_delta, out, "NO_TEST")
+      if arcpy.Exists(out_delta):
+         arcpy.Delete_management(out_delta)
+
+   with open(manifest, 'w') as f:
+      json.dump({'settings': settings, 'points': hashes}, f)
+   if out_Columnar:
+      WriteColumnar_hw([o[0] for o in outs], out_Columnar)
+   return [b[1] for b in bands]
+
+
 def main():
 
    # Set up variables
-   gdb = 'E:/git/HealthyWaters/inputs/watersheds/hw_watershed_nodams_' + DateStamp() + '.gdb'
-   arcpy.CreateFileGDB_management(os.path.dirname(gdb), os.path.basename(gdb))
+   dams = False  # whether to include dams as barriers or not
+   # whether to use the Network Analyst solve (GetNetworks_hw) instead of the in-process tracer, e.g. to cross-check
+   # results. Dams are handled differently by the two (see TraceNetworks_hw).
+   useNA = False
+   # The geodatabase is kept between runs, so that only new or moved points are processed (UpdateNetworkBands_hw).
+   # Delete it (or its manifest) to re-run all points. Network Analyst runs go to a new (dated) geodatabase each time,
+   # as all runs did before.
+   gdb = 'E:/git/HealthyWaters/inputs/watersheds/hw_watershed_' + ['nodams', 'dams'][dams] + \
+      ['', '_na_' + DateStamp()][useNA] + '.gdb'
+   if not arcpy.Exists(gdb):
+      arcpy.CreateFileGDB_management(os.path.dirname(gdb), os.path.basename(gdb))
    arcpy.env.workspace = gdb
 
    # Use original points, copy to geodatabase
-   # NOTE: process points as necessary in ArcGIS, then use query on 'lyr' for ones that should get watersheds
+   # NOTE: process points as necessary in ArcGIS, then use query for ones that should get watersheds
    in_Points0 = r'E:\git\HealthyWaters\HW_Reaches.gdb\Instar_Reaches_vertend2'
    in_Points = os.path.basename(in_Points0).replace('.shp', '')
-   lyr = arcpy.MakeFeatureLayer_management(in_Points0, where_clause="use_HW = 1")  # AND DATE_LOC_C IS NOT NULL")
-   arcpy.CopyFeatures_management(lyr, in_Points)
+   # point IDs come from the source OIDs (carried in the copy), so they are the same between runs
+   ptid = CopyPoints_hw(in_Points0, in_Points, "use_HW = 1")  # AND DATE_LOC_C IS NOT NULL")
 
    # Other datasets/settings
    # in_hydroNet = r'E:\git\HealthyWaters\inputs\watersheds\VA_HydroNet.gdb\HydroNet\HydroNet_ND'
    # in_Catchment = r'E:\git\HealthyWaters\inputs\watersheds\Proc_NHDPlus_HR.gdb\NHDPlusCatchment_Merge_valam'
    in_hydroNet = r'E:\projects\nhd_network\network_datasets\VA_HydroNetHR.gdb\HydroNet\HydroNet_ND'
    in_Catchment = r'E:\projects\nhd_network\network_datasets\VA_HydroNetHR.gdb\NHDPlusCatchment'
-   dams = False  # whether to include dams as barriers or not
 
    # distances to loop over, in KM
    kms = [[2, '2km'], [3, '3km'], [5, '5km'], [10, '10km'], [1000, 'fullWs']]
 
-   # loop over distances
-   for km in kms:
-      up_Dist = km[0] * 1000
-      out_Lines = 'hw_Flowline_' + km[1]
-      in_lyrUpTrace = MakeServiceLayer_hw(in_hydroNet, up_Dist, dams)
-      GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines, in_Catchment)
+   if useNA:
+      # Network Analyst version (one service layer per distance)
+      for km in kms:
+         up_Dist = km[0] * 1000
+         out_Lines = 'hw_Flowline_' + km[1]
+         in_lyrUpTrace = MakeServiceLayer_hw(in_hydroNet, up_Dist, dams)
+         GetNetworks_hw(in_Points, in_lyrUpTrace, in_hydroNet, out_Lines, in_Catchment, in_Points_id=ptid)
+   else:
+      # all distances from one trace. The full watershed ('fullWs') comes from the upstream index, so it is no
+      # longer limited to 1000 km of network upstream, as it is in the Network Analyst version (see README).
+      bands = [[None if km[1] == 'fullWs' else km[0] * 1000, 'hw_Flowline_' + km[1]] for km in kms]
+      UpdateNetworkBands_hw(in_Points, in_hydroNet, bands, in_Catchment, in_Points_id=ptid, dams=dams, workers=8)
+   # per-stage times, counts and memory, for comparing runs
+   WriteRunReport(os.path.splitext(gdb)[0] + '_runReport_' + DateStamp() + '.json')
 
 
 if __name__ == '__main__':
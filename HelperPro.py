@@ -2,7 +2,7 @@
 # HelperPro.py
 # Version: ArcPro / Python 3+
 # Creation Date: 2020-07-06
-# Last Edit: 2020-11-06
+# Last Edit: 2026-10-16
 # Creator:  Kirsten R. Hazler
 
 # Summary:
@@ -15,6 +15,11 @@ import os
 import sys
 import traceback
 import time
+import json
+import concurrent.futures
+import threading
+import numpy as np
+from contextlib import contextmanager
 from datetime import datetime as datetime 
 
 try:
@@ -27,6 +32,12 @@ except:
 from arcpy.sa import *
 arcpy.CheckOutExtension("Spatial")
 
+try:
+   from scipy.spatial import cKDTree
+except ImportError:
+   # only needed for IdwRaster
+   cKDTree = None
+
 # Set overwrite option so that existing data may be overwritten
 arcpy.env.overwriteOutput = True
 
@@ -34,6 +45,17 @@ arcpy.env.overwriteOutput = True
 print('Using python interpreter version: ' + str(sys.version))
 pyvers = sys.version_info.major
 
+# Meters per linear unit, for measurement strings such as "100 METERS"
+linearUnits = {'METERS': 1.0, 'METER': 1.0, 'KILOMETERS': 1000.0, 'FEET': 0.3048, 'FOOT': 0.3048,
+               'USSURVEYFEET': 1200.0 / 3937.0, 'MILES': 1609.344, 'YARDS': 0.9144}
+
+# Spatial references by dataset path, as [time stamp, spatial reference] (see DescribeSR)
+srCache = {}
+# Geographic transformations by (input, output) spatial reference key (see CompareSpatialRef)
+transCache = {}
+# KD-tree and values of the interpolation points in this process (see IdwInit)
+idwTree = {}
+
 
 def getScratchMsg(scratchGDB):
    """Prints message informing user of where scratch output will be written"""
@@ -174,6 +196,79 @@ def TabToDict(inTab, fldKey, fldValue):
    return codeDict
 
 
+def PairKeys(pairs, keyType=int):
+   """Converts an array/list of ID pairs (or longer tuples) to a set of tuples, used as a hashed composite-key
+   index. Values are cast with keyType, so that e.g. integer IDs stored as doubles match."""
+   return set([tuple([keyType(v) for v in p]) for p in pairs])
+
+
+def SelectPairs(in_Table, fields, pairs, keyType=int):
+   """Returns the ObjectIDs of rows whose values in fields match one of the pairs, e.g. (ptid, catID) pairs.
+   This replaces building `(a = 1 AND b = 2) OR (...)` queries, which are slow to parse and fail on large sets.
+   Parameters:
+   - in_Table = Input table or feature class
+   - fields = List of fields making up the composite key, e.g. [ptid_join, catID]
+   - pairs = Array or list of key values, one tuple per row to select, in the order of fields
+   """
+   keys = PairKeys(pairs, keyType)
+   oids = []
+   with arcpy.da.SearchCursor(in_Table, ['OID@'] + list(fields)) as cursor:
+      for row in cursor:
+         if None not in row and tuple([keyType(v) for v in row[1:]]) in keys:
+            oids.append(row[0])
+   return oids
+
+
+def DeletePairs(in_Table, fields, pairs, keyType=int):
+   """Deletes rows whose values in fields match one of the pairs (see SelectPairs). Returns the number of rows
+   deleted."""
+   keys = PairKeys(pairs, keyType)
+   count = 0
+   with arcpy.da.UpdateCursor(in_Table, list(fields)) as cursor:
+      for row in cursor:
+         if None not in row and tuple([keyType(v) for v in row]) in keys:
+            cursor.deleteRow()
+            count += 1
+   return count
+
+
+def CopyPairs(in_Table, fields, pairs, out_Table, keyType=int):
+   """Copies rows whose values in fields match one of the pairs (see SelectPairs) to a new feature class, with the
+   same fields as in_Table. A bare out_Table name is created in the current workspace."""
+   keys = PairKeys(pairs, keyType)
+   desc = arcpy.Describe(in_Table)
+   ws = os.path.dirname(out_Table)
+   if ws == '':
+      ws = arcpy.env.workspace
+   arcpy.CreateFeatureclass_management(ws, os.path.basename(out_Table), desc.shapeType.upper(), in_Table,
+                                       spatial_reference=desc.spatialReference)
+   flds = [f.name for f in arcpy.ListFields(in_Table) if f.type not in ['OID', 'Geometry'] and f.editable]
+   ix = [flds.index(f) for f in fields]
+   with arcpy.da.InsertCursor(out_Table, ['SHAPE@'] + flds) as ins:
+      with arcpy.da.SearchCursor(in_Table, ['SHAPE@'] + flds) as cursor:
+         for row in cursor:
+            k = [row[i + 1] for i in ix]
+            if None not in k and tuple([keyType(v) for v in k]) in keys:
+               ins.insertRow(row)
+   return out_Table
+
+
+def ReplacePairs(in_Table, fields, in_Replace, keyType=int):
+   """Replaces rows in in_Table with the rows of in_Replace, matching on the composite key in fields: rows in
+   in_Table with a key found in in_Replace are deleted, and all rows of in_Replace are inserted (fields with the
+   same name are copied). Returns the number of rows deleted."""
+   flds = [f.name for f in arcpy.ListFields(in_Replace) if f.type not in ['OID', 'Geometry'] and f.editable]
+   flds = [f.name for f in arcpy.ListFields(in_Table) if f.name in flds and f.editable]
+   rows = [row for row in arcpy.da.SearchCursor(in_Replace, ['SHAPE@'] + flds)]
+   ix = [flds.index(f) + 1 for f in fields]
+   count = DeletePairs(in_Table, fields, [[r[i] for i in ix] for r in rows if None not in [r[i] for i in ix]],
+                       keyType)
+   with arcpy.da.InsertCursor(in_Table, ['SHAPE@'] + flds) as ins:
+      for row in rows:
+         ins.insertRow(row)
+   return count
+
+
 def multiMeasure(meas, multi):
    """Given a measurement string such as "100 METERS" and a multiplier, multiplies the number by the specified
    multiplier, and returns a new measurement string along with its individual components """
@@ -221,13 +316,105 @@ def clearSelection(fc):
       arcpy.SelectLayerByAttribute_management(fc, "CLEAR_SELECTION")
 
 
-def Coalesce(inFeats, dilDist, outFeats, scratchGDB="in_memory"):
-   """If a positive number is entered for the dilation distance, features are expanded outward by the specified
-   distance, then shrunk back in by the same distance. This causes nearby features to coalesce. If a negative number
-   is entered for the dilation distance, features are first shrunk, then expanded. This eliminates narrow portions of
-   existing features, thereby simplifying them. It can also break narrow "bridges" between features that were
-   formerly coalesced. """
+def PartRings(part):
+   """Splits a polygon part (arcpy Array, with interior rings after null points) into a list of rings (lists of
+   Points). The first ring is the exterior ring."""
+   rings = [[]]
+   for p in part:
+      if p is None:
+         rings.append([])
+      else:
+         rings[-1].append(p)
+   return [r for r in rings if r]
+
 
+def RingsPolygon(rings, sr):
+   """Makes a polygon from a list of rings (lists of Points), as from PartRings."""
+   return arcpy.Polygon(arcpy.Array([arcpy.Array(r) for r in rings]), sr)
+
+
+def SplitParts(geoms):
+   """Explodes polygon geometries into single-part polygons (each keeping its interior rings), dropping empty
+   geometries. In-memory equivalent of CleanFeatures."""
+   out = []
+   for g in geoms:
+      if g is None or g.pointCount == 0:
+         continue
+      if g.partCount == 1:
+         out.append(g)
+         continue
+      for i in range(g.partCount):
+         out.append(RingsPolygon(PartRings(g.getPart(i)), g.spatialReference))
+   return out
+
+
+def UnionGeoms(geoms):
+   """Unions a list of geometries into one, pairwise in a balanced tree so each geometry is only merged into
+   log(n) intermediate results. Returns a list holding the union (or an empty list)."""
+   geoms = list(geoms)
+   while len(geoms) > 1:
+      geoms = [geoms[i].union(geoms[i + 1]) if i + 1 < len(geoms) else geoms[i] for i in range(0, len(geoms), 2)]
+   return geoms
+
+
+def BufferGeoms(geoms, meas, method="GEODESIC", dissolve=False):
+   """Buffers a list of geometries in memory, returning a list of geometries.
+   Parameters:
+   - geoms = List of arcpy geometries, with a spatial reference
+   - meas = Buffer distance, as a measurement string (e.g. "100 METERS") or a number in the units of the spatial
+      reference. Negative distances shrink polygons.
+   - method = "GEODESIC" (Buffer tool, with geometry lists in and out) or "PLANAR" (geometry buffer method; only for
+      projected inputs)
+   - dissolve = Whether to dissolve all buffers into one
+   """
+   if len(geoms) == 0:
+      return []
+   if method.upper() == "PLANAR":
+      sr = geoms[0].spatialReference
+      if type(meas) == str:
+         num, units, meas = multiMeasure(meas, 1)
+         dist = num * linearUnits[units.upper()] / sr.metersPerUnit
+      else:
+         dist = meas
+      out = [g.buffer(dist) for g in geoms]
+      out = [g for g in out if g is not None and g.pointCount > 0]
+      if dissolve:
+         out = UnionGeoms(out)
+      return out
+   return arcpy.Buffer_analysis(geoms, arcpy.Geometry(), meas, "FULL", "ROUND", ["NONE", "ALL"][dissolve], "",
+                                "GEODESIC")
+
+
+def EliminateHoles(geoms, minArea=None, percent=None, method="GEODESIC"):
+   """Removes interior rings (holes) from single-part polygons in memory, as EliminatePolygonPart with CONTAINED_ONLY.
+   Holes smaller than minArea (square meters), or smaller than percent of the polygon's exterior ring area, are
+   removed.
+   Parameters:
+   - geoms = List of single-part polygons (see SplitParts)
+   - method = Area method, "GEODESIC" or "PLANAR"
+   """
+   out = []
+   for g in geoms:
+      rings = PartRings(g.getPart(0))
+      if len(rings) == 1:
+         out.append(g)
+         continue
+      sr = g.spatialReference
+      areas = [abs(RingsPolygon([r], sr).getArea(method.upper(), "SQUAREMETERS")) for r in rings]
+      limit = 0
+      if minArea is not None:
+         limit = minArea
+      if percent is not None:
+         limit = max(limit, areas[0] * percent / 100.0)
+      keep = [rings[0]] + [r for r, a in zip(rings[1:], areas[1:]) if a >= limit]
+      out.append(g if len(keep) == len(rings) else RingsPolygon(keep, sr))
+   return out
+
+
+def CoalesceGeoms(geoms, dilDist, method="GEODESIC"):
+   """In-memory version of Coalesce, on a list of polygon geometries: buffer, dissolve, explode, hole elimination and
+   negative buffer are chained on geometry lists, without writing to a workspace. Returns a list of single-part
+   polygons. See Coalesce for parameters."""
    # If it's a string, parse dilation distance and get the negative
    if type(dilDist) == str:
       origDist, units, meas = multiMeasure(dilDist, 1)
@@ -235,54 +422,51 @@ def Coalesce(inFeats, dilDist, outFeats, scratchGDB="in_memory"):
    else:
       origDist = dilDist
       meas = dilDist
-      negDist = -1 * origDist
-      negMeas = negDist
+      negMeas = -1 * origDist
 
    # Parameter check
    if origDist == 0:
       arcpy.AddError("You need to enter a non-zero value for the dilation distance")
       raise arcpy.ExecuteError
 
-      # Set parameters. Dissolve parameter depends on dilation distance.
-   if origDist > 0:
-      dissolve1 = "ALL"
-      dissolve2 = "NONE"
-   else:
-      dissolve1 = "NONE"
-      dissolve2 = "ALL"
-
-   # Process: Buffer
-   Buff1 = scratchGDB + os.sep + "Buff1"
-   arcpy.Buffer_analysis(inFeats, Buff1, meas, "FULL", "ROUND", dissolve1, "", "GEODESIC")
-
-   # Process: Clean Features
-   Clean_Buff1 = scratchGDB + os.sep + "CleanBuff1"
-   CleanFeatures(Buff1, Clean_Buff1)
-
-   # Process:  Generalize Features
-   # This should prevent random processing failures on features with many vertices, and also speed processing in general
-   # arcpy.Generalize_edit(Clean_Buff1, "0.1 Meters")
-
+   # Buffer, dissolving if expanding, and explode
+   buff1 = SplitParts(BufferGeoms(geoms, meas, method, dissolve=origDist > 0))
    # Eliminate gaps
    # Added step due to weird behavior on some buffers
-   Clean_Buff1_ng = scratchGDB + os.sep + "Clean_Buff1_ng"
-   arcpy.EliminatePolygonPart_management(Clean_Buff1, Clean_Buff1_ng, "AREA", "900 SQUAREMETERS", "", "CONTAINED_ONLY")
+   buff1 = EliminateHoles(buff1, minArea=900, method=method)
+   # Negative buffer, dissolving if shrinking first, and explode to get final dilated features
+   return SplitParts(BufferGeoms(buff1, negMeas, method, dissolve=origDist < 0))
 
-   # Process: Buffer
-   Buff2 = scratchGDB + os.sep + "NegativeBuffer"
-   arcpy.Buffer_analysis(Clean_Buff1_ng, Buff2, negMeas, "FULL", "ROUND", dissolve2, "", "GEODESIC")
 
-   # Process: Clean Features to get final dilated features
-   CleanFeatures(Buff2, outFeats)
-
-   # Cleanup
-   if scratchGDB == "in_memory":
-      garbagePickup([Buff1, Clean_Buff1, Buff2])
+def Coalesce(inFeats, dilDist, outFeats, scratchGDB="in_memory", method="GEODESIC"):
+   """If a positive number is entered for the dilation distance, features are expanded outward by the specified
+   distance, then shrunk back in by the same distance. This causes nearby features to coalesce. If a negative number
+   is entered for the dilation distance, features are first shrunk, then expanded. This eliminates narrow portions of
+   existing features, thereby simplifying them. It can also break narrow "bridges" between features that were
+   formerly coalesced.
+   Geometries are processed in memory (CoalesceGeoms), and only outFeats is written. The method is the buffer
+   method: "GEODESIC", or "PLANAR", which is faster and can be used for projected inputs. scratchGDB is not used, and
+   is kept for existing calls. """
+   sr = arcpy.Describe(inFeats).spatialReference
+   geoms = [row[0] for row in arcpy.da.SearchCursor(inFeats, ["SHAPE@"]) if row[0] is not None]
+   out = CoalesceGeoms(geoms, dilDist, method)
+
+   # Write final dilated features
+   drive, path = os.path.splitdrive(outFeats)
+   path, filename = os.path.split(path)
+   arcpy.CreateFeatureclass_management(drive + path, filename, "POLYGON", spatial_reference=sr)
+   with arcpy.da.InsertCursor(outFeats, ["SHAPE@"]) as cursor:
+      for g in out:
+         cursor.insertRow([g])
 
    return outFeats
 
 
-def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti=8, scratchGDB="in_memory"):
+def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti=8, scratchGDB="in_memory", workers=1, method="GEODESIC"):
+   """Shrinkwraps features: nearby features are buffered together, and each resulting group is coalesced back down
+   to a smoothed outline around its features. Groups are processed independently (see ShrinkWrapGroup), in a
+   process pool of the given number of workers if more than 1. The method is the buffer method used to coalesce
+   groups ("GEODESIC" or "PLANAR"; see Coalesce)."""
    # Parse dilation distance, and increase it to get smoothing distance
    smthMulti = float(smthMulti)
    origDist, units, meas = multiMeasure(dilDist, 1)
@@ -345,47 +529,44 @@ def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti=8, scratchGDB="in_memory"):
    numWraps = (arcpy.GetCount_management(explFeats)).getOutput(0)
    arcpy.AddMessage('Shrinkwrapping: There are %s features after consolidation' % numWraps)
 
-   # Loop through the exploded buffer features
-   counter = 1
-   with arcpy.da.SearchCursor(explFeats, ["SHAPE@"]) as myFeats:
-      for Feat in myFeats:
-         arcpy.AddMessage('Working on shrink feature %s' % str(counter))
-         featSHP = Feat[0]
-         tmpFeat = scratchGDB + os.sep + "tmpFeat"
-         arcpy.CopyFeatures_management(featSHP, tmpFeat)
-         trashList.append(tmpFeat)
-
-         # Process:  Repair Geometry
-         arcpy.RepairGeometry_management(tmpFeat, "DELETE_NULL")
-
-         # Process:  Make Feature Layer
-         arcpy.MakeFeatureLayer_management(dissFeats, "dissFeatsLyr", "", "", "")
-         trashList.append("dissFeatsLyr")
-
-         # Process: Select Layer by Location (Get dissolved features within each exploded buffer feature)
-         arcpy.SelectLayerByLocation_management("dissFeatsLyr", "INTERSECT", tmpFeat, "", "NEW_SELECTION")
-
-         # Process:  Coalesce features (expand)
-         coalFeats = scratchGDB + os.sep + 'coalFeats'
-         Coalesce("dissFeatsLyr", smthMeas, coalFeats, scratchGDB)
-         # Increasing the dilation distance improves smoothing and reduces the "dumbbell" effect. However, it can also cause some wonkiness which needs to be corrected in the next steps.
-         trashList.append(coalFeats)
-
-         # Merge coalesced feature with original features, and coalesce again.
-         mergeFeats = scratchGDB + os.sep + 'mergeFeats'
-         arcpy.Merge_management([coalFeats, "dissFeatsLyr"], mergeFeats, "")
-         Coalesce(mergeFeats, "5 METERS", coalFeats, scratchGDB)
-
-         # Eliminate gaps
-         noGapFeats = scratchGDB + os.sep + "noGapFeats"
-         arcpy.EliminatePolygonPart_management(coalFeats, noGapFeats, "PERCENT", "", 99, "CONTAINED_ONLY")
-
-         # Process:  Append the final geometry to the ShrinkWrap feature class
-         arcpy.AddMessage("Appending feature...")
-         arcpy.Append_management(noGapFeats, outFeats, "NO_TEST", "", "")
+   # Group the dissolved features by the exploded buffer feature they fall in, with one spatial join, instead of
+   # selecting from the whole dissolved layer for each buffer feature
+   arcpy.AddField_management(explFeats, "wrapID", "LONG")
+   with arcpy.da.UpdateCursor(explFeats, ["OID@", "wrapID"]) as cursor:
+      for row in cursor:
+         row[1] = row[0]
+         cursor.updateRow(row)
+   joinFeats = scratchGDB + os.sep + "joinFeats"
+   arcpy.SpatialJoin_analysis(dissFeats, explFeats, joinFeats, "JOIN_ONE_TO_ONE", "KEEP_ALL", match_option="INTERSECT")
+   trashList.append(joinFeats)
+   groups = {}
+   with arcpy.da.SearchCursor(joinFeats, ["wrapID", "SHAPE@WKB"]) as cursor:
+      for row in cursor:
+         if row[0] is not None and row[1] is not None:
+            groups.setdefault(row[0], []).append(bytes(row[1]))
+   srWkt = arcpy.Describe(dissFeats).spatialReference.exportToString()
+
+   # Shrinkwrap each group. Groups are independent, so these can run in a process pool.
+   wraps = sorted(groups.keys())
+   results = []
+   if workers > 1 and len(wraps) > 1:
+      arcpy.AddMessage('Shrinkwrapping %s features using %s worker processes...' % (str(len(wraps)),
+                                                                                     str(min(workers, len(wraps)))))
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(wraps))) as pool:
+         jobs = [pool.submit(ShrinkWrapGroup, groups[w], smthMeas, srWkt, method) for w in wraps]
+         for j in jobs:
+            results += j.result()
+   else:
+      for counter, w in enumerate(wraps):
+         arcpy.AddMessage('Working on shrink feature %s' % str(counter + 1))
+         results += ShrinkWrapGroup(groups[w], smthMeas, srWkt, method)
 
-         counter += 1
-         del Feat
+   # Process:  Insert the final geometries to the ShrinkWrap feature class, in one cursor
+   arcpy.AddMessage("Inserting %s features..." % str(len(results)))
+   sr = arcpy.Describe(dissFeats).spatialReference
+   with arcpy.da.InsertCursor(outFeats, ["SHAPE@"]) as cursor:
+      for wkb in results:
+         cursor.insertRow([arcpy.FromWKB(wkb, sr)])
 
    # Cleanup
    if scratchGDB == "in_memory":
@@ -394,6 +575,26 @@ def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti=8, scratchGDB="in_memory"):
    return outFeats
 
 
+def ShrinkWrapGroup(wkbs, smthMeas, srWkt, method="GEODESIC"):
+   """Shrinkwraps one group of dissolved features (those within one exploded buffer feature), for ShrinkWrap. It can
+   run in a worker process: geometries are passed in and out as WKB, and all steps run on geometries in memory
+   (CoalesceGeoms). Returns a list of WKB geometries."""
+   sr = arcpy.SpatialReference()
+   sr.loadFromString(srWkt)
+   grp = [arcpy.FromWKB(w, sr) for w in wkbs]
+
+   # Coalesce features (expand)
+   # Increasing the dilation distance improves smoothing and reduces the "dumbbell" effect. However, it can also cause some wonkiness which needs to be corrected in the next steps.
+   coal = CoalesceGeoms(grp, smthMeas, method)
+
+   # Merge coalesced feature with original features, and coalesce again.
+   coal = CoalesceGeoms(coal + grp, "5 METERS", method)
+
+   # Eliminate gaps
+   out = EliminateHoles(coal, percent=99, method=method)
+   return [bytes(g.WKB) for g in out]
+
+
 def DateStamp():
    return time.strftime('%Y%m%d')
 
@@ -413,6 +614,104 @@ def GetElapsedTime (t0, t1):
    deltaString = '%s days, %s hours, %s minutes, %s seconds' % (str(d), str(h), str(m), str(s))
    return deltaString
    
+# Stages recorded with RunStage, for WriteRunReport
+runStages = []
+
+
+def MemoryUse():
+   """Returns the memory use (resident set size, in MB) of this process and its child processes (e.g. worker
+   pools), or None if psutil is not installed."""
+   try:
+      import psutil
+   except ImportError:
+      return None
+   proc = psutil.Process()
+   rss = proc.memory_info().rss
+   for child in proc.children(recursive=True):
+      try:
+         rss += child.memory_info().rss
+      except psutil.Error:
+         # the child exited while sampling
+         pass
+   return round(rss / 1048576.0, 1)
+
+
+def SampleMemory(peak, stop, interval=0.25):
+   """Samples MemoryUse every interval (seconds) until stop (a threading.Event) is set, keeping the highest value in
+   peak[0]. Runs in a thread during a stage (see RunStage)."""
+   while True:
+      m = MemoryUse()
+      if m is not None and (peak[0] is None or m > peak[0]):
+         peak[0] = m
+      if stop.wait(interval):
+         return
+
+
+def CountRows(data):
+   """Row count for a stage report: the count of a table/feature class/layer, the length of a list, or an integer.
+   Returns None if data is None or does not exist."""
+   if data is None:
+      return None
+   if isinstance(data, int):
+      return data
+   if isinstance(data, (list, tuple, set, dict)):
+      return len(data)
+   try:
+      return int(arcpy.GetCount_management(data)[0])
+   except:
+      return None
+
+
+@contextmanager
+def RunStage(name, data_in=None):
+   """Records a named processing stage for the run report (see WriteRunReport): wall time, row counts in and out,
+   and memory use of this process and its worker processes (MB, needs psutil): at the start and end of the stage,
+   the peak sampled during the stage, and the peak increase over the start. Set stage['out'] inside the block to the
+   output dataset (or a count).
+   Usage:
+   with RunStage('Solve', in_Points) as stage:
+      ...
+      stage['out'] = out_Lines
+   """
+   stage = {'name': name, 'in': CountRows(data_in), 'out': None}
+   mem0 = MemoryUse()
+   peak = [mem0]
+   stop = threading.Event()
+   sampler = threading.Thread(target=SampleMemory, args=(peak, stop))
+   sampler.daemon = True
+   sampler.start()
+   t0 = time.time()
+   try:
+      yield stage
+   finally:
+      stage['seconds'] = round(time.time() - t0, 3)
+      stop.set()
+      sampler.join()
+      stage['out'] = CountRows(stage['out'])
+      stage['startMemMB'] = mem0
+      stage['memMB'] = MemoryUse()
+      if stage['memMB'] is not None and stage['memMB'] > peak[0]:
+         peak[0] = stage['memMB']
+      stage['peakMemMB'] = peak[0]
+      stage['peakDeltaMB'] = round(peak[0] - mem0, 1) if mem0 is not None else None
+      runStages.append(stage)
+
+
+def WriteRunReport(out_Json, reset=True):
+   """Writes the stages recorded with RunStage to a JSON run report, with the total time per stage name, so runs can
+   be compared by stage. Clears the recorded stages if reset is True."""
+   totals = {}
+   for s in runStages:
+      totals[s['name']] = round(totals.get(s['name'], 0) + s['seconds'], 3)
+   report = {'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'stages': runStages, 'totals': totals}
+   with open(out_Json, 'w') as f:
+      json.dump(report, f, indent=1)
+   printMsg('Run report written to ' + out_Json + '.')
+   if reset:
+      del runStages[:]
+   return out_Json
+
+
 def createFGDB(FGDB):
    '''Checks to see if specified file geodatabase exists, and creates it if not.
    Parameters:
@@ -430,9 +729,49 @@ def createFGDB(FGDB):
       print("%s created." %gdbName)
    return FGDB
 
+def DataStamp(in_Data):
+   """Returns a modification time stamp for a dataset path on disk, used to invalidate cached metadata (see
+   DescribeSR). For data in a geodatabase, this is the latest of the geodatabase folder and its `timestamps` file; for
+   files, the latest of the file and its .prj/.aux.xml. Returns None for anything else (layers, in_memory data,
+   relative names, raster objects), which are not cached."""
+   if not isinstance(in_Data, str) or not os.path.isabs(in_Data):
+      return None
+   path = in_Data
+   while not os.path.exists(path):
+      parent = os.path.dirname(path)
+      if parent == path:
+         return None
+      path = parent
+   if path != in_Data and not path.lower().endswith(('.gdb', '.sde')):
+      return None
+   files = [path, path + os.sep + 'timestamps', os.path.splitext(in_Data)[0] + '.prj', in_Data + '.aux.xml']
+   return max([os.stat(f).st_mtime_ns for f in files if os.path.exists(f)])
+
+
+def DescribeSR(in_Data):
+   """Returns the spatial reference of a dataset, from a process-wide cache (srCache) if the dataset has not been
+   modified since it was described."""
+   stamp = DataStamp(in_Data)
+   key = str(in_Data)
+   if stamp is not None and key in srCache and srCache[key][0] == stamp:
+      return srCache[key][1]
+   sr = arcpy.Describe(in_Data).spatialReference
+   if stamp is not None:
+      srCache[key] = [stamp, sr]
+   return sr
+
+
+def SRKey(sr):
+   """Key for a spatial reference: its factory code, or its WKT if it has none."""
+   return sr.factoryCode if sr.factoryCode else sr.exportToString()
+
+
 def CompareSpatialRef(in_Data, in_Template):
-   sr_In = arcpy.Describe(in_Data).spatialReference
-   sr_Out = arcpy.Describe(in_Template).spatialReference
+   """Compares the spatial references of two datasets. Returns (sr_In, sr_Out, reproject, transform, geoTrans).
+   Spatial references (DescribeSR) and geographic transformations (by pair of spatial references) are cached for
+   the session, so repeated checks on unchanged data do not Describe them or list transformations again."""
+   sr_In = DescribeSR(in_Data)
+   sr_Out = DescribeSR(in_Template)
    srFacCode_In = sr_In.factoryCode
    # print("Input factory code: %s"%srFacCode_In)
    srFacCode_Out = sr_Out.factoryCode
@@ -452,7 +791,10 @@ def CompareSpatialRef(in_Data, in_Template):
          transform = 0
          geoTrans = ""
       else:
-         transList = arcpy.ListTransformations(sr_In, sr_Out)
+         key = (SRKey(sr_In), SRKey(sr_Out))
+         if key not in transCache:
+            transCache[key] = arcpy.ListTransformations(sr_In, sr_Out)
+         transList = transCache[key]
          if len(transList) == 0:
             transform = 0
             geoTrans = ""
@@ -519,15 +861,190 @@ def ProjectToMatch_ras(in_Data, in_Template, out_Data, resampleType = "NEAREST",
       arcpy.ProjectRaster_management (in_Data, out_Data, sr_Out, resampleType, cellSize, geoTrans)
       return out_Data
  
-def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpShp = "NONE"):
+def ResampleBlock(src, x0, y1, csx, csy, xs, ys, resType="BILINEAR"):
+   """Resamples a block of a source raster (a numpy array, NaN for NoData) at output cell centers.
+   Parameters:
+   - src = Source array
+   - x0, y1 = Coordinates of the upper left corner of src
+   - csx, csy = Source cell size in x and y
+   - xs, ys = Output cell center coordinates for columns and rows (1-d arrays)
+   - resType = NEAREST or BILINEAR. For BILINEAR, NoData neighbours are left out and the weights of the others
+      rescaled, so NoData does not spread into cells with data.
+
+   Returns an array of shape (len(ys), len(xs)), NaN where there is no value.
+   """
+   nr, nc = src.shape
+   fc = (np.asarray(xs, dtype=np.float64) - x0) / csx - 0.5
+   fr = (y1 - np.asarray(ys, dtype=np.float64)) / csy - 0.5
+   if resType.upper() == "NEAREST":
+      c = np.clip(np.floor(fc + 0.5).astype(np.int64), 0, nc - 1)
+      r = np.clip(np.floor(fr + 0.5).astype(np.int64), 0, nr - 1)
+      return src[r[:, None], c[None, :]].astype(np.float64)
+   c0 = np.floor(fc).astype(np.int64)
+   r0 = np.floor(fr).astype(np.int64)
+   wc = fc - c0
+   wr = fr - r0
+   tot = np.zeros((len(fr), len(fc)))
+   wsum = np.zeros((len(fr), len(fc)))
+   for dr, w1 in [[0, 1 - wr], [1, wr]]:
+      r = np.clip(r0 + dr, 0, nr - 1)
+      for dc, w2 in [[0, 1 - wc], [1, wc]]:
+         c = np.clip(c0 + dc, 0, nc - 1)
+         v = src[r[:, None], c[None, :]]
+         w = w1[:, None] * w2[None, :]
+         ok = ~np.isnan(v)
+         tot += np.where(ok, v * w, 0.0)
+         wsum += np.where(ok, w, 0.0)
+   with np.errstate(invalid='ignore', divide='ignore'):
+      return np.where(wsum > 1e-12, tot / wsum, np.nan)
+
+
+def ReadBlock(in_Raster, xmin, ymin, ncols, nrows):
+   """Reads a block of a raster to a float array, with NaN for NoData and for cells outside the raster."""
+   ras = arcpy.Raster(in_Raster)
+   nd = ras.noDataValue
+   arr = arcpy.RasterToNumPyArray(ras, arcpy.Point(xmin, ymin), ncols, nrows,
+                                  nd if nd is not None else np.nan).astype(np.float64)
+   if nd is not None:
+      arr[arr == nd] = np.nan
+   return arr
+
+
+def ReadWindow(in_Raster, xmin, ymin, xmax, ymax):
+   """Reads the window of a raster covering an extent, with a one cell margin (see ReadBlock). Returns
+   (array, x0, y1, csx, csy), where x0, y1 is the upper left corner of the window."""
+   ras = arcpy.Raster(in_Raster)
+   csx = ras.meanCellWidth
+   csy = ras.meanCellHeight
+   ext = ras.extent
+   c0 = int(np.floor((xmin - ext.XMin) / csx)) - 1
+   c1 = int(np.ceil((xmax - ext.XMin) / csx)) + 1
+   r0 = int(np.floor((ymin - ext.YMin) / csy)) - 1
+   r1 = int(np.ceil((ymax - ext.YMin) / csy)) + 1
+   x0 = ext.XMin + c0 * csx
+   y0 = ext.YMin + r0 * csy
+   return ReadBlock(in_Raster, x0, y0, c1 - c0, r1 - r0), x0, y0 + (r1 - r0) * csy, csx, csy
+
+
+def TileCenters(tile):
+   """Cell center coordinates (xs for columns, ys for rows) of an output tile [xmin, ymin, ncols, nrows, cellSize]."""
+   xmin, ymin, nc, nr, cs = tile
+   return xmin + (np.arange(nc) + 0.5) * cs, ymin + nr * cs - (np.arange(nr) + 0.5) * cs
+
+
+def SnapMask(in_Snap, tile, nonZero=False):
+   """Returns a boolean array for an output tile, True where the snap raster has data (nearest snap cell), as the mask
+   environment. If nonZero is True, cells where the snap raster is 0 are also False, as in Con(in_Snap, ...)."""
+   xs, ys = TileCenters(tile)
+   win, x0, y1, csx, csy = ReadWindow(in_Snap, xs[0], ys[-1], xs[-1], ys[0])
+   val = ResampleBlock(win, x0, y1, csx, csy, xs, ys, "NEAREST")
+   if nonZero:
+      return ~np.isnan(val) & (val != 0)
+   return ~np.isnan(val)
+
+
+def GridTiles(x0, y0, c0, c1, r0, r1, cellSize, tileRows, tileCols):
+   """Splits columns c0 to c1 and rows r0 to r1 (counted from the lower left corner x0, y0) of a grid into output
+   tiles, as [xmin, ymin, ncols, nrows, cellSize]."""
+   tiles = []
+   for r in range(r0, r1, tileRows):
+      for c in range(c0, c1, tileCols):
+         tiles.append([x0 + c * cellSize, y0 + r * cellSize, min(tileCols, c1 - c), min(tileRows, r1 - r), cellSize])
+   return tiles
+
+
+# Raster pixel types (Raster.pixelType), as [MosaicToNewRaster pixel type, numpy type]. 1, 2 and 4 bit rasters are
+# written as 8 bit, so that there is room for a NoData value.
+pixelTypes = {"U1": ["8_BIT_UNSIGNED", "uint8"],
+              "U2": ["8_BIT_UNSIGNED", "uint8"],
+              "U4": ["8_BIT_UNSIGNED", "uint8"],
+              "U8": ["8_BIT_UNSIGNED", "uint8"],
+              "S8": ["8_BIT_SIGNED", "int8"],
+              "U16": ["16_BIT_UNSIGNED", "uint16"],
+              "S16": ["16_BIT_SIGNED", "int16"],
+              "U32": ["32_BIT_UNSIGNED", "uint32"],
+              "S32": ["32_BIT_SIGNED", "int32"],
+              "F32": ["32_BIT_FLOAT", "float32"],
+              "F64": ["64_BIT", "float64"]}
+
+
+def TileType(in_Raster):
+   """Returns [MosaicToNewRaster pixel type, numpy type, NoData value] for output tiles with the pixel type of a
+   raster. Integer rasters without a NoData value get the largest (unsigned) or smallest (signed) value of the type.
+   """
+   ras = arcpy.Raster(in_Raster)
+   pt, dt = pixelTypes.get(ras.pixelType, pixelTypes["F32"])
+   nd = ras.noDataValue
+   if nd is None:
+      if dt.startswith("float"):
+         nd = -3.4e38
+      else:
+         info = np.iinfo(dt)
+         nd = info.max if dt.startswith("u") else info.min
+   return [pt, dt, nd]
+
+
+def SaveTile(arr, tile, out_Tile, tileType=None):
+   """Saves an output tile array (NaN for NoData) as a raster, with the type and NoData value in tileType (see
+   TileType; default 32 bit float). Returns out_Tile, or None if the tile has no data (no raster is saved)."""
+   if np.all(np.isnan(arr)):
+      return None
+   pt, dt, nd = tileType or ["32_BIT_FLOAT", "float32", -3.4e38]
+   arcpy.NumPyArrayToRaster(np.where(np.isnan(arr), nd, arr).astype(dt), arcpy.Point(tile[0], tile[1]),
+                            tile[4], tile[4], nd).save(out_Tile)
+   return out_Tile
+
+
+def TilePaths(name, n):
+   """Paths for n output tiles, in a folder of the scratch folder."""
+   tileDir = arcpy.env.scratchFolder + os.sep + name
+   if not os.path.exists(tileDir):
+      os.makedirs(tileDir)
+   return [tileDir + os.sep + "tile_%s.tif" % str(i) for i in range(n)]
+
+
+def MosaicTiles(tiles, out_Raster, sr, cellSize, pixelType="32_BIT_FLOAT"):
+   """Mosaics output tiles (None for tiles with no data) to the output raster, and deletes the tiles."""
+   tiles = [t for t in tiles if t]
+   if len(tiles) == 0:
+      printErr("No output cells have data.")
+      return None
+   out_ws = os.path.dirname(out_Raster) or arcpy.env.workspace
+   arcpy.MosaicToNewRaster_management(tiles, out_ws, os.path.basename(out_Raster), sr, pixelType, cellSize, 1)
+   garbagePickup(tiles)
+   return out_Raster
+
+
+def DownscaleTile(in_Raster, in_Snap, tile, out_Tile, resType="BILINEAR", tileType=None):
+   """Resamples one output tile for Downscale_ras, reading only the source window the tile needs, and masking by the
+   snap raster. It can run in a worker process. Returns out_Tile, or None if the tile has no data.
+   Parameters:
+   - in_Raster = Source raster, in the spatial reference of in_Snap
+   - in_Snap = Snap raster (sets the output grid, and acts as mask: cells where it is NoData or 0 get NoData)
+   - tile = [xmin, ymin, ncols, nrows, cellSize] of the tile, on the snap raster grid
+   - out_Tile = Output tile raster
+   - tileType = Output pixel type and NoData value (see TileType). Default is 32 bit float.
+   """
+   xs, ys = TileCenters(tile)
+   win, x0, y1, csx, csy = ReadWindow(in_Raster, tile[0], tile[1], tile[0] + tile[2] * tile[4],
+                                      tile[1] + tile[3] * tile[4])
+   out = ResampleBlock(win, x0, y1, csx, csy, xs, ys, resType)
+   out[~SnapMask(in_Snap, tile, nonZero=True)] = np.nan
+   return SaveTile(out, tile, out_Tile, tileType)
+
+
+def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpShp = "NONE", tileSize = 4096, workers = 1):
    '''Converts a lower resolution raster to one of higher resolution to match the cell size and alignment of the specified snap raster.
+   For NEAREST and BILINEAR, the coarse raster is clipped and projected to the snap raster's coordinate system at its own resolution first. It is then resampled one output tile at a time (DownscaleTile), reading only the source window each tile needs, so no full-extent intermediate is made at the output resolution. Tiles are mosaicked to the output. CUBIC and MAJORITY are resampled with arcpy at the output cell size, without tiles.
    
    Parameters:
    - in_Raster: input raster to be resampled. Enter NONE if using input points instead.
-   - in_Snap: snap raster used to set output cell size and alignment; also acts as mask
+   - in_Snap: snap raster used to set output cell size and alignment; also acts as mask (cells where it is NoData or 0 get NoData)
    - out_Raster: output resampled raster
    - resType: raster resampling type (NEAREST, BILINEAR, CUBIC, or MAJORITY)
    - in_clpShp: input feature class used to clip the input raster. Enter NONE if no clipping is needed.
+   - tileSize: number of rows and columns in an output tile. Memory use is under 100 bytes per tile cell.
+   - workers: number of worker processes for tiles
    '''
    
    # Set environment variables        
@@ -535,11 +1052,13 @@ def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpSh
    arcpy.env.snapRaster = in_Snap
    arcpy.env.extent = in_Snap
    arcpy.env.mask = in_Snap
-   cellSize = arcpy.GetRasterProperties_management(in_Snap, "CELLSIZEX").getOutput(0)
+   snap = arcpy.Raster(in_Snap)
+   cellSize = snap.meanCellWidth
    scratchGDB = arcpy.env.scratchGDB
    
    if in_clpShp == "NONE":
       clpRast = in_Raster
+      ext = snap.extent
    else:
       clpRast = scratchGDB + os.sep + "clpRast"
       print("Getting extents of clip shape...")
@@ -551,24 +1070,147 @@ def Downscale_ras(in_Raster, in_Snap, out_Raster, resType = "BILINEAR", in_clpSh
       rect = "%s %s %s %s" %(xmin, ymin, xmax, ymax)
       print("Clipping raster...")
       arcpy.management.Clip(in_Raster, rect, clpRast, in_clpShp, "", "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+      ext = arcpy.Describe(in_clpShp).extent
+      if DescribeSR(in_clpShp).factoryCode != snap.spatialReference.factoryCode:
+         ext = ext.projectAs(snap.spatialReference)
    
-   resRast = scratchGDB + os.sep + "resRast"
-   tmpRast = ProjectToMatch_ras(clpRast, in_Snap, resRast, resType, cellSize)
+   if resType.upper() not in ["NEAREST", "BILINEAR"]:
+      # Not tiled: project/resample to the output cell size with arcpy
+      resRast = scratchGDB + os.sep + "resRast"
+      tmpRast = ProjectToMatch_ras(clpRast, in_Snap, resRast, resType, cellSize)
+      if tmpRast == clpRast:
+         # If no re-projection occurred...
+         print("Resampling...")
+         arcpy.management.Resample(clpRast, resRast, cellSize, resType)
+      print("Finalizing output and saving...")
+      finRast = Con(in_Snap, resRast)
+      finRast.save(out_Raster)
+      print("Mission complete.")
+      return
    
-   if tmpRast == clpRast:
-      # If no re-projection occurred...
-      print("Resampling...")
-      arcpy.management.Resample(clpRast, resRast, cellSize, resType)
+   # Project the coarse raster (at its own cell size), instead of projecting to the output cell size
+   prjRast = scratchGDB + os.sep + "prjRast"
+   srcRast = ProjectToMatch_ras(clpRast, in_Snap, prjRast, resType)
+
+   # Output tiles, on the snap raster grid, covering the snap raster (or clip shape) extent
+   sx = snap.extent.XMin
+   sy = snap.extent.YMin
+   c0 = max(0, int(np.floor((ext.XMin - sx) / cellSize)))
+   c1 = min(snap.width, int(np.ceil((ext.XMax - sx) / cellSize)))
+   r0 = max(0, int(np.floor((ext.YMin - sy) / cellSize)))
+   r1 = min(snap.height, int(np.ceil((ext.YMax - sy) / cellSize)))
+   tiles = GridTiles(sx, sy, c0, c1, r0, r1, cellSize, tileSize, tileSize)
+   outTiles = TilePaths("dsTiles", len(tiles))
+   # NEAREST keeps the pixel type of the source raster (as the arcpy path does); BILINEAR output is 32 bit float
+   tileType = TileType(srcRast) if resType.upper() == "NEAREST" else None
+
+   print("Resampling %s tiles..." % str(len(tiles)))
+   if workers > 1 and len(tiles) > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tiles))) as pool:
+         jobs = [pool.submit(DownscaleTile, srcRast, in_Snap, t, o, resType, tileType)
+                 for t, o in zip(tiles, outTiles)]
+         done = [j.result() for j in jobs]
    else:
-      pass
+      done = [DownscaleTile(srcRast, in_Snap, t, o, resType, tileType) for t, o in zip(tiles, outTiles)]
 
    print("Finalizing output and saving...")
-   finRast = Con(in_Snap, resRast)
-   finRast.save(out_Raster)
+   MosaicTiles(done, out_Raster, snap.spatialReference, cellSize, tileType[0] if tileType else "32_BIT_FLOAT")
 
    print("Mission complete.")
 
-def interpPoints(in_Points, valFld, in_Snap, out_Raster, in_clpShp = "NONE", interpType = "IDW", numPts = 9, maxDist = "", cellSize = ""):
+def IdwInit(pt_xy, vals):
+   """Builds the KD-tree over interpolation points, once per process (used as the process pool initializer in
+   IdwRaster)."""
+   idwTree['tree'] = cKDTree(np.asarray(pt_xy, dtype=np.float64))
+   idwTree['vals'] = np.asarray(vals, dtype=np.float64)
+
+
+def IdwBlock(tree, vals, xy, numPts=9, maxDist=None, power=2):
+   """Inverse distance weighted values at locations xy ([n, 2]), from the numPts nearest points within maxDist
+   (as RadiusVariable(numPts, maxDist)). Locations with no points within maxDist get NaN, and locations on a point
+   get its value.
+   Parameters:
+   - tree = cKDTree of the point coordinates
+   - vals = Point values
+   - power = Exponent of distance
+   """
+   k = min(numPts, len(vals))
+   d, i = tree.query(xy, k=k, distance_upper_bound=maxDist or np.inf)
+   d = d.reshape(len(xy), k)
+   i = i.reshape(len(xy), k)
+   ok = np.isfinite(d)
+   v = vals[np.minimum(i, len(vals) - 1)]
+   exact = ok & (d == 0)
+   w = np.where(ok & ~exact, 1.0 / np.where(ok & ~exact, d, 1.0) ** power, 0.0)
+   wsum = w.sum(axis=1)
+   with np.errstate(invalid='ignore', divide='ignore'):
+      out = np.where(wsum > 0, (w * v).sum(axis=1) / wsum, np.nan)
+      on = exact.any(axis=1)
+      out[on] = (np.where(exact, v, 0.0).sum(axis=1) / exact.sum(axis=1))[on]
+   return out
+
+
+def IdwTile(in_Snap, tile, out_Tile, numPts=9, maxDist=None, power=2, chunk=1000000):
+   """Interpolates one output tile for IdwRaster, using the KD-tree built by IdwInit. Only cells where the snap raster
+   has data are evaluated, in chunks of cells. It can run in a worker process. Returns out_Tile, or None
+   if the tile has no data."""
+   xs, ys = TileCenters(tile)
+   mask = SnapMask(in_Snap, tile)
+   out = np.full(mask.shape, np.nan)
+   cells = np.nonzero(mask.ravel())[0]
+   nc = len(xs)
+   for a in range(0, len(cells), chunk):
+      c = cells[a:a + chunk]
+      xy = np.column_stack([xs[c % nc], ys[c // nc]])
+      out.ravel()[c] = IdwBlock(idwTree['tree'], idwTree['vals'], xy, numPts, maxDist, power)
+   return SaveTile(out, tile, out_Tile)
+
+
+def IdwRaster(in_Points, valFld, in_Snap, out_Raster, cellSize="", numPts=9, maxDist="", power=2, tileSize=4096,
+              workers=1):
+   '''Inverse distance weighted interpolation of points to a raster, without arcpy.sa.Idw. A KD-tree is built over the points once (per process), and the numPts nearest points within maxDist are queried for blocks of output cells at a time. The output is made in square tiles (as in Downscale_ras), which are interpolated in parallel if workers is more than 1, and mosaicked to the output. Memory use per worker depends on the tile size, not the width of the raster.
+   Requires scipy.
+
+   Parameters:
+   - in_Points: input points, in the spatial reference of in_Snap
+   - valFld: the field in the input points used to determine output raster values
+   - in_Snap: snap raster used to set the output extent and alignment; also acts as mask
+   - out_Raster: output raster
+   - cellSize: cell size of the output raster. If not specified, same as in_Snap raster.
+   - numPts: number of nearest points used for each cell
+   - maxDist: maximum search distance (map units). Cells with no points within maxDist get NoData.
+   - power: exponent of distance
+   - tileSize: number of rows and columns in an output tile
+   - workers: number of worker processes
+   '''
+   if cKDTree is None:
+      printErr("scipy is required for IdwRaster.")
+      raise ImportError("scipy is required for IdwRaster.")
+   snap = arcpy.Raster(in_Snap)
+   cs = float(cellSize) if cellSize != "" else snap.meanCellWidth
+   maxDist = float(maxDist) if maxDist not in ["", None] else None
+   pts = arcpy.da.FeatureClassToNumPyArray(in_Points, ['SHAPE@X', 'SHAPE@Y', valFld], skip_nulls=True)
+   xy = np.column_stack([pts['SHAPE@X'], pts['SHAPE@Y']])
+   vals = pts[valFld]
+
+   ext = snap.extent
+   ncols = int(np.ceil((ext.XMax - ext.XMin) / cs))
+   nrows = int(np.ceil((ext.YMax - ext.YMin) / cs))
+   tiles = GridTiles(ext.XMin, ext.YMin, 0, ncols, 0, nrows, cs, tileSize, tileSize)
+   outTiles = TilePaths("idwTiles", len(tiles))
+   print("Interpolating %s points to %s tiles..." % (str(len(vals)), str(len(tiles))))
+   if workers > 1 and len(tiles) > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tiles)), initializer=IdwInit,
+                                                  initargs=(xy, vals)) as pool:
+         jobs = [pool.submit(IdwTile, in_Snap, t, o, numPts, maxDist, power) for t, o in zip(tiles, outTiles)]
+         done = [j.result() for j in jobs]
+   else:
+      IdwInit(xy, vals)
+      done = [IdwTile(in_Snap, t, o, numPts, maxDist, power) for t, o in zip(tiles, outTiles)]
+   return MosaicTiles(done, out_Raster, snap.spatialReference, cs)
+
+
+def interpPoints(in_Points, valFld, in_Snap, out_Raster, in_clpShp = "NONE", interpType = "IDW", numPts = 9, maxDist = "", cellSize = "", engine = "ARCPY", workers = 1):
    '''Converts a point dataset to a raster via specified interpolation method
    
    NOTES/LESSONS LEARNED: 
@@ -585,6 +1227,8 @@ def interpPoints(in_Points, valFld, in_Snap, out_Raster, in_clpShp = "NONE", int
    - numPts: number of points used for interpolation. Ignored if TREND2 interpolation.
    - maxDist: maximum search radius for interpolation. Ignored if SPLINE or TREND2 interpolation.
    - cellSize: cell size of the output raster. If not specified, same as in_Snap raster.
+   - engine: IDW engine. ARCPY (default) uses Idw. KDTREE uses IdwRaster (requires scipy), which evaluates the same nearest-point weighting in tiles and can run in parallel, but its output can differ slightly from Idw.
+   - workers: number of worker processes for IDW with the KDTREE engine (see IdwRaster)
    '''
    
    # timestamp
@@ -620,6 +1264,13 @@ def interpPoints(in_Points, valFld, in_Snap, out_Raster, in_clpShp = "NONE", int
    if interpType == "IDW":
       # This is not as smooth as I'd like, but output makes more sense than spline for PMP points
       print("Interpolating points using inverse weighted squared distance...")
+      if engine.upper() == "KDTREE":
+         # KD-tree IDW in tiles, written directly to out_Raster
+         IdwRaster(tmpPts, valFld, in_Snap, out_Raster, cellSize, numPts, maxDist, 2, workers=workers)
+         t1 = datetime.now()
+         ds = GetElapsedTime (t0, t1)
+         print("Completed interpolation function. Time elapsed: %s" % ds)
+         return
       radius = RadiusVariable(numPts, maxDist)
       finRast = Idw(tmpPts, valFld, cellSize, 2, radius)
    elif interpType == "SPLINE":
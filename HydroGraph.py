@@ -0,0 +1,1285 @@
+# ----------------------------------------------------------------------------------------
+# HydroGraph.py
+# Version: ArcPro / Python 3+
+# Creation Date: 2026-10-16
+# Last Edit: 2026-10-16
+
+# Summary:
+# In-process upstream tracing over NHDFlowline, used as an alternative to the Network Analyst service area solve in
+# HealthyWaters.GetNetworks_hw. The flowline network is held as a compact graph (a dictionary of numpy arrays):
+# - one entry per flowline ("edge"): OBJECTID, NHDPlusID, from/to node, length, barrier bitmask, dam position
+# - an upstream adjacency in CSR form: for node n, the edges flowing into n are up_edge[up_ptr[n]:up_ptr[n+1]]
+# - flowline vertices in CSR form: for edge e, the vertices are xy[vtx_ptr[e]:vtx_ptr[e+1]], with the distance of
+#   each vertex from the start of the line in mdist.
+
+# Usage Tips:
+# Nodes are built from coincident flowline end points, and flowlines are assumed to be digitized in the direction of
+# flow (as they are in NHD), which is what the FlowUpOnly restriction in the HydroNet relies on as well.
+
+# The graph and trace functions only need numpy. arcpy is needed to read flowlines/points and write outputs.
+
+# Restrictions and dams are stored as bits of a per-flowline barrier bitmask (see barrierBits), so the graph is
+# built once and the barriers used are chosen for each trace (BarrierMask), e.g. to run with and without dams.
+
+# Syntax:
+# graph = MakeFlowGraph(in_Flowlines)
+# barriers = BarrierMask(dams=True)
+# snap = SnapPoints(graph, pt_xy, snap_dist=50, barriers=barriers)
+# OR reusing a segment grid index for several point batches
+# grid = BuildSegmentGrid(graph, 50, barriers)
+# snap = SnapPoints(graph, pt_xy, snap_dist=50, barriers=barriers, grid=grid)
+# pieces = TraceUpstream(graph, starts, up_Dist=5000, barriers=barriers)
+# pieces2km = ClipTrace(pieces, up_Dist=2000)
+# OR in worker processes, attached to one memory-mapped copy of the graph
+# pieces = TraceParallel(PublishGraph(graph, folder), starts, up_Dist=5000, barriers=barriers, workers=16)
+#
+# Full upstream networks from the (saved) upstream index
+# index = MakeUpstreamIndex(in_hydroNet, graph, barriers)
+# piecesFull = IndexTrace(index, graph, starts)
+#
+# Whole-watershed totals of catchment attributes, accumulated upstream once (saved), then looked up for each point
+# acc = MakeAccumulation(in_Catchment, index, ["AreaSqKm"])
+# totals = WatershedTotals(acc, graph, starts)
+#
+# Fetch catchment rows by NHDPlusID, without SQL IN queries
+# catIndex = MakeIdIndex(in_Catchment, "NHDPlusID")
+# rows = FetchRows(in_Catchment, LookupIds(catIndex, nids)[0], ["NHDPlusID", "SHAPE@"])
+# WriteTraceLines(graph, pieces, out_Lines, ptid_join)
+#
+# Catchments containing points, from a saved bounding box index
+# hits = PointsInPolygons(in_Catchment, pt_xy, ["NHDPlusID"])
+# ----------------------------------------------------------------------------------------
+
+# Import modules
+import os
+import shutil
+import heapq
+import hashlib
+import concurrent.futures
+import numpy as np
+
+try:
+   import arcpy
+except ImportError:
+   # Graph building (from arrays), snapping and tracing are numpy-only.
+   arcpy = None
+
+# Restrictions defined in the HydroNet (see notes in HealthyWaters.py), as [field, value] of restricted flowlines
+restrictDefs = {"NoPipelines": ["FType", 428],
+                "NoUndergroundConduits": ["FType", 420],
+                "NoEphemeral": ["FCode", 46007],
+                "NoCoastline": ["FType", 566]}
+
+# Bits of the barrier bitmask. Dams (NHDLine DamWeir, FType 343) block the flowline at the dam.
+barrierBits = {"NoPipelines": 1,
+               "NoUndergroundConduits": 2,
+               "NoEphemeral": 4,
+               "NoCoastline": 8,
+               "Dams": 16}
+
+# Graphs already built in this session, by flowline path and spatial reference
+graphCache = {}
+
+# Graph attached in a worker process (see AttachWorker)
+workerGraph = {}
+
+
+def BarrierMask(restrictions=None, dams=False):
+   """Returns the barrier bitmask for a trace.
+   Parameters:
+   - restrictions = List of restriction names (keys of restrictDefs). Default is all restrictions, matching
+      MakeServiceLayer_hw.
+   - dams = Whether dams should be barriers
+   """
+   if restrictions is None:
+      restrictions = list(restrictDefs.keys())
+   mask = 0
+   for r in restrictions:
+      mask |= barrierBits[r]
+   if dams:
+      mask |= barrierBits["Dams"]
+   return mask
+
+
+def Blocked(graph, barriers=None):
+   """Returns two boolean arrays for the barrier bitmask: flowlines that cannot be traversed at all (restricted),
+   and flowlines which are blocked at a dam."""
+   if barriers is None:
+      barriers = BarrierMask()
+   bar = np.asarray(graph['barrier'])
+   blocked = (bar & (barriers & ~barrierBits["Dams"])) != 0
+   dam = (bar & (barriers & barrierBits["Dams"])) != 0
+   return blocked, dam
+
+
+def BuildFlowGraph(oid, nid, barrier, v_oid, v_xy, nodeTol=0.001):
+   """Builds the flowline graph from arrays.
+   Parameters:
+   - oid = OBJECTID of each flowline
+   - nid = NHDPlusID of each flowline
+   - barrier = Barrier bitmask for each flowline (see barrierBits)
+   - v_oid = OBJECTID for each flowline vertex, with vertices in digitized order within each flowline
+   - v_xy = Coordinates of each vertex (n x 2)
+   - nodeTol = Tolerance (map units) used to match end points of flowlines into nodes
+   """
+   oid = np.asarray(oid, dtype=np.int64)
+   v_oid = np.asarray(v_oid, dtype=np.int64)
+   v_xy = np.asarray(v_xy, dtype=np.float64)
+
+   # Sort edges by OBJECTID, and vertices by OBJECTID keeping digitized order
+   eo = np.argsort(oid, kind='mergesort')
+   oid = oid[eo]
+   nid = np.asarray(nid)[eo]
+   barrier = np.asarray(barrier, dtype=np.uint8)[eo]
+   vo = np.argsort(v_oid, kind='mergesort')
+   v_oid = v_oid[vo]
+   v_xy = v_xy[vo]
+
+   # Vertex CSR. Flowlines with less than two vertices are dropped.
+   lo = np.searchsorted(v_oid, oid, 'left')
+   hi = np.searchsorted(v_oid, oid, 'right')
+   ok = (hi - lo) >= 2
+   oid, nid, barrier, lo, hi = oid[ok], nid[ok], barrier[ok], lo[ok], hi[ok]
+   cnt = hi - lo
+   vtx_ptr = np.concatenate([[0], np.cumsum(cnt)]).astype(np.int64)
+   take = np.repeat(lo - vtx_ptr[:-1], cnt) + np.arange(vtx_ptr[-1])
+   xy = v_xy[take]
+
+   # Distance of each vertex from the start of its line
+   seg = np.hypot(*np.diff(xy, axis=0).T)
+   seg = np.concatenate([[0.0], seg])
+   seg[vtx_ptr[:-1]] = 0.0
+   mdist = np.cumsum(seg)
+   mdist -= np.repeat(mdist[vtx_ptr[:-1]], cnt)
+   length = mdist[vtx_ptr[1:] - 1]
+
+   # Nodes from coincident end points
+   ends = np.vstack([xy[vtx_ptr[:-1]], xy[vtx_ptr[1:] - 1]])
+   keys = np.round(ends / nodeTol).astype(np.int64)
+   nodes, inv = np.unique(keys, axis=0, return_inverse=True)
+   inv = inv.ravel()
+   nEdge = len(oid)
+   from_node = inv[:nEdge]
+   to_node = inv[nEdge:]
+
+   # Upstream adjacency: edges grouped by the node they flow into
+   up_edge = np.argsort(to_node, kind='mergesort')
+   up_ptr = np.concatenate([[0], np.cumsum(np.bincount(to_node, minlength=len(nodes)))]).astype(np.int64)
+
+   graph = {'oid': oid, 'nid': nid, 'barrier': barrier, 'dam_pos': np.full(nEdge, np.nan), 'length': length,
+            'from_node': from_node, 'to_node': to_node, 'up_ptr': up_ptr, 'up_edge': up_edge,
+            'vtx_ptr': vtx_ptr, 'xy': xy, 'mdist': mdist}
+   return graph
+
+
+def SetDams(graph, d_oid, d_xy):
+   """Adds dams to the graph: sets the dam bit of the barrier bitmask, and the dam position (distance along the
+   flowline from its start) for each flowline crossed by a dam. Where a flowline has multiple dams, the most
+   downstream one is used.
+   Parameters:
+   - d_oid = OBJECTID of the flowline for each dam crossing
+   - d_xy = Coordinates of each dam crossing (n x 2)
+   """
+   d_xy = np.asarray(d_xy, dtype=np.float64).reshape(-1, 2)
+   e = np.searchsorted(graph['oid'], np.asarray(d_oid, dtype=np.int64))
+   ok = (e < len(graph['oid']))
+   ok[ok] = graph['oid'][e[ok]] == np.asarray(d_oid)[ok]
+   for i in np.where(ok)[0].tolist():
+      m = EdgeMeasure(graph, e[i], d_xy[i])
+      if not m <= graph['dam_pos'][e[i]]:
+         graph['dam_pos'][e[i]] = m
+      graph['barrier'][e[i]] |= barrierBits["Dams"]
+   return graph
+
+
+def EdgeMeasure(graph, e, xy):
+   """Distance along edge e (from its start) of the closest point on the edge to xy."""
+   a, b = graph['vtx_ptr'][e], graph['vtx_ptr'][e + 1]
+   v = graph['xy'][a:b]
+   m = graph['mdist'][a:b]
+   d, t = PointSegmentDistance(xy[0], xy[1], v[:-1], v[1:])
+   j = np.argmin(d)
+   return float(m[j] + t[j] * (m[j + 1] - m[j]))
+
+
+def NetworkVersion(in_Flowlines):
+   """Returns a version string for the network inputs: the flowlines (DataVersion, which includes the modification
+   time stamp, so attribute edits such as FType changes are seen) and the NHDLine feature class next to them (dams),
+   used to tell when saved outputs were made from a different network."""
+   ver = DataVersion(in_Flowlines)
+   nwLines = os.path.dirname(arcpy.Describe(in_Flowlines).catalogPath) + os.sep + "NHDLine"
+   if arcpy.Exists(nwLines):
+      ver += '|' + DataVersion(nwLines)
+   return ver
+
+
+def MakeFlowGraph(in_Flowlines, catID="NHDPlusID", sr=None, dams=True):
+   """Reads NHDFlowline and builds the flowline graph used for upstream tracing. All restrictions are stored in the
+   barrier bitmask; which ones apply is chosen when tracing.
+   Parameters:
+   - in_Flowlines = NHDFlowline feature class (e.g., VA_HydroNet.gdb/HydroNet/NHDFlowline)
+   - catID = Unique ID for each flowline, matching the catchments
+   - sr = Spatial reference used for the graph. Default is the spatial reference of in_Flowlines, or USA Contiguous
+      Albers (5070) if that is geographic, so that lengths are in meters.
+   - dams = Whether to add dams to the barrier bitmask, from DamWeir features (FType 343) in the NHDLine feature
+      class next to in_Flowlines
+   """
+   if sr is None:
+      sr = arcpy.Describe(in_Flowlines).spatialReference
+      if sr.type == 'Geographic':
+         sr = arcpy.SpatialReference(5070)
+   key = (arcpy.Describe(in_Flowlines).catalogPath, sr.factoryCode, dams)
+   if key in graphCache:
+      return graphCache[key]
+
+   print('Reading flowlines from `' + in_Flowlines + '`...')
+   flds = list(set([a[0] for a in restrictDefs.values()]))
+   att = arcpy.da.FeatureClassToNumPyArray(in_Flowlines, ['OID@', catID] + flds, null_value=-1)
+   barrier = np.zeros(len(att), dtype=np.uint8)
+   for r, (fld, val) in restrictDefs.items():
+      barrier[att[fld] == val] |= barrierBits[r]
+   vtx = arcpy.da.FeatureClassToNumPyArray(in_Flowlines, ['OID@', 'SHAPE@X', 'SHAPE@Y'], spatial_reference=sr,
+                                           explode_to_points=True)
+
+   print('Building flowline graph...')
+   graph = BuildFlowGraph(att['OID@'], att[catID], barrier, vtx['OID@'],
+                          np.column_stack([vtx['SHAPE@X'], vtx['SHAPE@Y']]))
+   graph['sr'] = sr
+
+   nwLines = os.path.dirname(arcpy.Describe(in_Flowlines).catalogPath) + os.sep + "NHDLine"
+   if dams and arcpy.Exists(nwLines):
+      print('Adding dam barriers to flowline graph...')
+      arcpy.MakeFeatureLayer_management(nwLines, "lyr_DamWeir", "FType = 343")
+      damPts = arcpy.env.scratchGDB + os.sep + 'damPts'
+      arcpy.Intersect_analysis([in_Flowlines, "lyr_DamWeir"], damPts, "ONLY_FID", output_type="POINT")
+      fid = [f.name for f in arcpy.ListFields(damPts)
+             if f.name.upper() == 'FID_' + os.path.basename(in_Flowlines).upper()][0]
+      dpt = arcpy.da.FeatureClassToNumPyArray(damPts, [fid, 'SHAPE@X', 'SHAPE@Y'], spatial_reference=sr,
+                                              explode_to_points=True)
+      SetDams(graph, dpt[fid], np.column_stack([dpt['SHAPE@X'], dpt['SHAPE@Y']]))
+      arcpy.Delete_management(damPts)
+   graphCache[key] = graph
+   print('Flowline graph has ' + str(len(graph['oid'])) + ' edges and ' + str(len(graph['up_ptr']) - 1) + ' nodes.')
+   return graph
+
+
+def BuildSegmentGrid(graph, cellSize, barriers=None):
+   """Builds a uniform grid index over the flowline segments (consecutive vertex pairs) of non-restricted flowlines,
+   for SnapPoints. Each segment is listed in every grid cell its bounding box overlaps.
+   Parameters:
+   - graph = Flowline graph (MakeFlowGraph)
+   - cellSize = Grid cell size (map units). The snap distance is a good choice.
+   - barriers = Barrier bitmask (BarrierMask); segments of restricted flowlines are not indexed
+
+   Returns a dictionary of arrays: seg (start vertex of each segment), edge (flowline of each segment), cell keys and
+   a CSR list of segments per cell (ptr, cell_seg), plus the grid origin (x0, y0) and cell size (cs).
+   """
+   xy = graph['xy']
+   vtx_ptr = graph['vtx_ptr']
+   # segments (a -> a+1), excluding segments crossing between lines and restricted lines
+   seg_edge = np.repeat(np.arange(len(vtx_ptr) - 1), np.diff(vtx_ptr))
+   a = np.arange(len(xy) - 1)
+   blocked = Blocked(graph, barriers)[0]
+   a = a[(seg_edge[a] == seg_edge[a + 1]) & ~blocked[seg_edge[a]]]
+   p0 = xy[a]
+   p1 = xy[a + 1]
+   x0 = xy[:, 0].min() if len(xy) > 0 else 0.0
+   y0 = xy[:, 1].min() if len(xy) > 0 else 0.0
+   cx0 = np.floor((np.minimum(p0[:, 0], p1[:, 0]) - x0) / cellSize).astype(np.int64)
+   cx1 = np.floor((np.maximum(p0[:, 0], p1[:, 0]) - x0) / cellSize).astype(np.int64)
+   cy0 = np.floor((np.minimum(p0[:, 1], p1[:, 1]) - y0) / cellSize).astype(np.int64)
+   cy1 = np.floor((np.maximum(p0[:, 1], p1[:, 1]) - y0) / cellSize).astype(np.int64)
+
+   # expand each segment to the cells of its bounding box
+   nx = cx1 - cx0 + 1
+   ny = cy1 - cy0 + 1
+   n = nx * ny
+   s = np.repeat(np.arange(len(a)), n)
+   k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+   keys = CellKey(cx0[s] + k // ny[s], cy0[s] + k % ny[s])
+   o = np.argsort(keys, kind='mergesort')
+   keys, s = keys[o], s[o]
+   cells, first = np.unique(keys, return_index=True)
+   ptr = np.concatenate([first, [len(keys)]]).astype(np.int64)
+   return {'seg': a, 'edge': seg_edge[a], 'cells': cells, 'ptr': ptr, 'cell_seg': s,
+           'x0': x0, 'y0': y0, 'cs': float(cellSize)}
+
+
+def CellKey(cx, cy):
+   """Integer key of grid cells (column, row), for BuildSegmentGrid."""
+   return (np.asarray(cx, dtype=np.int64) + 2 ** 30) * 2 ** 31 + (np.asarray(cy, dtype=np.int64) + 2 ** 30)
+
+
+def SnapPoints(graph, pt_xy, snap_dist, barriers=None, grid=None, chunk=100000):
+   """Snaps points to the closest non-restricted flowline within snap_dist (map units), where restrictions are
+   given by the barrier bitmask (BarrierMask). All points are queried at once against a grid index of flowline
+   segments (BuildSegmentGrid), in chunks of points.
+   Parameters:
+   - graph = Flowline graph (MakeFlowGraph)
+   - pt_xy = Point coordinates (n x 2)
+   - snap_dist = Snap tolerance (map units)
+   - barriers = Barrier bitmask
+   - grid = Segment grid from BuildSegmentGrid, built with the same barriers. Made with a cell size of snap_dist if
+      not given.
+   - chunk = Number of points per query
+
+   Returns a tuple of arrays (edge, measure, distance), where measure is the distance along the flowline from its
+   start. Points not within snap_dist of a flowline get an edge of -1 and a distance of inf.
+   """
+   pt_xy = np.asarray(pt_xy, dtype=np.float64).reshape(-1, 2)
+   if grid is None:
+      grid = BuildSegmentGrid(graph, snap_dist, barriers)
+   xy = graph['xy']
+   mdist = graph['mdist']
+   cs = grid['cs']
+   r = int(np.ceil(snap_dist / cs))
+   offs = [[i, j] for i in range(-r, r + 1) for j in range(-r, r + 1)]
+
+   edge = np.full(len(pt_xy), -1, dtype=np.int64)
+   meas = np.zeros(len(pt_xy))
+   dist = np.full(len(pt_xy), np.inf)
+   for c0 in range(0, len(pt_xy), chunk):
+      pxy = pt_xy[c0:c0 + chunk]
+      cx = np.floor((pxy[:, 0] - grid['x0']) / cs).astype(np.int64)
+      cy = np.floor((pxy[:, 1] - grid['y0']) / cs).astype(np.int64)
+      # candidate (point, segment) pairs from the cells around each point
+      pts = []
+      segs = []
+      for i, j in offs:
+         keys = CellKey(cx + i, cy + j)
+         c = np.searchsorted(grid['cells'], keys)
+         c = np.minimum(c, len(grid['cells']) - 1) if len(grid['cells']) > 0 else c
+         hit = np.nonzero(grid['cells'][c] == keys)[0] if len(grid['cells']) > 0 else np.zeros(0, dtype=np.int64)
+         lo = grid['ptr'][c[hit]]
+         n = grid['ptr'][c[hit] + 1] - lo
+         pts.append(np.repeat(hit, n))
+         segs.append(grid['cell_seg'][np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())])
+      pts = np.concatenate(pts)
+      segs = np.concatenate(segs)
+      if len(pts) == 0:
+         continue
+      a = grid['seg'][segs]
+      d, t = PointSegmentDistance(pxy[pts, 0], pxy[pts, 1], xy[a], xy[a + 1])
+      # closest segment per point
+      o = np.lexsort([d, pts])
+      first = o[np.concatenate([[True], pts[o][1:] != pts[o][:-1]])]
+      ok = d[first] <= snap_dist
+      first = first[ok]
+      p = pts[first] + c0
+      s = a[first]
+      edge[p] = grid['edge'][segs[first]]
+      meas[p] = mdist[s] + t[first] * (mdist[s + 1] - mdist[s])
+      dist[p] = d[first]
+   return edge, meas, dist
+
+
+def PointSegmentDistance(x, y, p0, p1):
+   """Distance from point (x, y) to segments p0-p1, and the position (0-1) of the closest point on each segment.
+   x and y can also be arrays, one point per segment."""
+   dx = p1[:, 0] - p0[:, 0]
+   dy = p1[:, 1] - p0[:, 1]
+   ll = dx * dx + dy * dy
+   with np.errstate(invalid='ignore', divide='ignore'):
+      t = ((x - p0[:, 0]) * dx + (y - p0[:, 1]) * dy) / ll
+   t = np.clip(np.nan_to_num(t), 0, 1)
+   d = np.hypot(p0[:, 0] + t * dx - x, p0[:, 1] + t * dy - y)
+   return d, t
+
+
+def TraceUpstream(graph, starts, up_Dist, barriers=None):
+   """Traces upstream from snapped points, to a maximum network distance.
+   Parameters:
+   - graph = Flowline graph (MakeFlowGraph)
+   - starts = List of [ptid, edge, measure] for each point, where measure is the distance along the edge from its
+      start (upstream end) to the point
+   - up_Dist = The distance (in map units) to traverse upstream from a point along the network
+   - barriers = Barrier bitmask (BarrierMask). Restricted flowlines are not traversed, and the trace stops at dams.
+
+   Returns a dictionary of arrays, one element per traced line piece: pt (point ID), edge, m0/m1 (start/end of the
+   piece, as distance along the edge), fromCumul/toCumul (network distance from the point to the downstream and
+   upstream end of the piece). The last piece on each path is cut at up_Dist.
+   """
+   # The graph arrays are indexed directly (only for the flowlines reached), so a graph attached from a published
+   # folder (AttachGraph) stays memory-mapped and shared, instead of being copied per call.
+   if barriers is None:
+      barriers = BarrierMask()
+   rmask = barriers & ~barrierBits["Dams"]
+   dmask = barriers & barrierBits["Dams"]
+   length = graph['length']
+   from_node = graph['from_node']
+   barrier = graph['barrier']
+   dam_pos = graph['dam_pos']
+   up_ptr = graph['up_ptr']
+   up_edge = graph['up_edge']
+
+   pt, edge, m0, m1, fc, tc = [], [], [], [], [], []
+   for ptid, e, s in starts:
+      # Piece of the starting flowline, upstream of the point (and downstream of any dam on it)
+      stop = bool(barrier[e] & dmask) and dam_pos[e] < s
+      top = float(dam_pos[e]) if stop else 0.0
+      if s > top:
+         pt.append(ptid)
+         edge.append(e)
+         m0.append(max(top, s - up_Dist))
+         m1.append(s)
+         fc.append(0.0)
+         tc.append(min(s - top, up_Dist))
+      if s >= up_Dist or stop:
+         continue
+      # Shortest-path walk up the network from the upstream node of the starting flowline
+      n0 = int(from_node[e])
+      best = {n0: s}
+      heap = [(s, n0)]
+      while heap:
+         d, n = heapq.heappop(heap)
+         if d > best[n]:
+            continue
+         us = up_edge[up_ptr[n]:up_ptr[n + 1]]
+         if len(us) == 0:
+            continue
+         for u, ln, n1, bar, dp in zip(us.tolist(), length[us].tolist(), from_node[us].tolist(),
+                                       barrier[us].tolist(), dam_pos[us].tolist()):
+            if bar & rmask:
+               continue
+            dam = bar & dmask
+            d1 = d + ln
+            top = dp if dam else 0.0
+            if top < ln:
+               pt.append(ptid)
+               edge.append(u)
+               m0.append(max(top, ln - (up_Dist - d)))
+               m1.append(ln)
+               fc.append(d)
+               tc.append(min(d1 - top, up_Dist))
+            if d1 < up_Dist and not dam:
+               if d1 < best.get(n1, np.inf):
+                  best[n1] = d1
+                  heapq.heappush(heap, (d1, n1))
+
+   pieces = {'pt': np.array(pt, dtype=np.int64), 'edge': np.array(edge, dtype=np.int64),
+             'm0': np.array(m0), 'm1': np.array(m1), 'fromCumul': np.array(fc), 'toCumul': np.array(tc)}
+   return pieces
+
+
+def ClipTrace(pieces, up_Dist):
+   """Cuts traced line pieces (TraceUpstream) back to a shorter distance. Since the trace keeps the cumulative
+   network distance for each piece, any distance up to the traced distance can be taken from one trace.
+   """
+   keep = pieces['fromCumul'] < up_Dist
+   clip = dict([[k, v[keep]] for k, v in pieces.items()])
+   clip['m0'] = np.maximum(clip['m0'], clip['m1'] - (up_Dist - clip['fromCumul']))
+   clip['toCumul'] = np.minimum(clip['toCumul'], up_Dist)
+   return clip
+
+
+def CutEdge(graph, e, m0, m1):
+   """Returns the vertices (n x 2 array) of edge e between distances m0 and m1 along the edge."""
+   a, b = graph['vtx_ptr'][e], graph['vtx_ptr'][e + 1]
+   xy = graph['xy'][a:b]
+   m = graph['mdist'][a:b]
+   if m0 <= 0 and m1 >= m[-1]:
+      return xy
+   inner = xy[(m > m0) & (m < m1)]
+   p0 = [np.interp(m0, m, xy[:, 0]), np.interp(m0, m, xy[:, 1])]
+   p1 = [np.interp(m1, m, xy[:, 0]), np.interp(m1, m, xy[:, 1])]
+   return np.vstack([p0, inner, p1])
+
+
+def SplitPath(fc):
+   """Splits a feature class path into workspace and name, using the current workspace for bare names."""
+   ws = os.path.dirname(fc)
+   if ws == '':
+      ws = arcpy.env.workspace
+   return ws, os.path.basename(fc)
+
+
+def CatalogPath(data):
+   """Full catalog path of a dataset, for passing to worker processes (which do not share the workspace of the parent
+   process, so workspace-relative names would not resolve). Paths in a not-yet-existing dataset are resolved against
+   the current workspace."""
+   if arcpy.Exists(data):
+      return arcpy.Describe(data).catalogPath
+   ws, nm = SplitPath(data)
+   return ws + os.sep + nm
+
+
+def NullNaN(v):
+   """Float value for cursors, with NaN as None (null)."""
+   v = float(v)
+   return None if np.isnan(v) else v
+
+
+def ToPolyline(parts, sr):
+   """Makes an arcpy Polyline from a list of vertex arrays (one per part)."""
+   arr = arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in p]) for p in parts])
+   return arcpy.Polyline(arr, sr)
+
+
+def ChainParts(parts, tol=0.001):
+   """Concatenates line parts which meet end to end into longer parts, without any geometric overlay. Parts are
+   joined at end points shared by exactly two parts (so lines break at confluences, as with an unsplit dissolve).
+   Parameters:
+   - parts = List of vertex arrays ([n, 2]), one per part. Parts are reversed where needed to join them.
+   - tol = Tolerance (map units) for matching end points
+
+   Returns a list of vertex arrays.
+   """
+   parts = [np.asarray(p, dtype=np.float64) for p in parts if len(p) > 1]
+   keys = [[tuple(np.round(p[0] / tol).astype(np.int64)), tuple(np.round(p[-1] / tol).astype(np.int64))]
+           for p in parts]
+   ends = {}
+   for i, k in enumerate(keys):
+      ends.setdefault(k[0], []).append([i, 0])
+      ends.setdefault(k[1], []).append([i, 1])
+   used = np.zeros(len(parts), dtype=bool)
+   out = []
+
+   def grow(chain, node, arrive):
+      # extend the chain past its end node, while the node joins exactly two parts
+      while len(ends[node]) == 2:
+         i, side = [e for e in ends[node] if e != arrive][0]
+         if used[i]:
+            break
+         used[i] = True
+         p = parts[i] if side == 0 else parts[i][::-1]
+         chain.append(p[1:])
+         node = keys[i][1 - side]
+         arrive = [i, 1 - side]
+      return chain
+
+   for i in range(len(parts)):
+      if used[i]:
+         continue
+      used[i] = True
+      tail = grow([parts[i]], keys[i][1], [i, 1])
+      head = grow([parts[i][::-1]], keys[i][0], [i, 0])
+      rev = [p[::-1] for p in head[:0:-1]]
+      out.append(np.vstack(rev + tail))
+   return out
+
+
+def DissolveLines(in_Lines, out_Lines, ptid_join="OBJECTID_in_Points", tol=0.001):
+   """Dissolves lines to one (multipart) feature per ptid_join value by concatenating the parts which meet end to
+   end (ChainParts). Used in place of Dissolve_management for traced networks, whose segments already share end
+   points."""
+   sr = arcpy.Describe(in_Lines).spatialReference
+   parts = {}
+   with arcpy.da.SearchCursor(in_Lines, [ptid_join, "SHAPE@"]) as cursor:
+      for row in cursor:
+         if row[0] is None or row[1] is None:
+            continue
+         for part in row[1]:
+            parts.setdefault(int(row[0]), []).append(np.array([[pt.X, pt.Y] for pt in part if pt]))
+   ws, nm = SplitPath(out_Lines)
+   arcpy.CreateFeatureclass_management(ws, nm, "POLYLINE", spatial_reference=sr)
+   arcpy.AddField_management(out_Lines, ptid_join, "LONG")
+   with arcpy.da.InsertCursor(out_Lines, ["SHAPE@", ptid_join]) as cursor:
+      for p in sorted(parts.keys()):
+         cursor.insertRow([ToPolyline(ChainParts(parts[p], tol), sr), p])
+   return out_Lines
+
+
+def WriteTraceLines(graph, pieces, out_Lines, ptid_join="OBJECTID_in_Points", catID="NHDPlusID"):
+   """Writes traced line pieces to feature classes: `[out_Lines]_full` with one feature per piece, and out_Lines
+   with one (multipart) feature per point, with pieces which meet end to end concatenated (ChainParts).
+   Fields in `_full` follow the Network Analyst service area lines used previously, so that the outputs can be passed
+   on to GetCatchments_hw: ptid_join, SourceOID, catID, FromCumul_Length, ToCumul_Length.
+   """
+   sr = graph['sr']
+   out_full = out_Lines + '_full'
+   for fc in [out_full, out_Lines]:
+      ws, nm = SplitPath(fc)
+      arcpy.CreateFeatureclass_management(ws, nm, "POLYLINE", spatial_reference=sr)
+      arcpy.AddField_management(fc, ptid_join, "LONG")
+   arcpy.AddField_management(out_full, "SourceOID", "LONG")
+   arcpy.AddField_management(out_full, catID, "DOUBLE")
+   arcpy.AddField_management(out_full, "FromCumul_Length", "DOUBLE")
+   arcpy.AddField_management(out_full, "ToCumul_Length", "DOUBLE")
+
+   print('Writing ' + str(len(pieces['pt'])) + ' traced lines...')
+   parts = {}
+   flds = ["SHAPE@", ptid_join, "SourceOID", catID, "FromCumul_Length", "ToCumul_Length"]
+   with arcpy.da.InsertCursor(out_full, flds) as cursor:
+      for i in range(len(pieces['pt'])):
+         e = pieces['edge'][i]
+         p = int(pieces['pt'][i])
+         vtx = CutEdge(graph, e, pieces['m0'][i], pieces['m1'][i])
+         parts.setdefault(p, []).append(vtx)
+         cursor.insertRow([ToPolyline([vtx], sr), p, int(graph['oid'][e]), float(graph['nid'][e]),
+                           NullNaN(pieces['fromCumul'][i]), NullNaN(pieces['toCumul'][i])])
+
+   # one feature per point, with each piece as a part
+   with arcpy.da.InsertCursor(out_Lines, ["SHAPE@", ptid_join]) as cursor:
+      for p in sorted(parts.keys()):
+         cursor.insertRow([ToPolyline(ChainParts(parts[p]), sr), p])
+
+   return out_Lines
+
+
+def SaveArrays(arrs, folder):
+   """Saves a dictionary of numpy arrays to a folder, one .npy file per array. The arrays are written to a new folder,
+   which then replaces the old one, so files that are memory-mapped (LoadArrays) are never written over. Arrays loaded
+   from the old folder must be released (del) first, since open memory-mapped files cannot be moved on Windows."""
+   tmp = folder + '_new'
+   if os.path.exists(tmp):
+      shutil.rmtree(tmp)
+   os.makedirs(tmp)
+   for k, v in arrs.items():
+      np.save(tmp + os.sep + k + '.npy', np.asarray(v))
+   if os.path.exists(folder):
+      shutil.rmtree(folder)
+   os.rename(tmp, folder)
+   return folder
+
+
+def LoadArrays(folder, mmap=True):
+   """Loads a dictionary of numpy arrays saved with SaveArrays. Numeric arrays are memory-mapped (read-only) if mmap
+   is True, so only the parts that are used get read from disk."""
+   arrs = {}
+   for f in sorted(os.listdir(folder)):
+      if f.endswith('.npy'):
+         try:
+            arrs[f[:-4]] = np.load(folder + os.sep + f, mmap_mode='r' if mmap else None)
+         except ValueError:
+            # object/string arrays cannot be memory-mapped
+            arrs[f[:-4]] = np.load(folder + os.sep + f, allow_pickle=False)
+   return arrs
+
+
+def GraphHash(arrs):
+   """Returns a hash (hex string) of a dictionary of numpy arrays: names, dtypes, shapes and contents."""
+   h = hashlib.sha1()
+   for k in sorted(arrs.keys()):
+      v = np.ascontiguousarray(arrs[k])
+      h.update((k + ';' + str(v.dtype) + ';' + str(v.shape)).encode('utf-8'))
+      h.update(v.tobytes())
+   return h.hexdigest()
+
+
+def PublishGraph(graph, folder):
+   """Publishes a flowline graph for worker processes, as memory-mapped arrays in a folder (SaveArrays). The spatial
+   reference is saved as WKT, and a hash of all published arrays (GraphHash) is saved with them. If the folder
+   already holds the same graph, it is not written again. Returns the folder.
+   """
+   arrs = dict([[k, v] for k, v in graph.items() if k != 'sr'])
+   if graph.get('sr') is not None:
+      arrs['sr_wkt'] = np.array(graph['sr'].exportToString())
+   arrs['hash'] = np.array(GraphHash(arrs))
+   # only the saved hash is read (not memory-mapped), so no open mapping is left on the files replaced below
+   old = folder + os.sep + 'hash.npy'
+   if os.path.exists(old) and str(np.load(old)) == str(arrs['hash']):
+      return folder
+   return SaveArrays(arrs, folder)
+
+
+def AttachGraph(folder):
+   """Attaches to a graph published with PublishGraph. Arrays are memory-mapped read-only, so processes attached to
+   the same folder share one copy in the OS page cache, and nothing is read until it is used."""
+   graph = LoadArrays(folder)
+   graph.pop('hash', None)
+   wkt = graph.pop('sr_wkt', None)
+   graph['sr'] = None
+   if wkt is not None and arcpy is not None:
+      graph['sr'] = arcpy.SpatialReference()
+      graph['sr'].loadFromString(str(wkt))
+   return graph
+
+
+def AttachWorker(folder):
+   """Process pool initializer: attaches the worker process to a published graph, once."""
+   workerGraph['graph'] = AttachGraph(folder)
+
+
+def TraceWorker(starts, up_Dist, barriers):
+   """Runs TraceUpstream in a worker process, on the graph attached by AttachWorker."""
+   return TraceUpstream(workerGraph['graph'], starts, up_Dist, barriers)
+
+
+def TraceParallel(folder, starts, up_Dist, barriers=None, workers=4, chunks=None):
+   """Traces upstream from snapped points in worker processes. Each worker attaches to the published graph
+   (PublishGraph) when it starts, instead of reading flowlines and building its own graph. Points are split into
+   chunks (default 4 per worker), and the pieces are returned in the order of starts, as from TraceUpstream.
+   Parameters:
+   - folder = Folder of the published graph
+   - chunks = Number of chunks of points
+   - other parameters as in TraceUpstream
+   """
+   chunks = chunks or workers * 4
+   n = max(1, -(-len(starts) // chunks))
+   batches = [starts[i:i + n] for i in range(0, len(starts), n)]
+   with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=AttachWorker,
+                                               initargs=(folder,)) as pool:
+      parts = list(pool.map(TraceWorker, batches, [up_Dist] * len(batches), [barriers] * len(batches)))
+   if len(parts) == 0:
+      return TraceUpstream(AttachGraph(folder), [], up_Dist, barriers)
+   return dict([[k, np.concatenate([p[k] for p in parts])] for k in parts[0].keys()])
+
+
+def BuildUpstreamIndex(graph, barriers=None):
+   """Builds an upstream-reachability index for the flowline graph, for one barrier bitmask (BarrierMask).
+   Each flowline is given one downstream flowline as its parent, making an upstream tree (forest) rooted at the
+   outlets. Flowlines are numbered in DFS pre-order, so all flowlines in the tree upstream of flowline e are the
+   interval pre[e] to pre[e] + size[e] - 1 in the pre-order (order). Where a flowline has more than one downstream
+   flowline (braided or divergent reaches), the other downstream links are kept in an overflow table (ovf_child,
+   ovf_parent), sorted by pre-order of the parent. Restricted flowlines are not linked to anything, and flowlines
+   with a dam have no flowlines upstream of them.
+
+   Returns a dictionary of arrays: oid, nid, barrier, barriers, parent, pre, size, order, ovf_child, ovf_parent,
+   ovf_pre.
+   """
+   if barriers is None:
+      barriers = BarrierMask()
+   nEdge = len(graph['oid'])
+   blocked, dam = Blocked(graph, barriers)
+   from_node = np.asarray(graph['from_node'])
+
+   # Downstream links (edge u flows into edge d where to_node[u] == from_node[d]), excluding restricted flowlines
+   up_ptr = np.asarray(graph['up_ptr'])
+   up_edge = np.asarray(graph['up_edge'])
+   cnt = np.diff(up_ptr)[from_node]
+   d = np.repeat(np.arange(nEdge), cnt)
+   u = up_edge[np.repeat(up_ptr[from_node], cnt) + (np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt))]
+   ok = ~blocked[u] & ~blocked[d] & ~dam[d] & (u != d)
+   u, d = u[ok], d[ok]
+
+   # First downstream link is the tree parent, others go in the overflow table
+   o = np.lexsort((d, u))
+   u, d = u[o], d[o]
+   first = np.concatenate([[True], u[1:] != u[:-1]]) if len(u) else np.zeros(0, dtype=bool)
+   parent = np.full(nEdge, -1, dtype=np.int64)
+   parent[u[first]] = d[first]
+   ovf_child = list(u[~first])
+   ovf_parent = list(d[~first])
+
+   # Children of each edge, in CSR form
+   def children(par):
+      has = np.where(par >= 0)[0]
+      ch = has[np.argsort(par[has], kind='mergesort')]
+      ptr = np.concatenate([[0], np.cumsum(np.bincount(par[has], minlength=nEdge))])
+      return ch, ptr
+
+   ch, ch_ptr = children(parent)
+
+   # Iterative DFS pre-order from roots
+   pre = np.full(nEdge, -1, dtype=np.int64)
+   order = []
+
+   def dfs(root):
+      stack = [root]
+      while stack:
+         e = stack.pop()
+         pre[e] = len(order)
+         order.append(e)
+         stack.extend(ch[ch_ptr[e]:ch_ptr[e + 1]][::-1].tolist())
+
+   for r in np.where(parent < 0)[0].tolist():
+      dfs(r)
+
+   # Edges not reached are in loops. Cut each loop at one edge, and keep the cut link as overflow.
+   if len(order) < nEdge:
+      for e in np.where(pre < 0)[0].tolist():
+         if pre[e] >= 0:
+            continue
+         seen = set()
+         while e not in seen:
+            seen.add(e)
+            e = parent[e]
+         ovf_child.append(e)
+         ovf_parent.append(parent[e])
+         parent[e] = -1
+         ch, ch_ptr = children(parent)
+         dfs(e)
+
+   order = np.array(order, dtype=np.int64)
+   # Subtree sizes, accumulated in reverse pre-order
+   size = np.ones(nEdge, dtype=np.int64)
+   par_o = parent[order]
+   for i in range(nEdge - 1, -1, -1):
+      if par_o[i] >= 0:
+         size[par_o[i]] += size[order[i]]
+
+   ovf_child = np.array(ovf_child, dtype=np.int64)
+   ovf_parent = np.array(ovf_parent, dtype=np.int64)
+   o = np.argsort(pre[ovf_parent], kind='mergesort')
+   index = {'oid': np.asarray(graph['oid']), 'nid': np.asarray(graph['nid']), 'barrier': np.asarray(graph['barrier']),
+            'barriers': np.array(barriers), 'parent': parent, 'pre': pre,
+            'size': size, 'order': order, 'ovf_child': ovf_child[o], 'ovf_parent': ovf_parent[o],
+            'ovf_pre': pre[ovf_parent[o]]}
+   return index
+
+
+def UpstreamIntervals(index, e):
+   """Returns the pre-order intervals [start, end) of all flowlines upstream of flowline e (including e)."""
+   pre = index['pre']
+   size = index['size']
+   ovf_pre = index['ovf_pre']
+   ovf_child = index['ovf_child']
+   ivs = []
+   stack = [int(e)]
+   while stack:
+      r = stack.pop()
+      a = int(pre[r])
+      if any([s <= a < t for s, t in ivs]):
+         continue
+      b = a + int(size[r])
+      # drop intervals nested in this one
+      ivs = [[s, t] for s, t in ivs if not (a <= s and t <= b)]
+      ivs.append([a, b])
+      # overflow links into this interval
+      i0, i1 = np.searchsorted(ovf_pre, [a, b])
+      stack.extend(ovf_child[i0:i1].tolist())
+   return sorted(ivs)
+
+
+def IsUpstream(index, x, y):
+   """Is flowline x upstream of (or the same as) flowline y?"""
+   px = int(index['pre'][x])
+   py = int(index['pre'][y])
+   if py <= px < py + int(index['size'][y]):
+      return True
+   if len(index['ovf_pre']) == 0:
+      return False
+   return any([s <= px < t for s, t in UpstreamIntervals(index, y)])
+
+
+def UpstreamEdges(index, e):
+   """Returns all flowlines (edge indices) upstream of flowline e, including e."""
+   order = index['order']
+   return np.concatenate([order[s:t] for s, t in UpstreamIntervals(index, e)])
+
+
+def UpstreamCatchments(index, e):
+   """Returns the catchment IDs (NHDPlusID) of all flowlines upstream of flowline e, including e."""
+   return np.unique(index['nid'][UpstreamEdges(index, e)])
+
+
+def IndexTrace(index, graph, starts):
+   """Traces the full upstream network for snapped points, using the upstream index instead of walking the graph.
+   Parameters and output are as for TraceUpstream, using the barriers the index was built with. The cumulative
+   distance is not known for pieces upstream of the starting flowline, and is set to NaN, except for flowlines
+   immediately upstream of a point on a node (these get a fromCumul of 0, as in TraceUpstream).
+   """
+   length = graph['length']
+   from_node = graph['from_node']
+   to_node = graph['to_node']
+   blocked, dam = Blocked(graph, int(index['barriers']))
+   top = np.where(dam, graph['dam_pos'], 0.0)
+   up_ptr = graph['up_ptr']
+   up_edge = graph['up_edge']
+   pt, edge, m0, m1, fc, tc = [], [], [], [], [], []
+   for ptid, e, s in starts:
+      # Piece of the starting flowline, upstream of the point (and downstream of any dam on it)
+      stop = dam[e] and top[e] < s
+      t = top[e] if stop else 0.0
+      if stop:
+         up = np.zeros(0, dtype=np.int64)
+      elif dam[e]:
+         # the point is upstream of the dam, which the index does not link past
+         n = from_node[e]
+         u0 = [u for u in up_edge[up_ptr[n]:up_ptr[n + 1]].tolist() if not blocked[u]]
+         up = np.unique(np.concatenate([UpstreamEdges(index, u) for u in u0])) if u0 else np.zeros(0, dtype=np.int64)
+         up = up[(up != e) & (top[up] < length[up])]
+      else:
+         up = UpstreamEdges(index, e)
+         up = up[(up != e) & (top[up] < length[up])]
+      if s > t:
+         pt.append([ptid])
+         edge.append([e])
+         m0.append([t])
+         m1.append([s])
+         fc.append([0.0])
+         tc.append([s - t])
+      pt.append(np.full(len(up), ptid))
+      edge.append(up)
+      m0.append(top[up])
+      m1.append(length[up])
+      f = np.full(len(up), np.nan)
+      if s == 0:
+         f[to_node[up] == from_node[e]] = 0.0
+      fc.append(f)
+      tc.append(np.full(len(up), np.nan))
+
+   def cat(ls, dt):
+      return np.concatenate(ls).astype(dt) if ls else np.zeros(0, dtype=dt)
+
+   pieces = {'pt': cat(pt, np.int64), 'edge': cat(edge, np.int64), 'm0': cat(m0, float), 'm1': cat(m1, float),
+             'fromCumul': cat(fc, float), 'toCumul': cat(tc, float)}
+   return pieces
+
+
+def CatchmentValues(index, nid, values):
+   """Assigns catchment attribute values to flowlines, by catchment ID (NHDPlusID). Where more than one flowline has
+   the same ID, the values go to one of them only (a non-restricted one if there is one), so each catchment is
+   counted once. Returns an array with one row per flowline (0 where there is no catchment).
+   Parameters:
+   - index = Upstream index (BuildUpstreamIndex)
+   - nid = Catchment ID of each catchment row
+   - values = Attribute values for each catchment row ([n] or [n, k])
+   """
+   values = np.asarray(values, dtype=np.float64)
+   v = values.reshape(len(values), -1)
+   blocked = Blocked(index, int(index['barriers']))[0]
+   # first flowline for each ID, non-restricted first
+   o = np.lexsort((blocked, np.asarray(index['nid'])))
+   keys = np.asarray(index['nid'])[o]
+   first = np.concatenate([[True], keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=bool)
+   edges, found = SortedLookup(keys[first], o[first], np.asarray(nid))
+   out = np.zeros((len(index['oid']), v.shape[1]))
+   np.add.at(out, edges, v[found])
+   return out.reshape((len(out),) + values.shape[1:])
+
+
+def AccumulateUpstream(index, values):
+   """Accumulates flowline values (e.g. from CatchmentValues) upstream, giving the total over each flowline's full
+   upstream network (including itself) in one sweep: a cumulative sum over the DFS pre-order of the index, where the
+   total for flowline e is the difference of the cumulative sums at the ends of its interval. Flowlines with
+   overflow links in their interval (braided or divergent reaches) get the sum over the union of their upstream
+   intervals instead, so flowlines reached by more than one path are counted once.
+   Parameters:
+   - index = Upstream index (BuildUpstreamIndex)
+   - values = Additive values for each flowline ([nEdge] or [nEdge, k])
+
+   Returns an array of the same shape as values.
+   """
+   values = np.asarray(values, dtype=np.float64)
+   v = values.reshape(len(values), -1)
+   pre = np.asarray(index['pre'])
+   end = pre + np.asarray(index['size'])
+   cum = np.vstack([np.zeros((1, v.shape[1])), np.cumsum(v[np.asarray(index['order'])], axis=0)])
+   total = cum[end] - cum[pre]
+   ovf_pre = np.asarray(index['ovf_pre'])
+   if len(ovf_pre) > 0:
+      fix = np.nonzero(np.searchsorted(ovf_pre, end) > np.searchsorted(ovf_pre, pre))[0]
+      for e in fix.tolist():
+         ivs = np.array(UpstreamIntervals(index, e))
+         total[e] = (cum[ivs[:, 1]] - cum[ivs[:, 0]]).sum(axis=0)
+   return total.reshape(values.shape)
+
+
+def WatershedTotals(acc, graph, starts):
+   """Looks up the full upstream (whole watershed) totals for snapped points, from an accumulation (MakeAccumulation).
+   A point's own flowline is counted in full. For points on a flowline with a dam, only the flowline's own values
+   are counted if the point is downstream of the dam; if it is upstream of the dam, the totals of the flowlines
+   flowing into it are added (as in IndexTrace).
+   Parameters:
+   - acc = Dictionary with the upstream index arrays, and the flowline values (value) and totals (total)
+   - graph = Flowline graph (MakeFlowGraph)
+   - starts = List of [ptid, edge, measure] for each point (see TraceUpstream)
+
+   Returns an array with one row of totals per point in starts.
+   """
+   total = np.asarray(acc['total'])
+   out = total[[s[1] for s in starts]].copy() if len(starts) else np.zeros((0,) + total.shape[1:])
+   blocked, dam = Blocked(graph, int(acc['barriers']))
+   up_ptr = graph['up_ptr']
+   up_edge = graph['up_edge']
+   for i, (ptid, e, s) in enumerate(starts):
+      if dam[e] and s <= graph['dam_pos'][e]:
+         n = graph['from_node'][e]
+         u0 = [u for u in up_edge[up_ptr[n]:up_ptr[n + 1]].tolist() if not blocked[u]]
+         if u0:
+            up = np.unique(np.concatenate([UpstreamEdges(acc, u) for u in u0]))
+            out[i] = out[i] + np.asarray(acc['value'])[up[up != e]].sum(axis=0)
+   return out
+
+
+def MakeUpstreamIndex(in_hydroNet, graph, barriers=None, rebuild=False):
+   """Loads (memory-mapped) or builds the upstream-reachability index for a HydroNet. The index is saved in a
+   folder next to the HydroNet geodatabase (e.g. `VA_HydroNet_upIndex_15` next to `VA_HydroNet.gdb`, for barrier
+   bitmask 15), and is rebuilt if the graph's flowlines, nodes or barriers do not match those the saved index was
+   built from (hash of the graph arrays, GraphHash), or if rebuild is True.
+   Parameters:
+   - in_hydroNet = Hydrological network dataset (e.g., VA_HydroNet.gdb/HydroNet/HydroNet_ND)
+   - graph = Flowline graph for the HydroNet (MakeFlowGraph)
+   - barriers = Barrier bitmask (BarrierMask)
+   """
+   if barriers is None:
+      barriers = BarrierMask()
+   gdb = os.path.dirname(os.path.dirname(arcpy.Describe(in_hydroNet).catalogPath))
+   folder = os.path.splitext(gdb)[0] + '_upIndex_' + str(barriers)
+   graphHash = GraphHash(dict([[k, graph[k]] for k in ['oid', 'nid', 'barrier', 'from_node', 'to_node']]))
+   if os.path.exists(folder) and not rebuild:
+      index = LoadArrays(folder)
+      if 'graph_hash' in index and str(index['graph_hash']) == graphHash:
+         print('Using upstream index `' + folder + '`.')
+         return index
+      # release the memory-mapped files before they are replaced
+      del index
+      print('Upstream index `' + folder + '` does not match flowlines, rebuilding...')
+   print('Building upstream index...')
+   index = BuildUpstreamIndex(graph, barriers)
+   index['graph_hash'] = np.array(graphHash)
+   SaveArrays(index, folder)
+   print('Upstream index saved to `' + folder + '`.')
+   return LoadArrays(folder)
+
+
+def MakeAccumulation(in_Catchment, index, fields, catID="NHDPlusID", rebuild=False):
+   """Loads (memory-mapped) or builds the upstream accumulation of catchment attributes, for an upstream index
+   (MakeUpstreamIndex). Catchment values are assigned to flowlines (CatchmentValues) and accumulated upstream
+   (AccumulateUpstream). The result is saved in a folder next to the catchment geodatabase
+   (`[gdb]_upAcc_[fc]_[barriers]`), and is rebuilt if it was made from a different upstream index (graph hash, see
+   MakeUpstreamIndex) or fields, if the catchments have changed (DataVersion), or if rebuild is True.
+   Parameters:
+   - in_Catchment = Catchments feature class (or table), with one row per catchment ID
+   - index = Upstream index (MakeUpstreamIndex)
+   - fields = Numeric fields to accumulate. Values must be additive (areas, lengths, counts, loads); for averages,
+      accumulate area-weighted values and divide by the accumulated area. Nulls are counted as 0.
+   - catID = Catchment ID field, matching the flowlines
+
+   Returns a dictionary of the index arrays, with fields, value (per flowline) and total (upstream total per flowline)
+   arrays, with one column per field.
+   """
+   fields = list(fields)
+   gdb = GdbPath(in_Catchment)
+   folder = os.path.splitext(gdb)[0] + '_upAcc_' + os.path.basename(arcpy.Describe(in_Catchment).catalogPath) + \
+      '_' + str(int(index['barriers']))
+   version = DataVersion(in_Catchment)
+   if os.path.exists(folder) and not rebuild:
+      acc = LoadArrays(folder)
+      if np.array_equal(acc['oid'], index['oid']) and acc['fields'].tolist() == fields and \
+            'version' in acc and str(acc['version']) == version and \
+            'index_hash' in acc and str(acc['index_hash']) == str(index.get('graph_hash')):
+         print('Using upstream accumulation `' + folder + '`.')
+         acc.update(index)
+         return acc
+      # release the memory-mapped files before they are replaced
+      del acc
+   print('Accumulating catchment attributes upstream...')
+   att = arcpy.da.TableToNumPyArray(in_Catchment, [catID] + fields, null_value=0)
+   value = CatchmentValues(index, att[catID], np.column_stack([att[f].astype(np.float64) for f in fields]))
+   SaveArrays({'oid': index['oid'], 'fields': np.array(fields), 'version': np.array(version),
+               'index_hash': np.array(str(index.get('graph_hash'))), 'value': value,
+               'total': AccumulateUpstream(index, value)}, folder)
+   print('Upstream accumulation saved to `' + folder + '`.')
+   acc = LoadArrays(folder)
+   acc.update(index)
+   return acc
+
+
+def GdbPath(in_Data):
+   """Returns the path of the file geodatabase (or folder) containing a dataset."""
+   path = arcpy.Describe(in_Data).catalogPath
+   gdb = path
+   while gdb and not gdb.lower().endswith('.gdb') and os.path.dirname(gdb) != gdb:
+      gdb = os.path.dirname(gdb)
+   if not gdb.lower().endswith('.gdb'):
+      gdb = os.path.dirname(path)
+   return gdb
+
+
+def BuildIdIndex(oid, key):
+   """Builds a key -> row (OBJECTID) index from arrays. Returns a dictionary of arrays: key/oid sorted by key, and
+   oid_s/key_s sorted by OBJECTID for the reverse lookup."""
+   oid = np.asarray(oid, dtype=np.int64)
+   key = np.asarray(key)
+   o = np.argsort(key, kind='mergesort')
+   r = np.argsort(oid, kind='mergesort')
+   return {'key': key[o], 'oid': oid[o], 'oid_s': oid[r], 'key_s': key[r]}
+
+
+def SortedLookup(keys, vals, q):
+   """Looks up values for q in a sorted key array. Returns (values, found), where found marks q present in keys."""
+   q = np.asarray(q)
+   i = np.searchsorted(keys, q)
+   i[i >= len(keys)] = 0
+   found = (keys[i] == q) if len(keys) else np.zeros(len(q), dtype=bool)
+   return vals[i[found]], found
+
+
+def LookupIds(index, ids):
+   """Returns the OBJECTIDs for unique IDs (keys), and the IDs not found in the index."""
+   ids = np.unique(np.asarray(ids))
+   oids, found = SortedLookup(index['key'], index['oid'], ids)
+   return oids, ids[~found]
+
+
+def LookupKeys(index, oids):
+   """Returns the unique IDs (keys) for OBJECTIDs, in the same order. OBJECTIDs not in the index get NaN."""
+   oids = np.asarray(oids, dtype=np.int64)
+   keys, found = SortedLookup(index['oid_s'], index['key_s'], oids)
+   out = np.full(len(oids), np.nan)
+   out[found] = keys
+   return out
+
+
+def DataVersion(in_Data, oid=None):
+   """Returns a version string for a table or feature class (row count, maximum OBJECTID, extent and modification
+   time stamp, see HelperPro.DataStamp), used to tell when a saved index was made from different data.
+   oid = OBJECTIDs of the rows, if already read"""
+   from HelperPro import DataStamp
+   if oid is None:
+      oid = arcpy.da.TableToNumPyArray(in_Data, ['OID@'])['OID@']
+   desc = arcpy.Describe(in_Data)
+   ver = '%d;%d' % (len(oid), int(oid.max()) if len(oid) else 0)
+   if hasattr(desc, 'extent') and desc.extent is not None:
+      ext = desc.extent
+      ver += ';%.3f;%.3f;%.3f;%.3f' % (ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+   return ver + ';' + str(DataStamp(desc.catalogPath))
+
+
+def MakeIdIndex(in_Table, key, rebuild=False):
+   """Loads (memory-mapped) or builds a persistent key -> row index for a table, e.g. NHDPlusID for catchments or
+   flowlines. The index is saved in a folder next to the table's geodatabase
+   (`[gdb]_idIndex_[table]_[key]`), and is rebuilt if the table has changed (DataVersion), or if rebuild is True.
+   Parameters:
+   - in_Table = Input table or feature class
+   - key = Unique ID field
+   """
+   gdb = GdbPath(in_Table)
+   folder = os.path.splitext(gdb)[0] + '_idIndex_' + os.path.basename(arcpy.Describe(in_Table).catalogPath) + '_' + key
+   version = DataVersion(in_Table)
+   if os.path.exists(folder) and not rebuild:
+      index = LoadArrays(folder)
+      if 'version' in index and str(index['version']) == version:
+         return index
+      # release the memory-mapped files before they are replaced
+      del index
+   print('Building ID index on `' + key + '` for `' + in_Table + '`...')
+   arr = arcpy.da.TableToNumPyArray(in_Table, ['OID@', key], null_value=-1)
+   index = BuildIdIndex(arr['OID@'], arr[key])
+   index['version'] = np.array(version)
+   SaveArrays(index, folder)
+   return LoadArrays(folder)
+
+
+def FetchRows(in_Table, oids, fields, maxGap=1000):
+   """Fetches rows from a table by OBJECTID in bulk. Sorted OBJECTIDs are grouped into runs (gaps no larger than
+   maxGap), and each run is read with a single OBJECTID range query, so no ID lists are built into SQL strings.
+   Yields rows as lists: [OBJECTID] + fields.
+   Parameters:
+   - in_Table = Input table or feature class
+   - oids = OBJECTIDs of rows to fetch
+   - fields = Fields to return (cursor tokens such as SHAPE@ can be used)
+   """
+   oids = np.unique(np.asarray(oids, dtype=np.int64))
+   if len(oids) == 0:
+      return
+   oidFld = arcpy.Describe(in_Table).OIDFieldName
+   brk = np.where(np.diff(oids) > maxGap)[0]
+   starts = np.concatenate([[0], brk + 1])
+   ends = np.concatenate([brk, [len(oids) - 1]])
+   want = set(oids.tolist())
+   for a, b in zip(starts.tolist(), ends.tolist()):
+      qry = oidFld + ' >= ' + str(oids[a]) + ' AND ' + oidFld + ' <= ' + str(oids[b])
+      with arcpy.da.SearchCursor(in_Table, ['OID@'] + list(fields), where_clause=qry) as cursor:
+         for row in cursor:
+            if row[0] in want:
+               yield list(row)
+
+
+def BuildBoxIndex(oid, box, cellSize=None):
+   """Builds a uniform grid index over feature bounding boxes, used for point-in-polygon lookups.
+   Parameters:
+   - oid = OBJECTID of each feature
+   - box = Bounding boxes ([n, 4], as xmin, ymin, xmax, ymax)
+   - cellSize = Grid cell size (map units). Default is the median box width.
+
+   Returns a dictionary of arrays: oid, box, grid cell keys with a CSR list of boxes per cell (ptr, cell_box), and the
+   grid origin (x0, y0) and cell size (cs).
+   """
+   oid = np.asarray(oid, dtype=np.int64)
+   box = np.asarray(box, dtype=np.float64).reshape(-1, 4)
+   if cellSize is None:
+      cellSize = float(np.median(box[:, 2] - box[:, 0])) if len(box) > 0 else 1.0
+      cellSize = cellSize if cellSize > 0 else 1.0
+   x0 = box[:, 0].min() if len(box) > 0 else 0.0
+   y0 = box[:, 1].min() if len(box) > 0 else 0.0
+   cx0 = np.floor((box[:, 0] - x0) / cellSize).astype(np.int64)
+   cx1 = np.floor((box[:, 2] - x0) / cellSize).astype(np.int64)
+   cy0 = np.floor((box[:, 1] - y0) / cellSize).astype(np.int64)
+   cy1 = np.floor((box[:, 3] - y0) / cellSize).astype(np.int64)
+   nx = cx1 - cx0 + 1
+   ny = cy1 - cy0 + 1
+   n = nx * ny
+   b = np.repeat(np.arange(len(box)), n)
+   k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+   keys = CellKey(cx0[b] + k // ny[b], cy0[b] + k % ny[b])
+   o = np.argsort(keys, kind='mergesort')
+   keys, b = keys[o], b[o]
+   cells, first = np.unique(keys, return_index=True)
+   ptr = np.concatenate([first, [len(keys)]]).astype(np.int64)
+   return {'oid': oid, 'box': box, 'cells': cells, 'ptr': ptr, 'cell_box': b,
+           'x0': np.float64(x0), 'y0': np.float64(y0), 'cs': np.float64(cellSize)}
+
+
+def BoxCandidates(index, pt_xy):
+   """Returns the (point, feature) pairs where a point falls within a feature's bounding box, from a box index
+   (BuildBoxIndex). Returns two arrays: point position in pt_xy, and position of the feature in the index."""
+   pt_xy = np.asarray(pt_xy, dtype=np.float64).reshape(-1, 2)
+   cs = float(index['cs'])
+   keys = CellKey(np.floor((pt_xy[:, 0] - float(index['x0'])) / cs), np.floor((pt_xy[:, 1] - float(index['y0'])) / cs))
+   cells = index['cells']
+   if len(cells) == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+   c = np.minimum(np.searchsorted(cells, keys), len(cells) - 1)
+   hit = np.nonzero(cells[c] == keys)[0]
+   lo = index['ptr'][c[hit]]
+   n = index['ptr'][c[hit] + 1] - lo
+   pts = np.repeat(hit, n)
+   fts = np.asarray(index['cell_box'])[np.repeat(lo - np.cumsum(n) + n, n) + np.arange(n.sum())]
+   box = index['box'][fts]
+   x = pt_xy[pts, 0]
+   y = pt_xy[pts, 1]
+   ok = (x >= box[:, 0]) & (x <= box[:, 2]) & (y >= box[:, 1]) & (y <= box[:, 3])
+   return pts[ok], fts[ok]
+
+
+def MakeBoxIndex(in_Features, rebuild=False):
+   """Loads (memory-mapped) or builds a persistent bounding box index for a polygon feature class, e.g. catchments.
+   The index is saved in a folder next to the geodatabase (`[gdb]_boxIndex_[fc]`), and is rebuilt if the features
+   have changed (DataVersion), or if rebuild is True. Boxes are in the spatial reference of in_Features."""
+   gdb = GdbPath(in_Features)
+   folder = os.path.splitext(gdb)[0] + '_boxIndex_' + os.path.basename(arcpy.Describe(in_Features).catalogPath)
+   version = DataVersion(in_Features)
+   if os.path.exists(folder) and not rebuild:
+      index = LoadArrays(folder)
+      if 'version' in index and str(index['version']) == version:
+         return index
+      # release the memory-mapped files before they are replaced
+      del index
+   print('Building bounding box index for `' + in_Features + '`...')
+   oid = []
+   box = []
+   with arcpy.da.SearchCursor(in_Features, ['OID@', 'SHAPE@']) as cursor:
+      for row in cursor:
+         if row[1] is None:
+            continue
+         e = row[1].extent
+         oid.append(row[0])
+         box.append([e.XMin, e.YMin, e.XMax, e.YMax])
+   index = BuildBoxIndex(oid, box)
+   index['version'] = np.array(version)
+   SaveArrays(index, folder)
+   return LoadArrays(folder)
+
+
+def PointsInPolygons(in_Features, pt_xy, fields=None, index=None):
+   """Finds the polygons containing (or touching) each point, using the box index (MakeBoxIndex) for candidates, and
+   fetching only the candidate polygons for the exact test.
+   Parameters:
+   - in_Features = Polygon feature class
+   - pt_xy = Point coordinates ([n, 2]), in the spatial reference of in_Features
+   - fields = Fields to return for each polygon (default none)
+   - index = Box index, if already loaded
+
+   Returns a list of [point position, OBJECTID, polygon] + fields, one for each point/polygon pair.
+   """
+   if index is None:
+      index = MakeBoxIndex(in_Features)
+   pts, fts = BoxCandidates(index, pt_xy)
+   if len(pts) == 0:
+      return []
+   oids = index['oid'][fts]
+   cand = {}
+   for p, o in zip(pts.tolist(), oids.tolist()):
+      cand.setdefault(o, []).append(p)
+   sr = arcpy.Describe(in_Features).spatialReference
+   fields = list(fields or [])
+   out = []
+   for row in FetchRows(in_Features, list(cand.keys()), ['SHAPE@'] + fields):
+      for p in cand[row[0]]:
+         pt = arcpy.PointGeometry(arcpy.Point(pt_xy[p][0], pt_xy[p][1]), sr)
+         if not row[1].disjoint(pt):
+            out.append([p, row[0], row[1]] + row[2:])
+   return sorted(out, key=lambda a: a[:2])
@@ -0,0 +1,475 @@
+# ----------------------------------------------------------------------------------------
+# WatershedRaster.py
+# Version: ArcPro / Python 3+
+# Creation Date: 2026-10-16
+# Last Edit: 2026-10-16
+
+# Summary:
+# Watershed delineation over NHDPlusHR D8 flow direction rasters (fdr.tif, or hydrofix.gdb/fdr_sinkfix for region
+# 02), used as an alternative to arcpy.sa.Watershed in HealthyWaters.GetSubCatchments_hw.
+# Sub-catchments never extend past the catchment of their pour point, so the flow direction raster is read one
+# catchment at a time, in a window covering only that catchment. Cells outside the catchment are masked, and all
+# pour points in the catchment are labelled together, by a reverse-flow breadth-first search from the pour point
+# cells. Memory use is bounded by the largest catchment window, not the HU4 extent.
+# Pour points sharing a catchment are delineated in the same pass: each cell is labelled with the first pour point
+# downstream of it, and the nested watershed of each point is then rolled up from the labels of the points upstream
+# of it (NestedLabels), so overlapping watersheds do not need separate passes.
+
+# Usage Tips:
+# D8 codes are the ESRI/NHDPlus codes: 1 = E, 2 = SE, 4 = S, 8 = SW, 16 = W, 32 = NW, 64 = N, 128 = NE. Array rows
+# run north to south, as returned by RasterToNumPyArray.
+
+# Label rasters are vectorized directly (VectorizeLabels), by tracing the cell boundaries of each label, so no
+# intermediate rasters, polygon feature classes or dissolves are needed.
+
+# The labelling, masking, rasterizing and vectorizing functions only need numpy. arcpy is needed to read rasters and features,
+# and to write outputs.
+
+# Syntax:
+# labels = LabelWatersheds(fdr, seeds, mask)
+# rings = VectorizeLabels(RowBlocks(labels))
+# nest = NestedLabels(DrainPairs(fdr, labels), np.unique(labels[labels > 0]))
+# WatershedsD8(in_fdr, in_Lines, in_Cat, out_Polys, uid="OBJECTID_in_Points", catID="NHDPlusID")
+# ----------------------------------------------------------------------------------------
+
+# Import modules
+import os
+import numpy as np
+
+try:
+   import arcpy
+except ImportError:
+   # Labelling, masking and rasterizing are numpy-only.
+   arcpy = None
+
+# D8 code: [row offset, column offset] of the cell the code flows to
+d8Offsets = {1: [0, 1],
+             2: [1, 1],
+             4: [1, 0],
+             8: [1, -1],
+             16: [0, -1],
+             32: [-1, -1],
+             64: [-1, 0],
+             128: [-1, 1]}
+
+
+def LabelWatersheds(fdr, seeds, mask=None):
+   """Labels the watershed of each pour point in a D8 flow direction array, in one pass.
+   Parameters:
+   - fdr = Flow direction array (D8 codes)
+   - seeds = Integer array of the same shape, with the label of the pour point in pour point cells, and 0 elsewhere
+   - mask = Optional boolean array; cells outside the mask are not labelled (and not traversed)
+
+   Labelling is a breadth-first search against the flow direction: each round, the unlabelled cells which flow into
+   the current frontier take the label of the cell they flow into. Since each cell flows to exactly one cell, no cell
+   can be reached by two labels in one round. Pour point cells keep their own label, so a pour point upstream of
+   another ends that watershed, as in arcpy.sa.Watershed. Returns the label array (0 = no watershed).
+   """
+   fdr = np.asarray(fdr)
+   lab = np.array(seeds, dtype=np.int64)
+   if mask is not None:
+      mask = np.asarray(mask, dtype=bool)
+      lab[~mask] = 0
+   nr, nc = lab.shape
+   r, c = np.nonzero(lab)
+   while r.size > 0:
+      next_r = []
+      next_c = []
+      for code, off in d8Offsets.items():
+         # the neighbour which flows into (r, c) with this code
+         rn = r - off[0]
+         cn = c - off[1]
+         ok = (rn >= 0) & (rn < nr) & (cn >= 0) & (cn < nc)
+         rn, cn, rs, cs = rn[ok], cn[ok], r[ok], c[ok]
+         ok = (fdr[rn, cn] == code) & (lab[rn, cn] == 0)
+         if mask is not None:
+            ok &= mask[rn, cn]
+         rn, cn = rn[ok], cn[ok]
+         lab[rn, cn] = lab[rs[ok], cs[ok]]
+         next_r.append(rn)
+         next_c.append(cn)
+      r = np.concatenate(next_r)
+      c = np.concatenate(next_c)
+   return lab
+
+
+def GridWindow(grid, xmin, ymin, xmax, ymax):
+   """Returns the window of a raster grid covering an extent, as [row0, col0, nrows, ncols], aligned to the grid
+   cells and clipped to the raster. grid is a dictionary with x0, y1 (upper left corner), cs (cell size), nrows and
+   ncols (see RasterGrid). Returns None if the extent does not overlap the raster."""
+   cs = grid['cs']
+   col0 = max(int(np.floor((xmin - grid['x0']) / cs)), 0)
+   col1 = min(int(np.ceil((xmax - grid['x0']) / cs)), grid['ncols'])
+   row0 = max(int(np.floor((grid['y1'] - ymax) / cs)), 0)
+   row1 = min(int(np.ceil((grid['y1'] - ymin) / cs)), grid['nrows'])
+   if col1 <= col0 or row1 <= row0:
+      return None
+   return [row0, col0, row1 - row0, col1 - col0]
+
+
+def WindowOrigin(grid, win):
+   """Upper left corner (x0, y1) of a window from GridWindow."""
+   return grid['x0'] + win[1] * grid['cs'], grid['y1'] - win[0] * grid['cs']
+
+
+def PolygonMask(rings, x0, y1, cs, shape):
+   """Rasterizes polygon rings to a boolean array, marking cells with their center inside the polygon (even-odd
+   rule, so interior rings are holes).
+   Parameters:
+   - rings = List of vertex arrays ([n, 2]), one per ring
+   - x0, y1 = Upper left corner of the array
+   - cs = Cell size
+   - shape = [nrows, ncols]
+   """
+   mask = np.zeros(shape, dtype=bool)
+   if len(rings) == 0:
+      return mask
+   a = np.concatenate([np.asarray(r, dtype=float)[:-1] for r in rings])
+   b = np.concatenate([np.asarray(r, dtype=float)[1:] for r in rings])
+   xc = x0 + (np.arange(shape[1]) + 0.5) * cs
+   for i in range(shape[0]):
+      yc = y1 - (i + 0.5) * cs
+      e = (a[:, 1] <= yc) != (b[:, 1] <= yc)
+      if not e.any():
+         continue
+      xa, ya, xb, yb = a[e, 0], a[e, 1], b[e, 0], b[e, 1]
+      xs = np.sort(xa + (yc - ya) * (xb - xa) / (yb - ya))
+      mask[i] = np.searchsorted(xs, xc) % 2 == 1
+   return mask
+
+
+def LineCells(parts, x0, y1, cs, shape):
+   """Returns the [rows, cols] of the cells a polyline passes through, within an array. Segments are sampled at a
+   quarter of the cell size.
+   Parameters:
+   - parts = List of vertex arrays ([n, 2]), one per part
+   - x0, y1 = Upper left corner of the array
+   - cs = Cell size
+   - shape = [nrows, ncols]
+   """
+   pts = []
+   for p in parts:
+      p = np.asarray(p, dtype=float)
+      if len(p) == 1:
+         pts.append(p)
+         continue
+      for j in range(len(p) - 1):
+         n = max(int(np.ceil(np.hypot(*(p[j + 1] - p[j])) / (cs / 4.0))), 1)
+         t = np.arange(n + 1)[:, None] / float(n)
+         pts.append(p[j] + t * (p[j + 1] - p[j]))
+   if len(pts) == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+   pts = np.concatenate(pts)
+   rows = np.floor((y1 - pts[:, 1]) / cs).astype(np.int64)
+   cols = np.floor((pts[:, 0] - x0) / cs).astype(np.int64)
+   ok = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+   cell = np.unique(rows[ok] * shape[1] + cols[ok])
+   return cell // shape[1], cell % shape[1]
+
+
+def RasterizeLines(lines, x0, y1, cs, shape):
+   """Rasterizes labelled pour lines to a seed array for LabelWatersheds.
+   Parameters:
+   - lines = List of [label, parts], with parts as for LineCells. Where lines overlap, later lines take the cell.
+   - x0, y1, cs, shape = As for LineCells
+   """
+   seeds = np.zeros(shape, dtype=np.int64)
+   for lab, parts in lines:
+      r, c = LineCells(parts, x0, y1, cs, shape)
+      seeds[r, c] = lab
+   return seeds
+
+
+def DrainPairs(fdr, labels):
+   """Returns the [upstream, downstream] label pairs where one watershed drains directly into another, from a label
+   array from LabelWatersheds. Only pour point cells can drain to a different label, since every other cell has the
+   label of the cell it flows into."""
+   fdr = np.asarray(fdr)
+   nr, nc = labels.shape
+   pairs = []
+   for code, off in d8Offsets.items():
+      r, c = np.nonzero((labels > 0) & (fdr == code))
+      rd = r + off[0]
+      cd = c + off[1]
+      ok = (rd >= 0) & (rd < nr) & (cd >= 0) & (cd < nc)
+      up = labels[r[ok], c[ok]]
+      dn = labels[rd[ok], cd[ok]]
+      ok = (dn > 0) & (dn != up)
+      pairs.append(np.column_stack([up[ok], dn[ok]]))
+   pairs = np.concatenate(pairs)
+   if len(pairs) == 0:
+      return []
+   return np.unique(pairs, axis=0).tolist()
+
+
+def NestedLabels(pairs, labs):
+   """Rolls up watershed labels, given the drainage pairs from DrainPairs. Returns a dictionary of label: list of the
+   labels making up its full (nested) watershed, which are the label itself and all labels upstream of it."""
+   up = {}
+   for u, d in pairs:
+      up.setdefault(d, []).append(u)
+   nest = {}
+   for lab in labs:
+      lab = int(lab)
+      seen = {lab}
+      stack = [lab]
+      while stack:
+         for u in up.get(stack.pop(), []):
+            if u not in seen:
+               seen.add(u)
+               stack.append(u)
+      nest[lab] = sorted(seen)
+   return nest
+
+
+def LineLength(parts):
+   """Total length of a polyline, from its vertex arrays."""
+   return sum([np.hypot(*np.diff(np.asarray(p, dtype=float), axis=0).T).sum() for p in parts])
+
+
+def GeometryParts(geom):
+   """Vertex arrays of an arcpy Polyline or Polygon, one per part (polylines) or ring (polygons)."""
+   parts = []
+   for part in geom:
+      ring = []
+      for pt in part:
+         if pt is None:
+            # start of an interior ring
+            if len(ring) > 0:
+               parts.append(np.array(ring))
+            ring = []
+         else:
+            ring.append([pt.X, pt.Y])
+      if len(ring) > 0:
+         parts.append(np.array(ring))
+   return parts
+
+
+def RasterGrid(in_Raster):
+   """Returns the grid of a raster, as a dictionary: x0, y1 (upper left corner), cs (cell size), nrows, ncols, sr."""
+   d = arcpy.Describe(in_Raster)
+   return {'x0': d.extent.XMin, 'y1': d.extent.YMax, 'cs': d.meanCellWidth, 'nrows': d.height,
+           'ncols': d.width, 'sr': d.spatialReference}
+
+
+def ReadWindow(in_Raster, grid, win):
+   """Reads a window (see GridWindow) of a raster to a numpy array. NoData cells are 0."""
+   x0, y1 = WindowOrigin(grid, win)
+   ll = arcpy.Point(x0, y1 - win[2] * grid['cs'])
+   return arcpy.RasterToNumPyArray(in_Raster, ll, win[3], win[2], nodata_to_value=0)
+
+
+def LabelEdges(blocks):
+   """Finds the boundary edges of each label in a label raster, read as consecutive row blocks (so the raster does not
+   need to be held in memory). Label 0 is background.
+   Parameters:
+   - blocks = Iterable of 2D label arrays, consecutive row blocks of the raster (same number of columns)
+
+   Edges run along cell sides, between grid corners numbered row * (ncols + 1) + col. Each edge is directed with its
+   label on the right, so outer rings run clockwise and holes counter-clockwise (as in ESRI polygons). Returns
+   [label, start, end] arrays, sorted by label, and the number of columns.
+   """
+   labs, starts, ends = [], [], []
+
+   def add(lab, v0, v1):
+      ok = lab != 0
+      labs.append(lab[ok])
+      starts.append(v0[ok])
+      ends.append(v1[ok])
+
+   prev = None
+   i0 = 0
+   nc = 0
+   for blk in blocks:
+      blk = np.asarray(blk, dtype=np.int64)
+      nr, nc = blk.shape
+      w = nc + 1
+      # horizontal edges, along the top of each row
+      top = np.vstack([np.zeros((1, nc), dtype=np.int64) if prev is None else prev[None, :], blk[:-1]])
+      ii, jj = np.nonzero(top != blk)
+      v0 = (ii + i0) * w + jj
+      add(blk[ii, jj], v0, v0 + 1)
+      add(top[ii, jj], v0 + 1, v0)
+      # vertical edges, along the left of each column (and the right of the last column)
+      pad = np.zeros((nr, nc + 2), dtype=np.int64)
+      pad[:, 1:-1] = blk
+      ii, jj = np.nonzero(pad[:, :-1] != pad[:, 1:])
+      v0 = (ii + i0) * w + jj
+      add(pad[ii, jj + 1], v0 + w, v0)
+      add(pad[ii, jj], v0, v0 + w)
+      prev = blk[-1]
+      i0 += nr
+   if prev is not None:
+      # bottom of the last row
+      jj = np.nonzero(prev)[0]
+      v0 = i0 * (nc + 1) + jj
+      add(prev[jj], v0 + 1, v0)
+   if len(labs) == 0:
+      return np.zeros((0, 3), dtype=np.int64), nc
+   edges = np.column_stack([np.concatenate(labs), np.concatenate(starts), np.concatenate(ends)])
+   return edges[np.argsort(edges[:, 0], kind='stable')], nc
+
+
+def LinkRings(start, end, ncols):
+   """Links the boundary edges of one label (from LabelEdges) into closed rings. Returns a list of vertex arrays
+   ([n, 2], as [row, col] grid corners), with vertices along straight runs removed."""
+   out = {}
+   for k in range(len(start)):
+      out.setdefault(int(start[k]), []).append(k)
+   used = np.zeros(len(start), dtype=bool)
+   rings = []
+   for k in range(len(start)):
+      if used[k]:
+         continue
+      first = int(start[k])
+      ring = [first]
+      cur = k
+      while True:
+         used[cur] = True
+         v = int(end[cur])
+         if v == first:
+            break
+         ring.append(v)
+         nxt = [e for e in out[v] if not used[e]]
+         cur = nxt[0]
+      ring = np.array(ring)
+      rc = np.column_stack([ring // (ncols + 1), ring % (ncols + 1)])
+      # drop vertices where the direction does not change
+      d_in = rc - np.roll(rc, 1, axis=0)
+      d_out = np.roll(rc, -1, axis=0) - rc
+      rc = rc[np.any(d_in != d_out, axis=1)]
+      rings.append(np.vstack([rc, rc[:1]]))
+   return rings
+
+
+def VectorizeLabels(blocks):
+   """Vectorizes a label raster, read as consecutive row blocks (see LabelEdges). Returns a dictionary of label:
+   list of rings, each a vertex array ([n, 2], as [row, col] grid corners), so each label makes one (multipart)
+   polygon."""
+   edges, nc = LabelEdges(blocks)
+   rings = {}
+   if len(edges) == 0:
+      return rings
+   brk = np.nonzero(np.diff(edges[:, 0]))[0] + 1
+   for e in np.split(edges, brk):
+      rings[int(e[0, 0])] = LinkRings(e[:, 1], e[:, 2], nc)
+   return rings
+
+
+def RowBlocks(arr, blockRows=512):
+   """Row blocks of an array, for VectorizeLabels."""
+   for i in range(0, arr.shape[0], blockRows):
+      yield arr[i:i + blockRows]
+
+
+def RingsToPolygon(rings, x0, y1, cs, sr):
+   """Makes an arcpy Polygon from rings from VectorizeLabels, with the grid origin at (x0, y1) and cell size cs."""
+   arr = arcpy.Array([arcpy.Array([arcpy.Point(x0 + c * cs, y1 - r * cs) for r, c in ring]) for ring in rings])
+   return arcpy.Polygon(arr, sr)
+
+
+def LabelsToPolygons(labels, x0, y1, cs, sr, blockRows=512):
+   """Converts a label array to polygons, one per label. Returns a dictionary of label: arcpy Polygon."""
+   rings = VectorizeLabels(RowBlocks(labels, blockRows))
+   return dict([[lab, RingsToPolygon(r, x0, y1, cs, sr)] for lab, r in rings.items()])
+
+
+def VectorizeRaster(in_Raster, out_Polys, field="gridcode", blockRows=512):
+   """Converts an integer raster to polygons, with one (multipart) feature per value, in field. The raster is read in
+   blocks of rows, so only the boundaries are held in memory. Used in place of RasterToPolygon and Dissolve."""
+   grid = RasterGrid(in_Raster)
+
+   def blocks():
+      for i in range(0, grid['nrows'], blockRows):
+         yield ReadWindow(in_Raster, grid, [i, 0, min(blockRows, grid['nrows'] - i), grid['ncols']])
+
+   rings = VectorizeLabels(blocks())
+   ws, nm = os.path.dirname(out_Polys), os.path.basename(out_Polys)
+   arcpy.CreateFeatureclass_management(ws, nm, "POLYGON", spatial_reference=grid['sr'])
+   arcpy.AddField_management(out_Polys, field, "LONG")
+   with arcpy.da.InsertCursor(out_Polys, ["SHAPE@", field]) as ins:
+      for lab in sorted(rings.keys()):
+         ins.insertRow([RingsToPolygon(rings[lab], grid['x0'], grid['y1'], grid['cs'], grid['sr']), lab])
+   return out_Polys
+
+
+def WatershedsD8(in_fdr, in_Lines, in_Cat, out_Polys, uid="OBJECTID_in_Points", catID="NHDPlusID", nested=True):
+   """Delineates the watershed of each pour line within its catchment, over a D8 flow direction raster. This
+   replaces PolylineToRaster, Watershed, RasterToPolygon, Identity and Select in GetSubCatchments_hw.
+   Parameters:
+   - in_fdr = D8 flow direction raster
+   - in_Lines = Pour lines (starting flowline of each network), with uid and catID fields. Selections are honored.
+   - in_Cat = Catchments, with one row for each uid (catchment of the pour line)
+   - out_Polys = Output sub-catchments. Uses the schema of in_Cat, and copies the attributes of each uid's row.
+   - uid = Unique integer ID for each network
+   - catID = Catchment ID field, shared by in_Lines and in_Cat
+   - nested = If True, the watershed of each pour line includes the watersheds of pour lines upstream of it in the
+      same catchment, so all pour lines can be processed at once. Where pour lines overlap (e.g. two points on one
+      flowline, each traced to the top of the flowline), the shorter line, from the upstream point, gets the cells.
+      If False, watersheds end at the next pour line upstream, as with arcpy.sa.Watershed.
+
+   Returns out_Polys.
+   """
+   grid = RasterGrid(in_fdr)
+   sr = grid['sr']
+
+   # pour lines, by catchment
+   lines = {}
+   with arcpy.da.SearchCursor(in_Lines, [catID, uid, "SHAPE@"], spatial_reference=sr) as cursor:
+      for row in cursor:
+         lines.setdefault(row[0], []).append([int(row[1]), GeometryParts(row[2])])
+
+   # catchment rows for the pour lines
+   flds = [f.name for f in arcpy.ListFields(in_Cat) if f.type not in ['OID', 'Geometry'] and f.editable]
+   ix = [flds.index(uid), flds.index(catID)]
+   cats = {}
+   attr = {}
+   with arcpy.da.SearchCursor(in_Cat, flds + ["SHAPE@"], spatial_reference=sr) as cursor:
+      for row in cursor:
+         if row[ix[1]] in lines:
+            cats[row[ix[1]]] = row[-1]
+            attr[int(row[ix[0]])] = list(row[:-1])
+
+   ws, nm = os.path.dirname(out_Polys), os.path.basename(out_Polys)
+   out_sr = arcpy.Describe(in_Cat).spatialReference
+   arcpy.CreateFeatureclass_management(ws, nm, "POLYGON", in_Cat, spatial_reference=out_sr)
+   print('Labelling watersheds for ' + str(len(lines)) + ' catchments...')
+   with arcpy.da.InsertCursor(out_Polys, ["SHAPE@"] + flds) as ins:
+      for c in lines.keys():
+         if c not in cats:
+            continue
+         ext = cats[c].extent
+         win = GridWindow(grid, ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+         if win is None:
+            continue
+         x0, y1 = WindowOrigin(grid, win)
+         fdr = ReadWindow(in_fdr, grid, win)
+         mask = PolygonMask(GeometryParts(cats[c]), x0, y1, grid['cs'], fdr.shape)
+         ls = lines[c]
+         if nested:
+            # longest first, so shorter (upstream) lines take the overlapping cells
+            ls = sorted(ls, key=lambda a: -LineLength(a[1]))
+         seeds = RasterizeLines(ls, x0, y1, grid['cs'], fdr.shape)
+         labels = LabelWatersheds(fdr, seeds, mask)
+         polys = LabelsToPolygons(labels, x0, y1, grid['cs'], sr)
+         if nested:
+            nest = NestedLabels(DrainPairs(fdr, labels), polys.keys())
+            for lab, parts in ls:
+               if lab not in polys:
+                  # all of its cells were taken by an upstream line: same watershed as that line
+                  r, col = LineCells(parts, x0, y1, grid['cs'], fdr.shape)
+                  own = seeds[r, col]
+                  own = own[own > 0]
+                  if len(own) > 0:
+                     nest[lab] = nest[int(np.bincount(own).argmax())]
+            for lab, labs in nest.items():
+               if lab in attr:
+                  geom = polys[labs[0]]
+                  for u in labs[1:]:
+                     geom = geom.union(polys[u])
+                  ins.insertRow([geom.projectAs(out_sr)] + attr[lab])
+         else:
+            for lab, geom in polys.items():
+               if lab in attr:
+                  ins.insertRow([geom.projectAs(out_sr)] + attr[lab])
+   return out_Polys
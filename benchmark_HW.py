@@ -0,0 +1,245 @@
+# ----------------------------------------------------------------------------------------
+# benchmark_HW.py
+# Version: ArcPro / Python 3+
+# Creation Date: 2026-10-16
+# Last Edit: 2026-10-16
+
+# Summary:
+# Benchmarks for the watershed functions in HealthyWaters.py, on synthetic data, so they can be run on any machine
+# (no arcpy or HydroNet needed). For each network size, a synthetic dendritic flowline network and catchment boxes
+# are generated, with a D8 flow direction grid derived from the network (so the grid grows with the network), and
+# the numpy cores behind each stage are timed at several point counts:
+# - trace: flow graph, segment grid, snapping and upstream trace (TraceNetworks_hw / GetNetworks_hw)
+# - full watershed: upstream index build and index trace (fullWs band)
+# - catchments: catchment selection and copy for each network (GetCatchments_hw: network/catchment pairs from the
+#   full watershed, catchment rows by ID, one copied row per pair) and point-in-catchment candidates
+# - sub-catchments: D8 watershed labelling, nesting and vectorizing (GetSubCatchments_hw, native=True)
+# Times are printed as a table, with the scaling exponent of each stage (slope of log time against log network size,
+# and against log point count), and can be saved to JSON to compare runs.
+
+# Usage Tips:
+# python benchmark_HW.py --sizes 1000 10000 100000 1000000 --points 100 1000 10000 --json bench.json
+# The D8 grid has --cellsPerSeg cells per flowline segment (default 16, about 16M cells for 1M segments).
+# ----------------------------------------------------------------------------------------
+
+# Import modules
+import argparse
+import json
+import time
+import numpy as np
+
+from HydroGraph import *
+from WatershedRaster import d8Offsets, LabelWatersheds, DrainPairs, NestedLabels, VectorizeLabels, RowBlocks
+
+
+def LowestNeighbour(elev):
+   """D8 flow direction array from an elevation array: each cell flows to its lowest neighbour, if it is lower than
+   the cell (otherwise the code is 0). Since elevation strictly decreases along flow, there are no loops."""
+   nr, nc = elev.shape
+   pad = np.full((nr + 2, nc + 2), np.inf)
+   pad[1:-1, 1:-1] = elev
+   fdr = np.zeros((nr, nc), dtype=np.int64)
+   low = elev.copy()
+   for code, off in d8Offsets.items():
+      nb = pad[1 + off[0]:nr + 1 + off[0], 1 + off[1]:nc + 1 + off[1]]
+      take = nb < low
+      fdr[take] = code
+      low[take] = nb[take]
+   return fdr
+
+
+def SyntheticFdr(side, seed=0):
+   """Generates a D8 flow direction grid (side x side) draining to the lower left cell. Elevation is the distance
+   to the outlet (in cells) plus noise smaller than one, and each cell flows to its lowest neighbour, so every cell
+   drains to the outlet without loops."""
+   rng = np.random.default_rng(seed)
+   r, c = np.mgrid[0:side, 0:side]
+   return LowestNeighbour(np.maximum(side - 1 - r, c) + rng.uniform(0, 0.9, (side, side)))
+
+
+def SyntheticNetwork(nSeg, segLen=500.0, seed=0):
+   """Generates a synthetic dendritic flowline network on a square lattice of L x L nodes, L * L - 1 flowlines (at
+   least nSeg), spaced segLen apart. Each node drains to a neighbouring node (SyntheticFdr on the lattice), so the
+   network is a tree draining to the lower left node, and flowlines do not overlap, as in a drainage network from a
+   DEM. Each flowline runs from its node to the downstream node, with three vertices, digitized in the direction of
+   flow. About 2% of flowlines are restricted (NoEphemeral bit).
+   Returns arrays for HydroGraph.BuildFlowGraph (oid, nid, barrier, v_oid, v_xy), catchment bounding boxes (one
+   per flowline, as xmin, ymin, xmax, ymax, around its node), and the network distance from the top of each flowline
+   to the outlet.
+   """
+   rng = np.random.default_rng(seed)
+   L = max(2, int(np.ceil(np.sqrt(nSeg + 1))))
+   code = SyntheticFdr(L, seed).ravel()
+   r, c = np.divmod(np.arange(L * L), L)
+   node = np.nonzero(code)[0]
+   off = np.array([d8Offsets[k] for k in code[node].tolist()]).reshape(-1, 2)
+   down = (r[node] + off[:, 0]) * L + c[node] + off[:, 1]
+   xy = np.column_stack([c * segLen, (L - 1 - r) * segLen]).astype(np.float64)
+   top = xy[node]
+   bot = xy[down]
+   mid = (top + bot) / 2.0 + rng.normal(0, segLen / 50.0, top.shape)
+   # network distance to the outlet, for the node at the top of each flowline; nodes are done in order of their
+   # lattice elevation (distance to the outlet), so the downstream node is always done first
+   seg = np.hypot(*(mid - top).T) + np.hypot(*(bot - mid).T)
+   dist = np.zeros(L * L)
+   order = np.argsort(np.maximum(L - 1 - r[node], c[node]), kind='mergesort')
+   for i, d, s in zip(node[order].tolist(), down[order].tolist(), seg[order].tolist()):
+      dist[i] = dist[d] + s
+   oid = np.arange(1, len(node) + 1)
+   v_oid = np.repeat(oid, 3)
+   v_xy = np.stack([top, mid, bot], axis=1).reshape(-1, 2)
+   barrier = np.where(rng.random(len(oid)) < 0.02, barrierBits["NoEphemeral"], 0)
+   box = np.column_stack([top - segLen / 2.0, top + segLen / 2.0])
+   return oid, oid + 10 ** 10, barrier, v_oid, v_xy, box, dist[node]
+
+
+def NetworkFdr(v_xy, topDist, segLen, k):
+   """Derives a D8 flow direction grid from a synthetic network (SyntheticNetwork), with k x k cells per lattice
+   square (segLen / k cell size). Flowlines are burned in with their network distance to the outlet as elevation,
+   and other cells get the elevation of the nearest flowline cell plus a steep slope (10 per map unit), so they drain
+   to the flowlines, and flowline cells drain along the network.
+   Returns the flow direction array, and the grid origin (x0, y1: upper left corner) and cell size."""
+   cs = segLen / k
+   pts = v_xy.reshape(-1, 3, 2)
+   x0 = pts[:, :, 0].min() - segLen / 2.0
+   y1 = pts[:, :, 1].max() + segLen / 2.0
+   nr = int(np.ceil((y1 - pts[:, :, 1].min() + segLen / 2.0) / cs))
+   nc = int(np.ceil((pts[:, :, 0].max() + segLen / 2.0 - x0) / cs))
+   elev = np.full((nr, nc), np.inf)
+   # sample each flowline at a quarter of the cell size, with elevation falling along the line
+   t = np.linspace(0, 1, 4 * k + 1)
+   d = topDist
+   for a, b in [[0, 1], [1, 2]]:
+      p0, p1 = pts[:, a], pts[:, b]
+      ln = np.hypot(*(p1 - p0).T)
+      xy = p0[:, None, :] + t[None, :, None] * (p1 - p0)[:, None, :]
+      e = d[:, None] - t[None, :] * ln[:, None]
+      rows = np.clip(((y1 - xy[:, :, 1]) / cs).astype(np.int64), 0, nr - 1)
+      cols = np.clip(((xy[:, :, 0] - x0) / cs).astype(np.int64), 0, nc - 1)
+      np.minimum.at(elev, (rows.ravel(), cols.ravel()), e.ravel())
+      d = d - ln
+   # spread elevations away from the flowlines
+   steps = [[off, 10.0 * cs * np.hypot(*off)] for off in d8Offsets.values()]
+   while True:
+      pad = np.full((nr + 2, nc + 2), np.inf)
+      pad[1:-1, 1:-1] = elev
+      new = elev.copy()
+      for off, step in steps:
+         np.minimum(new, pad[1 + off[0]:nr + 1 + off[0], 1 + off[1]:nc + 1 + off[1]] + step, out=new)
+      if not (new < elev).any():
+         break
+      elev = new
+   return LowestNeighbour(elev), x0, y1, cs
+
+
+def CatchmentPairs(idIndex, box, graph, full):
+   """Catchment selection and copy, as in GetCatchments_hw: unique (point, catchment ID) pairs from the full
+   watershed pieces, the catchment row of each ID looked up in the ID index, and the catchment (box) copied for each
+   pair. Returns the pairs and their boxes."""
+   nid = np.asarray(graph['nid'])[full['edge']]
+   pairs = np.unique(np.column_stack([full['pt'], nid]), axis=0)
+   oids, found = SortedLookup(idIndex['key'], idIndex['oid'], pairs[:, 1])
+   return pairs[found], box[oids - 1]
+
+
+def Timed(results, stage, size, npts, fn, *args):
+   """Runs fn(*args), recording the wall time for the stage. Returns the result of fn."""
+   t0 = time.time()
+   out = fn(*args)
+   results.append({'stage': stage, 'segments': size, 'points': npts, 'seconds': round(time.time() - t0, 4)})
+   print('  %-16s segments=%-8d points=%-7d %8.3f s' % (stage, size, npts, results[-1]['seconds']))
+   return out
+
+
+def RunBenchmark(sizes, pointCounts, up_Dist=5000.0, snap_dist=50.0, cellsPerSeg=16, seed=0, segLen=500.0):
+   """Runs all stages for each network size and point count. Returns a list of results
+   ({stage, segments, points, seconds})."""
+   results = []
+   rng = np.random.default_rng(seed)
+   barriers = BarrierMask()
+   k = max(1, int(round(np.sqrt(cellsPerSeg))))
+   for size in sizes:
+      oid, nid, barrier, v_oid, v_xy, box, topDist = SyntheticNetwork(size, segLen, seed)
+      size = len(oid)
+      print('Network with ' + str(size) + ' segments...')
+      graph = Timed(results, 'graph', size, 0, BuildFlowGraph, oid, nid, barrier, v_oid, v_xy)
+      grid = Timed(results, 'segmentGrid', size, 0, BuildSegmentGrid, graph, snap_dist, barriers)
+      index = Timed(results, 'upstreamIndex', size, 0, BuildUpstreamIndex, graph, barriers)
+      idIndex = Timed(results, 'idIndex', size, 0, BuildIdIndex, oid, nid)
+      boxIndex = Timed(results, 'boxIndex', size, 0, BuildBoxIndex, oid, box)
+      fdr, x0, y1, cs = Timed(results, 'flowDirection', size, 0, NetworkFdr, v_xy, topDist, segLen, k)
+
+      for npts in pointCounts:
+         # points near random flowline vertices
+         v = rng.integers(0, len(v_xy), npts)
+         pt_xy = v_xy[v] + rng.normal(0, snap_dist / 3.0, (npts, 2))
+         edge, meas, dist = Timed(results, 'snap', size, npts, SnapPoints, graph, pt_xy, snap_dist, barriers, grid)
+         starts = [[i, e, m] for i, (e, m) in enumerate(zip(edge.tolist(), meas.tolist())) if e >= 0]
+         pieces = Timed(results, 'trace', size, npts, TraceUpstream, graph, starts, up_Dist, barriers)
+         full = Timed(results, 'fullTrace', size, npts, IndexTrace, index, graph, starts)
+         Timed(results, 'catchments', size, npts, CatchmentPairs, idIndex, box, graph, full)
+         Timed(results, 'pointCatchments', size, npts, BoxCandidates, boxIndex, pt_xy)
+
+         # sub-catchments: one pass for all pour points (the cells of the snapped points) on the D8 grid
+         seeds = np.zeros(fdr.shape, dtype=np.int64)
+         snapped = np.nonzero(edge >= 0)[0]
+         rows = np.clip(((y1 - pt_xy[snapped, 1]) / cs).astype(np.int64), 0, fdr.shape[0] - 1)
+         cols = np.clip(((pt_xy[snapped, 0] - x0) / cs).astype(np.int64), 0, fdr.shape[1] - 1)
+         seeds[rows, cols] = snapped + 1
+         labels = Timed(results, 'subCatchments', size, npts, LabelWatersheds, fdr, seeds)
+         Timed(results, 'nestWatersheds', size, npts,
+               lambda: NestedLabels(DrainPairs(fdr, labels), np.unique(labels[labels > 0])))
+         Timed(results, 'vectorize', size, npts, lambda: VectorizeLabels(RowBlocks(labels)))
+   return results
+
+
+def Slope(x, y):
+   """Slope of log(y) against log(x), or None if there are fewer than two usable values."""
+   x = np.asarray(x, dtype=float)
+   y = np.asarray(y, dtype=float)
+   ok = (x > 0) & (y > 0)
+   if ok.sum() < 2 or len(np.unique(x[ok])) < 2:
+      return None
+   return round(float(np.polyfit(np.log(x[ok]), np.log(y[ok]), 1)[0]), 2)
+
+
+def ScalingReport(results):
+   """Scaling exponents per stage: against network size (at the largest point count, or 0 for per-network stages)
+   and against point count (at the largest network size)."""
+   report = {}
+   for stage in sorted(set([r['stage'] for r in results])):
+      rs = [r for r in results if r['stage'] == stage]
+      maxPts = max([r['points'] for r in rs])
+      maxSize = max([r['segments'] for r in rs])
+      bySize = [r for r in rs if r['points'] == maxPts]
+      byPts = [r for r in rs if r['segments'] == maxSize]
+      report[stage] = {'vsSegments': Slope([r['segments'] for r in bySize], [r['seconds'] for r in bySize]),
+                       'vsPoints': Slope([r['points'] for r in byPts], [r['seconds'] for r in byPts])}
+   print('\nScaling exponents (time ~ n^k):')
+   print('  %-16s %12s %12s' % ('stage', 'segments', 'points'))
+   for stage, k in report.items():
+      print('  %-16s %12s %12s' % (stage, k['vsSegments'], k['vsPoints']))
+   return report
+
+
+def main():
+   parser = argparse.ArgumentParser(description='Benchmark the watershed functions on synthetic networks.')
+   parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+   parser.add_argument('--points', type=int, nargs='+', default=[100, 1000, 10000])
+   parser.add_argument('--upDist', type=float, default=5000.0)
+   parser.add_argument('--cellsPerSeg', type=int, default=16, help='D8 grid cells per flowline segment')
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--json', default=None, help='Output JSON file for results')
+   args = parser.parse_args()
+
+   results = RunBenchmark(args.sizes, args.points, args.upDist, cellsPerSeg=args.cellsPerSeg, seed=args.seed)
+   report = ScalingReport(results)
+   if args.json:
+      with open(args.json, 'w') as f:
+         json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'args': vars(args), 'results': results,
+                    'scaling': report}, f, indent=1)
+      print('Results written to ' + args.json + '.')
+
+
+if __name__ == '__main__':
+   main()